@@ -7,7 +7,9 @@ import platform
 from aiot.app import App
 from aiot.config import Config
 from aiot.fastboot import Fastboot
+from aiot.fastboot_async import AsyncFastboot
 from aiot.flash import Flash
+from aiot.session import FlashSession
 from aiot.ubootenv import UBootEnv
 from aiot.version import version
 
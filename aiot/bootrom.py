@@ -1,20 +1,67 @@
+import logging
 import platform
+import sys
+import threading
+import time
 import aiot_bootrom.bootrom
 from pathlib import Path
 
+from aiot.bootrom_log_parser import BootromProgress
+from aiot.timeout import SupervisedProcess, Timeouts, print_line, timeout_event
+
 if platform.system() == 'Linux':
     import pyudev
 
-def udev_wait():
+# Held from starting the bootrom tool of a board until the tool opens it:
+# the tool takes the first boot ROM device it finds, so the bootstraps of
+# a process, of boards dispatched together or of concurrent sessions, must
+# not be looking for one at the same time
+bootrom_open_lock = threading.Lock()
+
+class OpenPhase:
+    # Hold bootrom_open_lock until the bootrom tool output shows it opened
+    # its board, passing the lines on to on_line.
+
+    def __init__(self, on_line=None):
+        self.on_line = on_line
+        self.held = False
+
+    def __enter__(self):
+        bootrom_open_lock.acquire()
+        self.held = True
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        if self.held:
+            self.held = False
+            bootrom_open_lock.release()
+
+    def parse_line(self, line):
+        if "Opening" in line:
+            self.release()
+        if self.on_line:
+            self.on_line(line)
+
+def udev_wait(timeout=None):
+    # Wait for a MediaTek USB device to be bound, return False on timeout.
     context = pyudev.Context()
     monitor = pyudev.Monitor.from_netlink(context)
     monitor.filter_by(subsystem="usb")
+    monitor.start()
 
-    for action, device in monitor:
+    end = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        remaining = max(end - time.monotonic(), 0) if end is not None else None
+        device = monitor.poll(remaining)
+        if device is None:
+            return False
         if 'ID_VENDOR_ID' in device and 'ID_MODEL_ID' in device:
             if device['ID_VENDOR_ID'] == '0e8d':
-                if action == 'bind':
-                    break
+                if device.action == 'bind':
+                    return True
 
 def add_bootstrap_group(parser):
     group = parser.add_argument_group('Bootstrap')
@@ -39,7 +86,12 @@ def add_bootstrap_group(parser):
     group.add_argument('--bootstrap-mode', type=str, default='aarch64',
                        choices=['aarch64', 'aarch32'])
 
-def run_bootrom(args):
+def run_bootrom(args, callback=None, on_event=None, port=None):
+    # Load the bootstrap through the boot ROM. callback receives the
+    # TimeoutEvent if the bootstrap stage exceeds its limits. In daemon
+    # mode, on_event receives a BootromEvent as each step starts. port is
+    # the USB port of a board already in download mode, dispatched by the
+    # daemon: its boot ROM device is not waited for.
     image_path = Path(args.path)
     bootrom_app = [
         'aiot-bootrom',
@@ -59,14 +111,40 @@ def run_bootrom(args):
        # To avoid bootrom_tool from sending these files, pass invalid values for -s and -t
        bootrom_app.extend(['-s', '', '-t', ''])
 
-    if platform.system() == 'Linux':
+    if port is None and platform.system() == 'Linux':
         udev_wait()
+
+    # Run the bootrom-tool binary directly, under the bootstrap stage limits
+    timeouts = Timeouts.from_args(args)
+    bootrom_app[0] = aiot_bootrom.bootrom.get_exec_path()
+    on_line = print_line
     if args.daemon:
-        try:
-            return aiot_bootrom.bootrom.check_output(bootrom_app)
-        except subprocess.CalledProcessError as e:
-            return e.stdout
-        except KeyboardInterrupt:
-            pass
-    else:
-        return aiot_bootrom.bootrom.run(bootrom_app)
+        on_line = BootromProgress(on_event).parse_line if on_event else None
+    opening = OpenPhase(on_line)
+    on_line = opening.parse_line
+
+    def parse_line(line):
+        # The tool may wait for the operator to put the board in download
+        # mode: the deadline only runs once it opens the boot ROM.
+        if "Opening" in line:
+            child.start_deadline()
+        if on_line:
+            on_line(line)
+
+    child = SupervisedProcess(bootrom_app, timeouts.deadline('bootstrap'), timeouts.inactivity('bootstrap'),
+                              on_line=parse_line, deferred=True)
+    try:
+        with opening:
+            child.run()
+    except KeyboardInterrupt:
+        if args.daemon:
+            return None
+        sys.exit(1)
+
+    if child.timed_out:
+        event = timeout_event('bootstrap', child.timed_out, child.limit())
+        logging.getLogger('aiot').error(event.error)
+        if callback:
+            callback(event)
+    if args.daemon:
+        return child.stdout()
@@ -2,9 +2,10 @@
 # Copyright 2024 (c) MediaTek Inc.
 # Author: Macpaul Lin <macpaul.lin@mediatek.com>
 
-import json
 import re
 
+from aiot.events import BootromEvent
+
 # Pre-compile regular expressions for log parsing
 patterns = {
     "com_port": re.compile(r"Opening (\/dev\/ttyACM\d+|COM\d+) using baudrate=(\d+)"),
@@ -41,10 +42,24 @@ def parse_log_line(line, result):
         if match:
             result["address"], result["mode"] = match.groups()
 
-def bootrom_log_parser(log):
-    # Parse the bootrom log and convert it to JSON.
+class BootromProgress:
+    # Report a BootromEvent to callback each time the bootstrap log,
+    # given line by line, enters a new step.
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.result = {}
+
+    def parse_line(self, line):
+        action = self.result.get("action")
+        parse_log_line(line, self.result)
+        if self.result.get("action") != action:
+            self.callback(BootromEvent.from_dict(self.result))
+
+def parse_bootrom_log(log):
+    # Parse the bootrom log into a BootromEvent.
     if log is None:
-        return json.dumps({"error": "No log output"}, indent=4)
+        return BootromEvent(error="No log output")
 
     result = {
         "action": "",
@@ -59,4 +74,8 @@ def bootrom_log_parser(log):
     for line in log.splitlines():
         parse_log_line(line, result)
 
-    return json.dumps(result, indent=4)
+    return BootromEvent.from_dict(result)
+
+def bootrom_log_parser(log):
+    # Parse the bootrom log and convert it to JSON.
+    return parse_bootrom_log(log).to_json()
@@ -0,0 +1,271 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+
+# Default limit of the disk space taken by the artifact cache
+DEFAULT_CACHE_SIZE = 4096 * 1024 * 1024
+# Entries used this recently are kept even over the limit, another
+# process may still be reading them
+EVICT_GRACE_SECONDS = 3600
+# Temporary files older than this were left by an interrupted writer
+STALE_TEMP_SECONDS = 24 * 3600
+TEMP_PREFIX = '.tmp-'
+
+def cache_directory(*names):
+    # Directory of the data genio-tools keeps between runs.
+    if platform.system() == 'Windows' and os.environ.get('LOCALAPPDATA'):
+        base = os.environ['LOCALAPPDATA']
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'genio-tools', *names)
+
+def same_content(path, other):
+    # Whether two small files hold the same bytes.
+    try:
+        if os.path.getsize(path) != os.path.getsize(other):
+            return False
+        with open(path, 'rb') as a, open(other, 'rb') as b:
+            return a.read() == b.read()
+    except OSError:
+        return False
+
+class CacheWriter:
+    """
+    A cache entry being written to a temporary file, published under its
+    key by commit() with an atomic rename, so that readers never see a
+    partial entry. All-zero writes become holes of a sparse file.
+    """
+
+    def __init__(self, cache, kind, key):
+        self.cache = cache
+        self.kind = kind
+        self.key = key
+        fd, self.temp = tempfile.mkstemp(dir=cache.directory, prefix=TEMP_PREFIX)
+        self.fp = os.fdopen(fd, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        if self.fp is None:
+            return
+        if self.size + len(data) > self.cache.max_size:
+            # would not fit, give up on the entry
+            self.discard()
+            return
+        if data and data.count(0) == len(data):
+            self.fp.seek(len(data), os.SEEK_CUR)
+        else:
+            self.fp.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        if self.fp is None:
+            return False
+        try:
+            self.fp.truncate(self.size)
+            self.fp.close()
+            self.fp = None
+            os.replace(self.temp, self.cache.path(self.key))
+        except OSError as e:
+            self.cache.logger.warning(f"Cannot store {self.kind} in the artifact cache: {e}")
+            self.discard()
+            return False
+        self.cache.count(self.kind, 'stores')
+        self.cache.evict()
+        return True
+
+    def discard(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        try:
+            os.remove(self.temp)
+        except OSError:
+            pass
+
+class ArtifactCache:
+    """
+    Files derived from an image, such as sparse conversions, decompressed
+    images and generated binaries, kept on disk across runs.
+
+    Entries are keyed by a digest of what they are derived from and how,
+    so an entry is never updated in place: writers publish complete
+    entries with an atomic rename, and concurrent workers and processes
+    share the directory safely. Least recently used entries are evicted
+    once the cache exceeds max_size bytes, 0 disables the cache.
+    """
+
+    def __init__(self, directory=None, max_size=DEFAULT_CACHE_SIZE):
+        self.logger = logging.getLogger('aiot')
+        self.directory = directory or cache_directory('artifacts')
+        self.max_size = max_size
+        # decompressed streams are also stored, only when asked: it writes
+        # the whole decompressed image to disk
+        self.streams = False
+        self.lock = threading.Lock()
+        # hits, misses and stores of each kind of entry
+        self.stats = {}
+
+    def configure(self, max_size=None, directory=None, streams=None):
+        if max_size is not None:
+            self.max_size = max_size
+        if directory is not None:
+            self.directory = directory
+        if streams is not None:
+            self.streams = streams
+
+    def fits(self, size):
+        # Whether an entry of size bytes, None when unknown, may fit.
+        return self.enabled and (size is None or size <= self.max_size)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def key(self, kind, *params):
+        # Digest identifying an entry of kind derived with params, which
+        # must be JSON serializable.
+        return hashlib.sha256(json.dumps([kind, params]).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def count(self, kind, what):
+        with self.lock:
+            stats = self.stats.setdefault(kind, {'hits': 0, 'misses': 0, 'stores': 0})
+            stats[what] += 1
+
+    def summary(self):
+        with self.lock:
+            return ", ".join(f"{kind}: {stats['hits']} hits, {stats['misses']} misses, {stats['stores']} stored"
+                             for kind, stats in self.stats.items())
+
+    def lookup(self, kind, key):
+        # Path of the entry of key, None when not cached. The access time
+        # of the entry is its last use, for eviction; its modification
+        # time is left alone, the entry may be the source of another one.
+        if not self.enabled:
+            return None
+        path = self.path(key)
+        try:
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        except OSError:
+            self.count(kind, 'misses')
+            return None
+        self.count(kind, 'hits')
+        return path
+
+    def writer(self, kind, key):
+        # CacheWriter of a new entry, None when the cache cannot be used.
+        if not self.enabled:
+            return None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            return CacheWriter(self, kind, key)
+        except OSError as e:
+            self.logger.warning(f"Cannot use the artifact cache {self.directory}: {e}")
+            return None
+
+    def fetch(self, kind, key, destination):
+        """
+        Put the entry of key at destination, return False when not cached.
+        A destination already holding the entry is left untouched, keeping
+        its modification time. Meant for small generated files.
+        """
+        path = self.lookup(kind, key)
+        if path is None:
+            return False
+        if same_content(path, destination):
+            return True
+        temp = None
+        try:
+            directory = os.path.dirname(os.path.abspath(destination))
+            fd, temp = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+            os.close(fd)
+            shutil.copyfile(path, temp)
+            os.chmod(temp, 0o644)
+            os.replace(temp, destination)
+        except OSError as e:
+            # evicted meanwhile, or destination not writable
+            self.logger.debug(f"Cannot fetch {kind} from the artifact cache: {e}")
+            if temp is not None:
+                self._remove(temp)
+            return False
+        return True
+
+    def store(self, kind, key, source):
+        # Copy the file source into the cache as the entry of key.
+        writer = self.writer(kind, key)
+        if writer is None:
+            return
+        try:
+            with open(source, 'rb') as fp:
+                for data in iter(lambda: fp.read(1024 * 1024), b''):
+                    writer.write(data)
+        except OSError:
+            writer.discard()
+            return
+        writer.commit()
+
+    def load_json(self, kind, key):
+        path = self.lookup(kind, key)
+        if path is None:
+            return None
+        try:
+            with open(path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def store_json(self, kind, key, data):
+        writer = self.writer(kind, key)
+        if writer is not None:
+            writer.write(json.dumps(data).encode())
+            writer.commit()
+
+    def evict(self):
+        # Remove the least recently used entries over max_size, and the
+        # temporary files of interrupted writers.
+        now = time.time()
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    if entry.name.startswith(TEMP_PREFIX):
+                        if now - st.st_mtime > STALE_TEMP_SECONDS:
+                            self._remove(entry.path)
+                        continue
+                    # allocated blocks, decompressed images have holes
+                    entries.append((st.st_atime, getattr(st, 'st_blocks', 0) * 512 or st.st_size, entry.path))
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in entries)
+        for atime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if now - atime < EVICT_GRACE_SECONDS:
+                continue
+            if self._remove(path):
+                total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+artifact_cache = ArtifactCache()
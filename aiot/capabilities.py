@@ -0,0 +1,81 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import logging
+import re
+
+from aiot.fastboot_usb import parse_int
+
+# "(bootloader) name: value" lines of `fastboot getvar all`, the prefix
+# is not there when the INFO packets are read natively
+GETVAR_LINE = re.compile(r"^(?:\(bootloader\)\s+)?(\S+?):\s+(.*?)\s*$")
+
+# Variables reporting the storage and the download agent version,
+# the first one present is used
+STORAGE_VARIABLES = ('storage-type', 'storage')
+VERSION_VARIABLES = ('version-bootloader', 'version')
+
+class DeviceCapabilities:
+    """
+    What a device in fastboot mode reported through getvar, queried with a
+    single getvar:all when its session starts. Values are kept as strings,
+    missing variables read as None.
+    """
+
+    def __init__(self, variables=None):
+        self.logger = logging.getLogger('aiot')
+        self.variables = variables if variables is not None else {}
+
+    @classmethod
+    def parse(cls, lines):
+        variables = {}
+        for line in lines:
+            match = GETVAR_LINE.match(line)
+            if match:
+                variables[match.group(1)] = match.group(2)
+        return cls(variables)
+
+    def _first(self, names):
+        return next((self.variables[name] for name in names if name in self.variables), None)
+
+    def _int(self, name):
+        value = self.variables.get(name)
+        try:
+            return parse_int(value) if value else None
+        except ValueError:
+            return None
+
+    @property
+    def max_download_size(self):
+        return self._int('max-download-size')
+
+    @property
+    def storage(self):
+        return self._first(STORAGE_VARIABLES)
+
+    @property
+    def serialno(self):
+        return self.variables.get('serialno')
+
+    @property
+    def da_version(self):
+        return self._first(VERSION_VARIABLES)
+
+    def partition_size(self, partition):
+        return self._int(f"partition-size:{partition}")
+
+    def validate(self, sizes, storage=None):
+        """
+        Return the reasons why images of sizes, a dict of partition to
+        image size in bytes, cannot be flashed to this device. Only what
+        the device reported is checked.
+        """
+        errors = []
+        if storage and self.storage and storage.lower() not in self.storage.lower():
+            errors.append(f"image is for {storage} storage, device reports {self.storage}")
+        for partition, size in sizes.items():
+            partition_size = self.partition_size(partition)
+            if size is not None and partition_size is not None and size > partition_size:
+                errors.append(f"{partition}: image of {size} bytes larger than the "
+                              f"{partition_size} bytes partition")
+        return errors
@@ -0,0 +1,103 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+from pathlib import Path
+
+import bz2
+import gzip
+import lzma
+
+import zstandard
+
+# Longest zstd frame header, which holds the content size when known
+ZSTD_FRAME_HEADER_MAX = 18
+
+def open_zstd(fp):
+    return zstandard.ZstdDecompressor().stream_reader(fp)
+
+# Supported compressed variants of an image file, in lookup order
+DECOMPRESSORS = {
+    '.zst': open_zstd,
+    '.xz': lambda fp: lzma.LZMAFile(fp),
+    '.gz': lambda fp: gzip.GzipFile(fileobj=fp),
+    '.bz2': lambda fp: bz2.BZ2File(fp),
+}
+
+def is_compressed(path):
+    return Path(path).suffix in DECOMPRESSORS
+
+def decompressed_size(path):
+    # Size of the decompressed content of path when its header tells,
+    # None when unknown. Only zstd frames record it reliably.
+    if Path(path).suffix != '.zst':
+        return None
+    try:
+        with open(path, 'rb') as fp:
+            size = zstandard.frame_content_size(fp.read(ZSTD_FRAME_HEADER_MAX))
+    except (OSError, zstandard.ZstdError):
+        return None
+    return size if size >= 0 else None
+
+def resolve(path):
+    # Return path if it exists, else its first existing compressed variant,
+    # else path unchanged.
+    path = Path(path)
+    if path.exists() or is_compressed(path):
+        return path
+    for suffix in DECOMPRESSORS:
+        compressed = path.with_name(path.name + suffix)
+        if compressed.exists():
+            return compressed
+    return path
+
+def resolve_partitions(path, partitions):
+    # Point the partition files that only exist compressed to their
+    # compressed variant.
+    for partition, filename in partitions.items():
+        if filename:
+            resolved = resolve(Path(path) / filename)
+            if resolved.name != Path(filename).name:
+                partitions[partition] = str(Path(filename).with_name(resolved.name))
+
+class DecompressedFile:
+    """
+    Read-only stream of the decompressed content of a file. tell_compressed()
+    reports how far the compressed input has been consumed, to be used as a
+    progress indicator since the decompressed size is usually unknown.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.fp = open(path, 'rb')
+        self.size = self.path.stat().st_size
+        self.stream = DECOMPRESSORS[self.path.suffix](self.fp)
+
+    def read(self, size):
+        # Read exactly size bytes, unless the end of stream is reached.
+        data = self.stream.read(size)
+        if len(data) == size or not data:
+            return data
+        data = bytearray(data)
+        while len(data) < size:
+            chunk = self.stream.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    def tell_compressed(self):
+        try:
+            return self.fp.tell()
+        except ValueError:
+            # closed, the whole input has been consumed
+            return self.size
+
+    def close(self):
+        self.stream.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
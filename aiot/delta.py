@@ -0,0 +1,240 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import hashlib
+import logging
+import os
+import threading
+import weakref
+
+from aiot.fastboot_usb import COMMAND_TIMEOUT, FastbootError
+from aiot.index import INDEX_CHUNK_SIZE, index_entry_of
+from aiot.sparse import SparseImage
+
+# Size of the blocks compared between the host image and the device
+DELTA_HASH_SIZE = 1024 * 1024
+# Bytes read back from the device per fetch command
+READBACK_SIZE = 16 * 1024 * 1024
+
+# image_digests() of each image, by hash size: the images of image_cache
+# are shared by all the boards, which then only hash them once
+_digests = weakref.WeakKeyDictionary()
+_digests_lock = threading.Lock()
+
+class BlockHasher:
+    # Digest of each hash_size block of the data it is fed.
+
+    def __init__(self, hash_size):
+        self.hash_size = hash_size
+        self.digests = []
+        self.hasher = hashlib.sha256()
+        self.pending = 0
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            take = min(len(data), self.hash_size - self.pending)
+            self.hasher.update(data[:take])
+            self.pending += take
+            data = data[take:]
+            if self.pending == self.hash_size:
+                self.digests.append(self.hasher.digest())
+                self.hasher = hashlib.sha256()
+                self.pending = 0
+
+    def finish(self):
+        if self.pending:
+            self.digests.append(self.hasher.digest())
+            self.hasher = hashlib.sha256()
+            self.pending = 0
+        return self.digests
+
+class ReadbackDevice:
+    """
+    Device digests computed on the host from the partition read back with
+    fetch. Reading is cheaper than writing the eMMC, but still moves the
+    whole partition over USB.
+    """
+
+    def __init__(self, session, timeout=COMMAND_TIMEOUT):
+        self.session = session
+        self.timeout = timeout
+
+    def digests(self, partition, hash_size, size):
+        hasher = BlockHasher(hash_size)
+        for offset in range(0, size, READBACK_SIZE):
+            self.session.fetch(partition, hasher.update, offset, min(READBACK_SIZE, size - offset),
+                               timeout=self.timeout)
+        return hasher.finish()
+
+class OemHashDevice:
+    """
+    Device digests computed by the download agent:
+    `oem hash:<partition>:<offset>:<size>:<hash_size>`, hexadecimal values,
+    answered with one INFO line holding the hex SHA-256 of each block.
+    Download agents without the command fall back to fallback.
+    """
+
+    def __init__(self, session, fallback=None, timeout=COMMAND_TIMEOUT):
+        self.logger = logging.getLogger('aiot')
+        self.session = session
+        self.fallback = fallback
+        self.timeout = timeout
+        self.supported = True
+
+    def digests(self, partition, hash_size, size):
+        if self.supported:
+            lines = []
+            try:
+                self.session.command(f"oem hash:{partition}:{0:x}:{size:x}:{hash_size:x}",
+                                     self.timeout, info_callback=lines.append)
+                return [bytes.fromhex(line.strip()) for line in lines]
+            except (FastbootError, ValueError) as e:
+                if self.fallback is None:
+                    raise
+                self.logger.info(f"oem hash not supported ({e}), reading {partition} back instead")
+                self.supported = False
+        return self.fallback.digests(partition, hash_size, size)
+
+class FakeDevice:
+    """
+    Partitions stored as files of a local directory, to exercise delta
+    flashing without hardware. flash() writes a sparse image the way the
+    device would, leaving DONT_CARE blocks untouched.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, partition):
+        return os.path.join(self.directory, partition)
+
+    def digests(self, partition, hash_size, size):
+        hasher = BlockHasher(hash_size)
+        if not os.path.exists(self._path(partition)):
+            return []
+        with open(self._path(partition), 'rb') as fp:
+            remaining = size
+            while remaining:
+                data = fp.read(min(READBACK_SIZE, remaining))
+                if not data:
+                    # past the end of the file reads as zero
+                    data = bytes(min(READBACK_SIZE, remaining))
+                hasher.update(data)
+                remaining -= len(data)
+        return hasher.finish()
+
+    def fetch(self, partition, sink, offset=0, size=None):
+        with open(self._path(partition), 'rb') as fp:
+            fp.seek(offset)
+            sink(fp.read(size) if size is not None else fp.read())
+
+    def flash(self, partition, image):
+        mode = 'r+b' if os.path.exists(self._path(partition)) else 'w+b'
+        with open(self._path(partition), mode) as fp:
+            for offset, data in image.expand():
+                fp.seek(offset)
+                fp.write(data)
+
+def image_digests(image, hash_size):
+    """
+    Digest of each hash_size block of the image once written, None for
+    the blocks not entirely written by the image, whose device content
+    cannot be compared. Computed once per image, the list must not be
+    modified.
+    """
+    with _digests_lock:
+        digests = _digests.get(image, {}).get(hash_size)
+    if digests is None:
+        digests = hash_image(image, hash_size)
+        with _digests_lock:
+            _digests.setdefault(image, {})[hash_size] = digests
+    return digests
+
+def hash_image(image, hash_size):
+    # image_digests() computed from the image data.
+    size = image.expanded_size()
+    digests = [None] * -(-size // hash_size)
+    hasher = None
+    index = None
+    covered = 0
+
+    for offset, data in image.expand():
+        data = memoryview(data)
+        while data:
+            if offset // hash_size != index:
+                index = offset // hash_size
+                hasher = hashlib.sha256()
+                covered = 0
+            end = min((index + 1) * hash_size, size)
+            take = min(len(data), end - offset)
+            hasher.update(data[:take])
+            data = data[take:]
+            offset += take
+            covered += take
+            if covered == end - index * hash_size:
+                digests[index] = hasher.digest()
+    return digests
+
+def indexed_digests(image, hash_size):
+    """
+    image_digests() taken from the chunk hashes of the image index, None
+    when the image file has none. Only raw files are hashed by chunk, and
+    the image holds their content wherever its chunks cover it.
+    """
+    entry = index_entry_of(image.path) if image.path else None
+    if (entry is None or 'chunks' not in entry or hash_size != INDEX_CHUNK_SIZE or
+            image.sparse or entry['size'] != image.expanded_size()):
+        return None
+
+    blocks_per_hash = hash_size // image.block_size
+    covered = [0] * len(entry['chunks'])
+    for chunk in image.chunks:
+        block = chunk.block
+        while block < chunk.block + chunk.blocks:
+            index = block // blocks_per_hash
+            blocks = min(chunk.block + chunk.blocks, (index + 1) * blocks_per_hash) - block
+            covered[index] += blocks
+            block += blocks
+
+    digests = []
+    for index, digest in enumerate(entry['chunks']):
+        blocks = min(blocks_per_hash, image.total_blocks - index * blocks_per_hash)
+        digests.append(bytes.fromhex(digest) if covered[index] == blocks else None)
+    return digests
+
+def delta_image(image, partition, device, hash_size=DELTA_HASH_SIZE):
+    """
+    Restrict image to the hash_size blocks whose content differs on
+    device, or that cannot be compared. The result covers the same blocks
+    as image, anything already correct becomes DONT_CARE.
+    """
+    logger = logging.getLogger('aiot')
+    if hash_size % image.block_size:
+        raise ValueError(f"hash size {hash_size} not a multiple of block size {image.block_size}")
+
+    host = indexed_digests(image, hash_size)
+    if host is None:
+        host = image_digests(image, hash_size)
+    remote = device.digests(partition, hash_size, image.expanded_size())
+    changed = [digest is None or index >= len(remote) or remote[index] != digest
+               for index, digest in enumerate(host)]
+
+    blocks_per_hash = hash_size // image.block_size
+    chunks = []
+    for chunk in image.chunks:
+        pending = chunk
+        while pending:
+            index = pending.block // blocks_per_hash
+            blocks = min(pending.blocks, (index + 1) * blocks_per_hash - pending.block)
+            if blocks < pending.blocks:
+                head, pending = pending.split(blocks, image.block_size)
+            else:
+                head, pending = pending, None
+            if changed[index]:
+                chunks.append(head)
+
+    delta = SparseImage(image.path, image.block_size, image.total_blocks, chunks)
+    logger.info(f"{partition}: delta of {delta.sparse_size()} bytes to send instead of "
+                f"{image.sparse_size()}, {changed.count(False)} blocks of {hash_size} bytes unchanged")
+    return delta
@@ -0,0 +1,214 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import logging
+import platform
+import threading
+import time
+
+if platform.system() == 'Linux':
+    import pyudev
+
+# USB IDs of the download agent once it runs fastboot, see config.py udev rules
+FASTBOOT_VENDOR_ID = '0e8d'
+FASTBOOT_PRODUCT_ID = '201c'
+# USB IDs of the boot ROM of a board in download mode
+BOOTROM_VENDOR_ID = '0e8d'
+BOOTROM_PRODUCT_ID = '0003'
+
+def on_port(path, port):
+    # Whether the USB device at topology path is on port, or behind a hub
+    # on port. Any path is on port None.
+    return port is None or (path is not None and (path == port or path.startswith(port + '.')))
+
+def usb_path(device):
+    # USB topology path of a pyusb device, as udev names it (e.g. 1-2.3).
+    ports = getattr(device, 'port_numbers', None)
+    if not ports:
+        return None
+    return f"{device.bus}-{'.'.join(str(port) for port in ports)}"
+
+def tty_port(com_port):
+    # USB topology path of the device behind serial port com_port, such as
+    # the boot ROM a bootrom tool opened. None when unknown.
+    if platform.system() != 'Linux' or not com_port:
+        return None
+    try:
+        device = pyudev.Devices.from_device_file(pyudev.Context(), com_port)
+    except (OSError, ValueError, pyudev.DeviceNotFoundError):
+        return None
+    usb_device = device.find_parent('usb', 'usb_device')
+    return usb_device.sys_name if usb_device is not None else None
+
+class FastbootDevice:
+    # A connected fastboot device, port is the USB topology path (e.g. 1-2.3).
+    __slots__ = ('serial', 'port', 'added')
+
+    def __init__(self, serial, port, added):
+        self.serial = serial
+        self.port = port
+        self.added = added
+
+    def on_port(self, port):
+        # Whether the device is connected on port, or behind a hub on port.
+        return on_port(self.port, port)
+
+    def __repr__(self):
+        return f"FastbootDevice(serial={self.serial}, port={self.port})"
+
+class DeviceRegistry:
+    """
+    Fastboot devices currently connected, kept up to date by udev events.
+
+    The registry is shared by all the flash workers of a process: lookups
+    only read its state, and waiting for a new device blocks on a condition
+    notified by the udev monitor thread instead of polling `fastboot devices`.
+    Boards entering and leaving download mode are reported to the
+    watch_bootrom() callbacks. On systems without udev, available is False and callers fall
+    back to polling.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('aiot')
+        self.condition = threading.Condition()
+        self.devices = {}
+        # ports of the boot ROM devices, by sys_path
+        self.bootroms = {}
+        self.bootrom_callbacks = []
+        self.bootrom_remove_callbacks = []
+        self.observer = None
+        self.available = platform.system() == 'Linux'
+
+    def start(self):
+        # Start monitoring on first use, return whether the registry is usable.
+        with self.condition:
+            if self.observer is not None or not self.available:
+                return self.available
+            try:
+                context = pyudev.Context()
+                monitor = pyudev.Monitor.from_netlink(context)
+                monitor.filter_by(subsystem='usb', device_type='usb_device')
+                self.observer = pyudev.MonitorObserver(monitor, callback=self._handle_event,
+                                                       name='fastboot-devices', daemon=True)
+                self.observer.start()
+                # enumerate after the monitor is running so no device is missed
+                for device in context.list_devices(subsystem='usb', DEVTYPE='usb_device'):
+                    self._add(device)
+            except (OSError, pyudev.DeviceNotFoundError) as e:
+                self.logger.debug(f"udev monitoring unavailable: {e}")
+                self.available = False
+                self.observer = None
+            return self.available
+
+    def stop(self):
+        with self.condition:
+            if self.observer is not None:
+                self.observer.send_stop()
+                self.observer = None
+                self.devices.clear()
+                self.bootroms.clear()
+
+    @staticmethod
+    def is_fastboot(device):
+        return (device.get('ID_VENDOR_ID') == FASTBOOT_VENDOR_ID and
+                device.get('ID_MODEL_ID') == FASTBOOT_PRODUCT_ID)
+
+    @staticmethod
+    def is_bootrom(device):
+        return (device.get('ID_VENDOR_ID') == BOOTROM_VENDOR_ID and
+                device.get('ID_MODEL_ID') == BOOTROM_PRODUCT_ID)
+
+    def _add(self, device):
+        # Record a device, return the port of a new boot ROM device.
+        if self.is_bootrom(device) and device.sys_path not in self.bootroms:
+            self.bootroms[device.sys_path] = device.sys_name
+            self.logger.debug(f"boot ROM device added on port {device.sys_name}")
+            return device.sys_name
+        if not self.is_fastboot(device) or device.sys_path in self.devices:
+            return None
+        serial = device.get('ID_SERIAL_SHORT')
+        if not serial:
+            return None
+        self.devices[device.sys_path] = FastbootDevice(serial, device.sys_name, time.monotonic())
+        self.logger.debug(f"fastboot device {serial} added on port {device.sys_name}")
+        return None
+
+    def _handle_event(self, device):
+        # Called from the udev monitor thread.
+        bootrom = None
+        left = None
+        with self.condition:
+            if device.action == 'add':
+                bootrom = self._add(device)
+            elif device.action == 'remove':
+                left = self.bootroms.pop(device.sys_path, None)
+                removed = self.devices.pop(device.sys_path, None)
+                if removed:
+                    self.logger.debug(f"fastboot device {removed.serial} removed from port {removed.port}")
+            self.condition.notify_all()
+            callbacks = list(self.bootrom_callbacks)
+            remove_callbacks = list(self.bootrom_remove_callbacks)
+        if bootrom:
+            for callback in callbacks:
+                callback(bootrom)
+        if left:
+            for callback in remove_callbacks:
+                callback(left)
+
+    def watch_bootrom(self, callback, removed=None):
+        """
+        Call callback with the USB port of each board entering download
+        mode, first of the ones already in it, and removed with the port of
+        each one leaving it. Callbacks run in the udev monitor thread and
+        must not block. Return False without udev.
+        """
+        if not self.start():
+            return False
+        with self.condition:
+            self.bootrom_callbacks.append(callback)
+            if removed is not None:
+                self.bootrom_remove_callbacks.append(removed)
+            ports = list(self.bootroms.values())
+        for port in ports:
+            callback(port)
+        return True
+
+    def in_bootrom(self, port):
+        # Whether a board on USB port is in download mode.
+        with self.condition:
+            return port in self.bootroms.values()
+
+    def list(self, port=None):
+        # Connected fastboot devices, oldest first.
+        with self.condition:
+            return sorted((d for d in self.devices.values() if d.on_port(port)),
+                          key=lambda d: d.added)
+
+    def serials(self):
+        return [device.serial for device in self.list()]
+
+    def claim(self, assigned, port=None, timeout=0):
+        """
+        Return the oldest device on port whose serial is not in assigned,
+        and add its serial to assigned, waiting up to timeout seconds for
+        one to appear. Return None on timeout.
+
+        assigned is only updated under the registry lock, so concurrent
+        callers sharing it never get the same device.
+        """
+        def find():
+            return next((d for d in self.list(port) if d.serial not in assigned), None)
+
+        with self.condition:
+            device = self.condition.wait_for(find, timeout)
+            if device is None:
+                return None
+            others = [d.serial for d in self.list(port) if d.serial not in assigned and d is not device]
+            if others:
+                self.logger.warning(f"More than one new fastboot device: {[device.serial] + others}, "
+                                    f"assigning {device.serial}")
+            assigned.add(device.serial)
+            return device
+
+# Registry shared by all the fastboot clients of the process
+device_registry = DeviceRegistry()
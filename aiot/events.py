@@ -0,0 +1,68 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import json
+
+class Event:
+    """
+    Base of the events passed between Fastboot, Flash, the workers and the
+    daemon. Fields left to None are absent; JSON is only produced by
+    to_json(), when an event leaves the process.
+    """
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError(f"{type(self).__name__}: unknown fields {', '.join(fields)}")
+
+    @classmethod
+    def from_dict(cls, data):
+        # Build an event from a parser dict, ignoring the unknown keys.
+        return cls(**{key: value for key, value in data.items() if key in cls.__slots__})
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=4)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f"{key}={value!r}" for key, value in self.to_dict().items())
+        return f"{type(self).__name__}({fields})"
+
+class BootromEvent(Event):
+    # Progress of the bootstrap, and of the board control before it.
+    # usb_port is the USB topology path of the board opened.
+    __slots__ = ('action', 'com_port', 'baudrate', 'hw_code', 'address', 'mode', 'error', 'usb_port')
+
+class FastbootEvent(Event):
+    # Progress of a fastboot command, as parsed from the fastboot output
+    # or reported by the native client.
+    __slots__ = ('action', 'partition', 'type', 'status', 'error', 'duration', 'total_duration',
+                 'progress', 'size', 'unit', 'segment', 'fastboot_sn')
+
+class DeviceEvent(Event):
+    # What a fastboot device reported through getvar when flashing starts.
+    __slots__ = ('fastboot_sn', 'storage', 'da_version', 'max_download_size')
+
+class TimeoutEvent(Event):
+    # A stage exceeded its deadline or inactivity limit.
+    __slots__ = ('action', 'error', 'timeout', 'stage', 'partition')
+
+class VerifyEvent(Event):
+    # Readback verification of a flashed partition, or with verify set,
+    # the outcome of the verification of the board: OKAY, FAIL or SKIPPED.
+    __slots__ = ('action', 'partition', 'status', 'error', 'blocks', 'mismatches', 'duration', 'verify')
+
+class WorkerStatus(Event):
+    # Status of a daemon worker, as served to the clients. boards and
+    # failures count the boards the worker flashed and failed to flash,
+    # average_duration is the mean duration of the flashed ones.
+    __slots__ = ('id', 'action', 'error', 'com_port', 'usb_port', 'fastboot_sn', 'progress', 'duration',
+                 'storage', 'da_version', 'verify', 'boards', 'failures', 'average_duration')
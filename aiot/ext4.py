@@ -0,0 +1,181 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import logging
+import struct
+
+# On-disk format, see Documentation/filesystems/ext4/ in the Linux kernel
+SUPERBLOCK_OFFSET = 1024
+SUPERBLOCK_SIZE = 1024
+EXT4_MAGIC = 0xef53
+
+COMPAT_SPARSE_SUPER2 = 0x200
+INCOMPAT_META_BG = 0x10
+INCOMPAT_64BIT = 0x80
+RO_COMPAT_SPARSE_SUPER = 0x1
+RO_COMPAT_GDT_CSUM = 0x10
+RO_COMPAT_BIGALLOC = 0x200
+RO_COMPAT_METADATA_CSUM = 0x400
+
+BG_BLOCK_UNINIT = 0x2
+
+class Ext4Image:
+    """
+    Read-only view of an ext4 filesystem stored at `offset` in fp, used to
+    tell which blocks hold data. Only the superblock, the group descriptors
+    and the block bitmaps are read.
+    """
+
+    def __init__(self, fp, offset=0):
+        self.logger = logging.getLogger('aiot')
+        self.fp = fp
+        self.offset = offset
+
+        sb = self._read(SUPERBLOCK_OFFSET, SUPERBLOCK_SIZE)
+        (self.blocks_count_lo, ) = struct.unpack_from("<I", sb, 0x4)
+        (self.first_data_block, log_block_size) = struct.unpack_from("<II", sb, 0x14)
+        (self.blocks_per_group, ) = struct.unpack_from("<I", sb, 0x20)
+        (self.inodes_per_group, ) = struct.unpack_from("<I", sb, 0x28)
+        (self.inode_size, ) = struct.unpack_from("<H", sb, 0x58)
+        (self.feature_compat, self.feature_incompat,
+         self.feature_ro_compat) = struct.unpack_from("<III", sb, 0x5c)
+        (self.reserved_gdt_blocks, ) = struct.unpack_from("<H", sb, 0xce)
+        (desc_size, ) = struct.unpack_from("<H", sb, 0xfe)
+        (blocks_count_hi, ) = struct.unpack_from("<I", sb, 0x150)
+        self.backup_bgs = struct.unpack_from("<II", sb, 0x24c)
+
+        self.block_size = 1024 << log_block_size
+        self.is_64bit = bool(self.feature_incompat & INCOMPAT_64BIT)
+        self.blocks_count = self.blocks_count_lo
+        self.desc_size = 32
+        if self.is_64bit:
+            self.blocks_count |= blocks_count_hi << 32
+            self.desc_size = desc_size
+        self.group_count = (self.blocks_count - self.first_data_block +
+                            self.blocks_per_group - 1) // self.blocks_per_group
+        self.gdt_blocks = (self.group_count * self.desc_size + self.block_size - 1) // self.block_size
+
+    @classmethod
+    def probe(cls, fp, offset=0):
+        # Whether an ext2/3/4 superblock is found at offset.
+        fp.seek(offset + SUPERBLOCK_OFFSET + 0x38)
+        data = fp.read(2)
+        return len(data) == 2 and struct.unpack("<H", data)[0] == EXT4_MAGIC
+
+    def _read(self, offset, size):
+        self.fp.seek(self.offset + offset)
+        data = self.fp.read(size)
+        if len(data) < size:
+            raise ValueError("ext4: truncated filesystem image")
+        return data
+
+    def is_supported(self):
+        if self.feature_ro_compat & RO_COMPAT_BIGALLOC:
+            self.logger.debug("ext4: bigalloc bitmaps are not supported")
+            return False
+        if self.feature_incompat & INCOMPAT_META_BG:
+            self.logger.debug("ext4: meta_bg group descriptors are not supported")
+            return False
+        return self.blocks_per_group > 0 and self.desc_size >= 32
+
+    def group_descriptors(self):
+        # Yield (block_bitmap, inode_bitmap, inode_table, flags) of every group.
+        gdt = self._read((self.first_data_block + 1) * self.block_size,
+                         self.group_count * self.desc_size)
+        for group in range(self.group_count):
+            desc = gdt[group * self.desc_size:(group + 1) * self.desc_size]
+            block_bitmap, inode_bitmap, inode_table = struct.unpack_from("<III", desc, 0x0)
+            (flags, ) = struct.unpack_from("<H", desc, 0x12)
+            if self.is_64bit and self.desc_size >= 64:
+                hi = struct.unpack_from("<III", desc, 0x20)
+                block_bitmap |= hi[0] << 32
+                inode_bitmap |= hi[1] << 32
+                inode_table |= hi[2] << 32
+            yield block_bitmap, inode_bitmap, inode_table, flags
+
+    def has_super(self, group):
+        # Whether the group holds a backup of the superblock and descriptors.
+        if group == 0:
+            return True
+        if self.feature_compat & COMPAT_SPARSE_SUPER2:
+            return group in self.backup_bgs
+        if group == 1 or not self.feature_ro_compat & RO_COMPAT_SPARSE_SUPER:
+            return True
+        for base in (3, 5, 7):
+            n = base
+            while n < group:
+                n *= base
+            if n == group:
+                return True
+        return False
+
+    def group_start(self, group):
+        return self.first_data_block + group * self.blocks_per_group
+
+    def group_blocks(self, group):
+        return min(self.blocks_per_group, self.blocks_count - self.group_start(group))
+
+    def allocated_blocks(self):
+        """
+        Return the sorted list of (first block, block count) runs in use.
+
+        Groups flagged BLOCK_UNINIT have no initialized bitmap; like
+        e2fsprogs, their used blocks are the superblock backup and
+        descriptor copies, plus any bitmap or inode table placed there.
+        """
+        uninit_bg = self.feature_ro_compat & (RO_COMPAT_GDT_CSUM | RO_COMPAT_METADATA_CSUM)
+        inode_table_blocks = (self.inodes_per_group * self.inode_size +
+                              self.block_size - 1) // self.block_size
+        descriptors = list(self.group_descriptors())
+
+        # metadata blocks, for groups without a bitmap
+        metadata = []
+        for block_bitmap, inode_bitmap, inode_table, _ in descriptors:
+            metadata += [(block_bitmap, 1), (inode_bitmap, 1), (inode_table, inode_table_blocks)]
+
+        runs = []
+        def add(block, count):
+            if runs and runs[-1][0] + runs[-1][1] >= block:
+                end = max(runs[-1][0] + runs[-1][1], block + count)
+                runs[-1] = (runs[-1][0], end - runs[-1][0])
+            else:
+                runs.append((block, count))
+
+        if self.first_data_block:
+            # the boot block of 1 KiB block filesystems
+            add(0, self.first_data_block)
+
+        for group, (block_bitmap, _, _, flags) in enumerate(descriptors):
+            start = self.group_start(group)
+            count = self.group_blocks(group)
+
+            if uninit_bg and flags & BG_BLOCK_UNINIT:
+                used = []
+                if self.has_super(group):
+                    used.append((start, 1 + self.gdt_blocks + self.reserved_gdt_blocks))
+                for block, length in metadata:
+                    if start <= block < start + count:
+                        used.append((block, length))
+                for block, length in sorted(used):
+                    add(block, length)
+                continue
+
+            bitmap = self._read(block_bitmap * self.block_size, (count + 7) // 8)
+            bits = int.from_bytes(bitmap, 'little') & ((1 << count) - 1)
+            bit = 0
+            while bits >> bit:
+                # skip the free blocks, then take the run of used ones
+                rest = bits >> bit
+                bit += (rest & -rest).bit_length() - 1
+                rest = ~(bits >> bit)
+                length = (rest & -rest).bit_length() - 1
+                add(start + bit, length)
+                bit += length
+
+        return runs
+
+    def allocated_ranges(self):
+        # Return the (byte offset, byte length) ranges in use, relative to
+        # the start of the filesystem.
+        return [(block * self.block_size, count * self.block_size)
+                for block, count in self.allocated_blocks()]
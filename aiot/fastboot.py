@@ -3,162 +3,374 @@
 # Author: Fabien Parent <fparent@baylibre.com>
 # Author: Macpaul Lin <macpaul.lin@mediatek.com>
 
-import json
 import logging
-import subprocess
+import os
+import re
 import threading
 import sys
 import time
 from fastboot_log_parser import FlashLogParser
 
+from aiot.capabilities import DeviceCapabilities
+from aiot.delta import OemHashDevice, ReadbackDevice
+from aiot.devices import device_registry, usb_path
+from aiot.events import FastbootEvent
+from aiot.fastboot_usb import BULK_TRANSFER_SIZE, FastbootError, FastbootUsbDevice, parse_int
+from aiot.sparse import SparseImage, SparseStream
+from aiot.timeout import SupervisedProcess, Timeouts, print_line, timeout_event
+
+def read_file(filename):
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(BULK_TRANSFER_SIZE), b''):
+            yield chunk
+
 class Fastboot:
-    def __init__(self, dry_run=False, daemon=False):
+    def __init__(self, dry_run=False, daemon=False, native=False, timeouts=None):
         self.dry_run = dry_run
         self.daemon = daemon
+        self.native = native
+        self.timeouts = timeouts if timeouts is not None else Timeouts()
         self.bin = 'fastboot'
         self.parser = FlashLogParser()
+        # Claimed USB sessions of the native client, keyed by serial
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.max_download_sizes = {}
+        # DeviceCapabilities of the devices, keyed by serial
+        self.device_capabilities = {}
+        # sources of the device block digests for delta flashing, keyed by serial
+        self.delta_devices = {}
+
+    def _session(self, fastboot_sn=None):
+        # Return the native USB session of a device, opening it on first use.
+        with self.sessions_lock:
+            session = self.sessions.get(fastboot_sn)
+            if session is None:
+                session = FastbootUsbDevice.open(fastboot_sn)
+                self.sessions[fastboot_sn] = session
+            return session
+
+    def close(self):
+        # Release all the USB sessions opened by the native client.
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+    def _native_command(self, action, partition, fn):
+        # Run a native command and describe it with an event shaped like
+        # the ones the fastboot log parser produces for the fastboot binary.
+        event = FastbootEvent(action=action, partition=partition)
+        start = time.time()
+        try:
+            fn()
+            event.status = "OKAY"
+        except FastbootError as e:
+            event.status = "FAIL"
+            event.error = str(e)
+        duration = time.time() - start
+        event.duration = f"{duration:.3f}s"
 
-    def _run_command(self, command):
-        # Helper method to run a fastboot command.
+        if not self.daemon:
+            label = f"{action.capitalize()} '{partition}'" if partition else action.capitalize()
+            print(f"{label:<50} {event.status} [{duration:7.3f}s]", flush=True)
+            if event.error is not None:
+                print(f"fastboot: error: {event.error}", flush=True)
+        return event
+
+    def _native_result(self, event):
+        # Daemon callers expect an event, the others a return code.
+        if self.daemon:
+            return event
+        return 0 if event.status == "OKAY" else 1
+
+    def _parse(self, output):
+        # Parse fastboot output into the event it leads to. The parser
+        # history is never used, do not let it grow for every line.
+        self.parser.parse_log(output)
+        self.parser.event_history.clear()
+        return FastbootEvent.from_dict(self.parser.event)
+
+    def _run_command(self, command, stage='command'):
+        # Helper method to run a fastboot command under the limits of stage.
         if self.dry_run:
             return None
 
         if self.daemon:
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, universal_newlines=True)
-            stdout, _ = process.communicate()
-            self.parser.parse_log(stdout)
-            return self.parser.get_event_as_json()
+            child = SupervisedProcess(command, self.timeouts.deadline(stage), self.timeouts.inactivity(stage))
+            child.run()
+            if child.timed_out:
+                return timeout_event(stage, child.timed_out, child.limit())
+            output = child.stdout()
+            event = self._parse(output)
+            if child.process.returncode:
+                # the failure is not always on a line the parser knows
+                event.status = "FAIL"
+                event.error = event.error or (output.strip().splitlines() or [""])[-1]
+            return event
         else:
             try:
-                p = subprocess.Popen(
-                        command,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,  # merge STDERR into STDOUT
-                        shell=False,               # we need cmd parsing
-                        text=True,                 # decode stdout to string
-                    )
-
-                # Poll process STDOUT and print immediately
-                while True:
-                    output = p.stdout.readline().rstrip()
-                    if output == '' and p.poll() is not None:
-                        break
-                    if output:
-                        print(output, flush=True)
-
-                retcode = p.poll()
+                child = SupervisedProcess(command, self.timeouts.deadline(stage), self.timeouts.inactivity(stage),
+                                          on_line=print_line)
+                retcode = child.run()
+                if child.timed_out:
+                    logging.getLogger('aiot').error(timeout_event(stage, child.timed_out, child.limit()).error)
                 return retcode
             except KeyboardInterrupt:
                 sys.exit(1)
 
     def devices(self):
         # List connected fastboot devices.
+        return [serial for serial, _ in self.device_ports()]
+
+    def device_ports(self):
+        # List (serial, USB topology path) of the connected fastboot
+        # devices, the path is None when unknown.
         if self.dry_run:
             return []
 
-        # Wait while the OS enumerates new fastboot devices; this takes about 2 seconds.
+        # Devices tracked from udev events, no need to spawn fastboot
+        if device_registry.start():
+            return [(device.serial, device.port) for device in device_registry.list()]
+
+        if self.native:
+            try:
+                return [(sn, usb_path(dev)) for sn, dev in FastbootUsbDevice.list_devices() if sn]
+            except FastbootError as e:
+                logging.getLogger('aiot').error(str(e))
+                return []
+
+        # Without udev, wait while the OS enumerates new fastboot devices; this takes about 2 seconds.
         time.sleep(2)
-        process = subprocess.Popen([self.bin, "devices"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, universal_newlines=True)
-        stdout, _ = process.communicate()
-        devices = stdout.strip().split('\n')
-        return [line.split()[0] for line in devices if 'fastboot' in line]
+        child = SupervisedProcess([self.bin, "devices", "-l"], self.timeouts.deadline('command'))
+        child.run()
+        devices = []
+        for line in child.stdout().strip().split('\n'):
+            if 'fastboot' in line:
+                fields = line.split()
+                path = next((field[len('usb:'):] for field in fields if field.startswith('usb:')), None)
+                devices.append((fields[0], path))
+        return devices
+
+    @staticmethod
+    def file_argument(partition, filename):
+        # The file the fastboot binary flashes to partition. Sparse images
+        # and streams, such as a delta or a decompressing image, only have
+        # their data in memory and are only sent by the native client.
+        if isinstance(filename, (SparseImage, SparseStream)):
+            raise FastbootError(f"Flashing {partition} from a {type(filename).__name__} "
+                                "requires --fastboot-usb")
+        return filename
 
     def flash(self, partition, filename, callback=None, fastboot_sn=None):
         # Flash a partition with a specified file.
         if self.dry_run:
             return
 
-        logger = logging.getLogger('aiot')
+        if self.native:
+            return self._flash_native(partition, filename, callback, fastboot_sn)
+        filename = self.file_argument(partition, filename)
+
         command = [self.bin]
         if fastboot_sn:
             command += ["-s", fastboot_sn]
         command += ["flash", partition, filename]
 
         if self.daemon:
-            stdout = ''
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, universal_newlines=True)
-            last_output_time = time.time()
-            timeout_sec = 30
-            watchdog_started = False
-
-            def watchdog_fn():
-                nonlocal last_output_time
-                while process.poll() is None:
-                    if time.time() - last_output_time > timeout_sec:
-                        logger.error(f"[Fastboot] No output from fastboot for {timeout_sec} seconds, triggering callback for timeout.")
-                        if callback:
-                            callback('{"action": "Error", "error": "fastboot no output timeout"}')
-                        break
-
-            def handle_fastboot_noresp_error(json_output):
-                nonlocal last_output_time, watchdog_started
-                import json
-                json_obj = json.loads(json_output)
-                if (
-                    json_obj
-                    and json_obj.get('action') == 'writing'
-                    and json_obj.get('status') == 'OKAY'
-                    and str(json_obj.get('partition', '')).startswith('mmc')
-                ):
-                    last_output_time = time.time()
-                    if not watchdog_started:
-                        watchdog_thread = threading.Thread(
-                            target=watchdog_fn,
-                            daemon=True
-                        )
-                        watchdog_thread.start()
-                        watchdog_started = True
-
-            # Thread to read process.stdout lines
-            def reader_thread_fn():
-                for output in iter(process.stdout.readline, ''):
-                    if output == '' and process.poll() is not None:
-                        break
-                    if output:
-                        line = output.strip() + "\n"
-                        self.parser.parse_log(line)
-                        json_output = self.parser.get_event_as_json()
-                        if callback:
-                            callback(json_output)
-                        handle_fastboot_noresp_error(json_output)
-                process.stdout.close()
-
-            reader_thread = threading.Thread(
-                target=reader_thread_fn,
-                daemon=True
-            )
-            reader_thread.start()
-
-            # Wait for process to finish and reader thread to complete
-            process.wait()
-            reader_thread.join()
+            def parse_line(line):
+                event = self._parse(line.strip() + "\n")
+                if callback:
+                    callback(event)
+
+            child = SupervisedProcess(command, self.timeouts.deadline('partition'),
+                                      self.timeouts.inactivity('partition'), on_line=parse_line)
+            child.run()
+            if not callback:
+                return
+            if child.timed_out:
+                callback(timeout_event('partition', child.timed_out, child.limit(), partition))
+            elif child.process.returncode:
+                # the failure is not always on a line the parser knows
+                lines = child.stdout().strip().splitlines()
+                callback(FastbootEvent(action="writing", partition=partition, status="FAIL",
+                                       error=lines[-1] if lines else f"fastboot exited with {child.process.returncode}"))
         else:
-            self._run_command(command)
+            return self._run_command(command, 'partition')
+
+    def _flash_native(self, partition, filename, callback=None, fastboot_sn=None):
+        # Upload an image with the native USB client then write it. filename
+        # may also be a SparseImage already describing the data to send.
+        # Images larger than the device download buffer are split into
+        # sparse segments, streamed from the source file. A SparseStream
+        # is decompressed and uploaded segment by segment.
+        last_percent = -1
+
+        def report(event):
+            if callback:
+                callback(event)
+
+        def report_progress(ratio):
+            nonlocal last_percent
+            percent = int(ratio * 100)
+            if percent != last_percent:
+                last_percent = percent
+                report(FastbootEvent(action="sending", partition=partition,
+                                     progress=f"{ratio * 100:.2f}%"))
+
+        def send(size, chunks, offset, total):
+            def progress(sent, _):
+                report_progress((offset + sent) / total)
+            self._session(fastboot_sn).download(size, chunks, progress, self.timeouts.deadline('partition'))
+
+        def upload_stream(session, stream, max_size):
+            for i, segment in enumerate(stream.segments(max_size), start=1):
+                segment_size = segment.sparse_size()
+                report(FastbootEvent(action="sending", type="sparse", partition=partition,
+                                     segment=str(i), size=str(segment_size // 1024), unit="KB"))
+                session.download(segment_size, segment.stream(),
+                                 lambda sent, size: report_progress(stream.progress()),
+                                 self.timeouts.deadline('partition'))
+                session.flash(partition, self.timeouts.deadline('partition'))
+
+        def upload():
+            session = self._session(fastboot_sn)
+            max_size = session.max_download_size
+            if isinstance(filename, SparseStream):
+                upload_stream(session, filename, max_size)
+                return
+            if isinstance(filename, SparseImage):
+                image = filename
+            else:
+                image = SparseImage.from_file(filename)
+            size = os.path.getsize(image.path)
+
+            if image.is_plain() and size <= max_size:
+                report(FastbootEvent(action="sending", partition=partition,
+                                     size=str(size // 1024), unit="KB"))
+                send(size, read_file(image.path), 0, size)
+                session.flash(partition, self.timeouts.deadline('partition'))
+                return
+
+            segments = image.split(max_size)
+            total = sum(segment.sparse_size() for segment in segments)
+            offset = 0
+            for i, segment in enumerate(segments, start=1):
+                segment_size = segment.sparse_size()
+                report(FastbootEvent(action="sending", type="sparse", partition=partition,
+                                     segment=f"{i}/{len(segments)}",
+                                     size=str(segment_size // 1024), unit="KB"))
+                send(segment_size, segment.stream(), offset, total)
+                offset += segment_size
+                session.flash(partition, self.timeouts.deadline('partition'))
+
+        event = self._native_command("writing", partition, upload)
+
+        if self.daemon:
+            report(event)
+            return
+        return self._native_result(event)
+
+    def max_download_size(self, fastboot_sn=None):
+        # Size of the device download buffer, queried once per device.
+        if self.native:
+            return self._session(fastboot_sn).max_download_size
+
+        if fastboot_sn in self.device_capabilities:
+            size = self.device_capabilities[fastboot_sn].max_download_size
+            if size:
+                return size
+
+        if fastboot_sn not in self.max_download_sizes:
+            command = [self.bin]
+            if fastboot_sn:
+                command += ["-s", fastboot_sn]
+            command += ["getvar", "max-download-size"]
+            child = SupervisedProcess(command, self.timeouts.deadline('command'))
+            child.run()
+            match = re.search(r"max-download-size:\s*(\S+)", child.stdout())
+            self.max_download_sizes[fastboot_sn] = parse_int(match.group(1)) if match else None
+        return self.max_download_sizes[fastboot_sn]
+
+    def capabilities(self, fastboot_sn=None):
+        # Variables of the device, queried with a single getvar:all the
+        # first time, then served from the cache.
+        if self.dry_run:
+            return DeviceCapabilities()
+
+        if fastboot_sn not in self.device_capabilities:
+            if self.native:
+                try:
+                    lines = self._session(fastboot_sn).getvar_all(self.timeouts.deadline('command'))
+                except FastbootError as e:
+                    logging.getLogger('aiot').warning(f"getvar all failed: {e}")
+                    lines = []
+            else:
+                command = [self.bin]
+                if fastboot_sn:
+                    command += ["-s", fastboot_sn]
+                command += ["getvar", "all"]
+                child = SupervisedProcess(command, self.timeouts.deadline('command'))
+                child.run()
+                lines = child.stdout().splitlines()
+            self.device_capabilities[fastboot_sn] = DeviceCapabilities.parse(lines)
+        return self.device_capabilities[fastboot_sn]
+
+    def delta_device(self, fastboot_sn=None):
+        # Where delta flashing gets the digests of the device contents:
+        # computed by the DA when it can, else read back by the host.
+        if fastboot_sn not in self.delta_devices:
+            session = self._session(fastboot_sn)
+            # hashing or reading back a partition takes as long as flashing it
+            timeout = self.timeouts.deadline('partition')
+            self.delta_devices[fastboot_sn] = OemHashDevice(session, fallback=ReadbackDevice(session, timeout),
+                                                            timeout=timeout)
+        return self.delta_devices[fastboot_sn]
+
+    def readback_device(self, fastboot_sn=None):
+        # What partitions are read back from, with fetch(partition, sink,
+        # offset, size) streaming the data to sink.
+        return self._session(fastboot_sn)
 
     def fetch(self, partition, filename):
         # Fetch a partition to a specified file.
         print(f"Fetching {partition} to {filename}")
-        self._run_command([self.bin, "fetch", partition, filename])
+        if self.native:
+            with open(filename, 'wb') as fp:
+                return self._native_result(self._native_command("fetching", partition,
+                    lambda: self._session().fetch(partition, fp.write,
+                                                  timeout=self.timeouts.deadline('partition'))))
+        self._run_command([self.bin, "fetch", partition, filename], 'partition')
 
     def erase(self, partition, fastboot_sn=None):
         # Erase a specified partition.
+        if self.native and not self.dry_run:
+            return self._native_result(self._native_command("erasing", partition,
+                lambda: self._session(fastboot_sn).erase(partition, self.timeouts.deadline('erase'))))
+
         command = [self.bin]
         if fastboot_sn:
             command += ["-s", fastboot_sn]
         command += ["erase", partition]
-        return self._run_command(command)
+        return self._run_command(command, 'erase')
 
     def reboot(self, fastboot_sn=None):
         if self.dry_run:
             return
 
         # Reboot the device.
+        if self.native:
+            return self._native_result(self._native_command("rebooting", None,
+                lambda: self._session(fastboot_sn).reboot(self.timeouts.deadline('reboot'))))
+
         command = [self.bin]
         if fastboot_sn:
             command += ["-s", fastboot_sn]
         command += ["reboot"]
-        return self._run_command(command)
+        return self._run_command(command, 'reboot')
 
     def write_rpmb_key(self):
         # Write the RPMB key.
+        if self.native:
+            return self._native_result(self._native_command("writing", "rpmb_key",
+                lambda: self._session().oem("rpmb_key", self.timeouts.deadline('command'))))
         self._run_command([self.bin, "oem", "rpmb_key"])
\ No newline at end of file
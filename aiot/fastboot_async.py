@@ -0,0 +1,205 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import asyncio
+import logging
+from fastboot_log_parser import FlashLogParser
+
+from aiot.devices import device_registry
+from aiot.events import FastbootEvent
+from aiot.fastboot import Fastboot
+from aiot.timeout import TERMINATE_GRACE, Timeouts, timeout_event
+
+class FastbootOperation:
+    """
+    A fastboot command started on first use.
+
+    Awaiting the operation returns its final event, iterating it with
+    `async for` yields the parsed events as they come. Both can be used on
+    the same operation; events are FastbootEvent, or TimeoutEvent when a
+    limit expires.
+    """
+
+    def __init__(self, run):
+        # run(emit) is the coroutine doing the work, emit(event) queues an event.
+        self._run = run
+        self._events = None
+        self._task = None
+
+    def _start(self):
+        if self._task is None:
+            self._events = asyncio.Queue()
+            self._task = asyncio.ensure_future(self._main())
+        return self._task
+
+    async def _main(self):
+        try:
+            return await self._run(self._events.put_nowait)
+        finally:
+            self._events.put_nowait(None)
+
+    def __await__(self):
+        return self._start().__await__()
+
+    def __aiter__(self):
+        self._start()
+        return self
+
+    async def __anext__(self):
+        event = await self._events.get()
+        if event is None:
+            # re-raise the error of the command, if any
+            await self._task
+            raise StopAsyncIteration
+        return event
+
+class AsyncFastboot:
+    """
+    asyncio counterpart of Fastboot, to drive many boards from one event
+    loop. Commands run as asyncio subprocesses of the fastboot binary,
+    whose output is parsed without any thread. With native, the built-in
+    USB client is used instead; its blocking transfers run in the loop
+    default executor.
+    """
+
+    def __init__(self, native=False, timeouts=None):
+        self.logger = logging.getLogger('aiot')
+        self.native = native
+        self.bin = 'fastboot'
+        self.timeouts = timeouts if timeouts is not None else Timeouts()
+        self.fastboot = Fastboot(daemon=True, native=True, timeouts=self.timeouts) if native else None
+
+    def _command(self, fastboot_sn, *args):
+        command = [self.bin]
+        if fastboot_sn:
+            command += ["-s", fastboot_sn]
+        return command + [str(arg) for arg in args]
+
+    async def _stop(self, process):
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), TERMINATE_GRACE)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+    async def _run(self, command, stage, emit, partition=None):
+        # Run a fastboot command under the limits of stage, emitting an
+        # event each time its output changes the parsed state.
+        loop = asyncio.get_running_loop()
+        deadline = self.timeouts.deadline(stage)
+        inactivity = self.timeouts.inactivity(stage)
+        end = loop.time() + deadline if deadline else None
+        parser = FlashLogParser()
+        last_state = {}
+        last_line = ''
+        timed_out = None
+
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT)
+        try:
+            while True:
+                limits = [('inactivity', inactivity)] if inactivity else []
+                if end is not None:
+                    limits.append(('deadline', end - loop.time()))
+                kind, wait = min(limits, key=lambda limit: limit[1], default=(None, None))
+                try:
+                    line = await asyncio.wait_for(process.stdout.readline(), wait)
+                except asyncio.TimeoutError:
+                    timed_out = kind
+                    break
+                if not line:
+                    break
+
+                line = line.decode(errors='replace').strip()
+                if line:
+                    last_line = line
+                parser.parse_log(line + "\n")
+                parser.event_history.clear()
+                if parser.event and parser.event != last_state:
+                    last_state = parser.event.copy()
+                    emit(FastbootEvent.from_dict(last_state))
+
+            if not timed_out:
+                try:
+                    await asyncio.wait_for(process.wait(), end - loop.time() if end is not None else None)
+                except asyncio.TimeoutError:
+                    timed_out = 'deadline'
+        finally:
+            if process.returncode is None:
+                await self._stop(process)
+
+        if timed_out:
+            event = timeout_event(stage, timed_out, deadline if timed_out == 'deadline' else inactivity, partition)
+            self.logger.warning(f"{command[0]}: {event.error}")
+            emit(event)
+            return event
+
+        event = FastbootEvent.from_dict(last_state)
+        if process.returncode:
+            event.status = "FAIL"
+            event.error = last_line
+        return event
+
+    async def _run_native(self, emit, call):
+        # Run call(callback) of the blocking native client in the executor.
+        # Its final event is either returned or the last one reported.
+        loop = asyncio.get_running_loop()
+        last_event = None
+
+        def callback(event):
+            nonlocal last_event
+            last_event = event
+            loop.call_soon_threadsafe(emit, event)
+
+        result = await loop.run_in_executor(None, call, callback)
+        if result:
+            last_event = result
+            emit(result)
+        return last_event
+
+    async def devices(self):
+        # List connected fastboot devices.
+        if device_registry.start():
+            return device_registry.serials()
+        if self.native:
+            return await asyncio.get_running_loop().run_in_executor(None, self.fastboot.devices)
+
+        process = await asyncio.create_subprocess_exec(self.bin, "devices", stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT)
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), self.timeouts.deadline('command'))
+        except asyncio.TimeoutError:
+            await self._stop(process)
+            return []
+        devices = stdout.decode(errors='replace').strip().split('\n')
+        return [line.split()[0] for line in devices if 'fastboot' in line]
+
+    def flash(self, partition, filename, fastboot_sn=None):
+        # Flash a partition with a file, or a SparseImage/SparseStream with
+        # native. Raise FastbootError for the latter without native.
+        if self.native:
+            return FastbootOperation(lambda emit: self._run_native(emit,
+                lambda callback: self.fastboot.flash(partition, filename, callback, fastboot_sn)))
+        filename = Fastboot.file_argument(partition, filename)
+        return FastbootOperation(lambda emit: self._run(
+            self._command(fastboot_sn, "flash", partition, filename), 'partition', emit, partition))
+
+    def erase(self, partition, fastboot_sn=None):
+        if self.native:
+            return FastbootOperation(lambda emit: self._run_native(emit,
+                lambda callback: self.fastboot.erase(partition, fastboot_sn)))
+        return FastbootOperation(lambda emit: self._run(
+            self._command(fastboot_sn, "erase", partition), 'erase', emit, partition))
+
+    def reboot(self, fastboot_sn=None):
+        if self.native:
+            return FastbootOperation(lambda emit: self._run_native(emit,
+                lambda callback: self.fastboot.reboot(fastboot_sn)))
+        return FastbootOperation(lambda emit: self._run(
+            self._command(fastboot_sn, "reboot"), 'reboot', emit))
+
+    def close(self):
+        # Release the USB sessions of the native client.
+        if self.fastboot:
+            self.fastboot.close()
@@ -0,0 +1,239 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import logging
+import time
+
+import usb.core
+import usb.util
+
+# Fastboot USB interface, see system/core/fastboot/README.md in AOSP
+FASTBOOT_CLASS = 0xff
+FASTBOOT_SUBCLASS = 0x42
+FASTBOOT_PROTOCOL = 0x03
+
+# Commands and responses are short ASCII packets, data phases use
+# large bulk transfers to keep the number of USB round trips low.
+MAX_COMMAND_LENGTH = 4096
+MAX_RESPONSE_LENGTH = 256
+BULK_TRANSFER_SIZE = 1024 * 1024
+USB_TIMEOUT_MS = 5000
+# Seconds the device is given to answer a command by default, None is
+# only passed when the limit of the stage is disabled
+COMMAND_TIMEOUT = 120
+
+class FastbootError(RuntimeError):
+    pass
+
+def parse_int(value):
+    # getvar values are usually "0x"-prefixed hex, some bootloaders omit the prefix
+    try:
+        return int(value, 0)
+    except ValueError:
+        return int(value, 16)
+
+def is_fastboot_interface(intf):
+    return (intf.bInterfaceClass == FASTBOOT_CLASS and
+            intf.bInterfaceSubClass == FASTBOOT_SUBCLASS and
+            intf.bInterfaceProtocol == FASTBOOT_PROTOCOL)
+
+def find_fastboot_interface(dev):
+    # Return the fastboot interface of a USB device, or None.
+    try:
+        for cfg in dev:
+            for intf in cfg:
+                if is_fastboot_interface(intf):
+                    return intf
+    except (usb.core.USBError, ValueError):
+        pass
+    return None
+
+def get_serial(dev):
+    try:
+        return usb.util.get_string(dev, dev.iSerialNumber)
+    except (usb.core.USBError, ValueError):
+        return None
+
+class FastbootUsbDevice:
+    """
+    A claimed fastboot session on one USB device.
+
+    The interface is claimed once when the session is opened and released
+    by close(), so several commands can be issued back to back without
+    re-enumerating the device.
+    """
+
+    def __init__(self, dev, intf):
+        self.logger = logging.getLogger('aiot')
+        self.dev = dev
+        self.intf = intf
+        self.serial = get_serial(dev)
+        self._max_download_size = None
+        self.ep_out = usb.util.find_descriptor(intf, custom_match=lambda e:
+            usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
+        self.ep_in = usb.util.find_descriptor(intf, custom_match=lambda e:
+            usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN)
+        if self.ep_out is None or self.ep_in is None:
+            raise FastbootError("Fastboot interface has no bulk endpoints")
+        usb.util.claim_interface(dev, intf)
+
+    @classmethod
+    def list_devices(cls):
+        # List (serial, usb device) of all the connected fastboot devices.
+        devices = []
+        try:
+            found = usb.core.find(find_all=True)
+        except usb.core.NoBackendError:
+            raise FastbootError("No libusb backend available for the native fastboot client")
+        for dev in found:
+            if find_fastboot_interface(dev) is not None:
+                devices.append((get_serial(dev), dev))
+        return devices
+
+    @classmethod
+    def open(cls, serial=None):
+        # Open a session on the device matching serial, or on the only
+        # fastboot device connected when no serial is given.
+        devices = cls.list_devices()
+        if serial:
+            devices = [d for d in devices if d[0] == serial]
+        if len(devices) == 0:
+            raise FastbootError(f"No fastboot device found (serial={serial})")
+        if len(devices) > 1:
+            raise FastbootError("More than one fastboot device connected, please specify a serial")
+
+        dev = devices[0][1]
+        try:
+            return cls(dev, find_fastboot_interface(dev))
+        except usb.core.USBError as e:
+            raise FastbootError(f"Cannot claim fastboot interface: {e}")
+
+    def close(self):
+        try:
+            usb.util.release_interface(self.dev, self.intf)
+            usb.util.dispose_resources(self.dev)
+        except usb.core.USBError:
+            pass
+
+    def _write(self, data):
+        try:
+            self.ep_out.write(data, USB_TIMEOUT_MS)
+        except usb.core.USBError as e:
+            raise FastbootError(f"USB write failed: {e}")
+
+    def _read(self, length):
+        try:
+            return bytes(self.ep_in.read(length, USB_TIMEOUT_MS))
+        except usb.core.USBTimeoutError:
+            raise
+        except usb.core.USBError as e:
+            raise FastbootError(f"USB read failed: {e}")
+
+    def _read_response(self, timeout=COMMAND_TIMEOUT, info_callback=None):
+        # Wait for the final response of a command. INFO and TEXT
+        # packets are forwarded to info_callback.
+        start = time.time()
+        while True:
+            try:
+                packet = self._read(MAX_RESPONSE_LENGTH)
+            except usb.core.USBTimeoutError:
+                if timeout is not None and time.time() - start > timeout:
+                    raise FastbootError(f"No response from device for {timeout} seconds")
+                continue
+
+            status, payload = packet[:4].decode(errors='replace'), packet[4:].decode(errors='replace')
+            if status in ('INFO', 'TEXT'):
+                self.logger.debug(f"(fastboot) {payload}")
+                if info_callback:
+                    info_callback(payload)
+            elif status == 'OKAY':
+                return payload
+            elif status == 'DATA':
+                return int(payload, 16)
+            elif status == 'FAIL':
+                raise FastbootError(payload)
+            else:
+                raise FastbootError(f"Unknown fastboot response: {packet!r}")
+
+    def command(self, command, timeout=COMMAND_TIMEOUT, info_callback=None):
+        # Send a command and return the payload of its OKAY response.
+        data = command.encode()
+        if len(data) > MAX_COMMAND_LENGTH:
+            raise FastbootError(f"Command too long: {command}")
+        self.logger.debug(f"(fastboot) > {command}")
+        self._write(data)
+        return self._read_response(timeout, info_callback)
+
+    def getvar(self, name, timeout=COMMAND_TIMEOUT):
+        return self.command(f"getvar:{name}", timeout)
+
+    def getvar_all(self, timeout=COMMAND_TIMEOUT):
+        # Return the "name: value" lines the device sends for getvar:all.
+        lines = []
+        self.command("getvar:all", timeout, info_callback=lines.append)
+        return lines
+
+    @property
+    def max_download_size(self):
+        # Queried once per session, the device answer does not change.
+        if self._max_download_size is None:
+            self._max_download_size = parse_int(self.getvar("max-download-size"))
+            self.logger.debug(f"(fastboot) max-download-size={self._max_download_size}")
+        return self._max_download_size
+
+    def download(self, size, chunks, progress_callback=None, timeout=COMMAND_TIMEOUT):
+        # Send size bytes taken from the iterable chunks to the device,
+        # waiting up to timeout seconds for each of its responses.
+        if self.command(f"download:{size:08x}", timeout) != size:
+            raise FastbootError("Device refused download size")
+
+        sent = 0
+        pending = bytearray()
+        for chunk in chunks:
+            pending += chunk
+            while len(pending) >= BULK_TRANSFER_SIZE:
+                self._write(pending[:BULK_TRANSFER_SIZE])
+                del pending[:BULK_TRANSFER_SIZE]
+                sent += BULK_TRANSFER_SIZE
+                if progress_callback:
+                    progress_callback(sent, size)
+        if pending:
+            self._write(pending)
+            sent += len(pending)
+            if progress_callback:
+                progress_callback(sent, size)
+
+        if sent != size:
+            raise FastbootError(f"Download size mismatch: sent {sent} of {size} bytes")
+        return self._read_response(timeout)
+
+    def upload(self, size, sink, timeout=COMMAND_TIMEOUT):
+        # Receive size bytes announced by a DATA response into sink(chunk).
+        received = 0
+        while received < size:
+            try:
+                chunk = self._read(min(BULK_TRANSFER_SIZE, size - received))
+            except usb.core.USBTimeoutError:
+                raise FastbootError("Timeout while receiving data from device")
+            sink(chunk)
+            received += len(chunk)
+        return self._read_response(timeout)
+
+    def flash(self, partition, timeout=COMMAND_TIMEOUT):
+        return self.command(f"flash:{partition}", timeout)
+
+    def erase(self, partition, timeout=COMMAND_TIMEOUT):
+        return self.command(f"erase:{partition}", timeout)
+
+    def fetch(self, partition, sink, offset=0, size=None, timeout=COMMAND_TIMEOUT):
+        command = f"fetch:{partition}"
+        if size is not None:
+            command += f":{offset:08x}:{size:08x}"
+        length = self.command(command, timeout)
+        return self.upload(length, sink, timeout)
+
+    def oem(self, command, timeout=COMMAND_TIMEOUT):
+        return self.command(f"oem {command}", timeout)
+
+    def reboot(self, timeout=COMMAND_TIMEOUT):
+        return self.command("reboot", timeout)
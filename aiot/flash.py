@@ -8,192 +8,538 @@ import pathlib
 import platform
 import time
 import os
-import json
+from concurrent.futures import ThreadPoolExecutor
 
 import aiot
 
 from aiot.bootrom import run_bootrom
-from aiot.bootrom_log_parser import bootrom_log_parser
+from aiot.bootrom_log_parser import parse_bootrom_log
+from aiot.cache import artifact_cache
+from aiot.compression import is_compressed, resolve
+from aiot.delta import delta_image
+from aiot.devices import device_registry, on_port, tty_port
+from aiot.events import BootromEvent, DeviceEvent, FastbootEvent, VerifyEvent
+from aiot.journal import FlashJournal, plan_fingerprint, step_id
+from aiot.plan import compile_plan
+from aiot.fastboot_usb import FastbootError
+from aiot.sparse import NOR_ERASED_FILL, SparseImage, SparseStream, image_cache, image_size
+from aiot.verify import verify_image
+
+# Memory the next partition may hold while being prepared ahead
+PREFETCH_MEMORY = 256 * 1024 * 1024
+
+def claim_fastboot_device(daemon, fastboot, port=None, timeout=10):
+    # Serial of the first fastboot device, on USB port when known, not in
+    # the assigned_sn of daemon, which gets it. None on timeout.
+    if device_registry.start():
+        # the DA enumerates on the USB port of the boot ROM, when known
+        device = device_registry.claim(daemon.assigned_sn, port=port, timeout=timeout)
+        return device.serial if device else None
+
+    # No udev events to wait on, poll fastboot for a new device on port
+    start_time = time.time()
+    while True:
+        serials = [serial for serial, path in fastboot.device_ports()
+                   if on_port(path, port) and serial not in daemon.assigned_sn]
+        if serials:
+            return daemon.assign_sn_flasher(serials)
+        if time.time() - start_time > timeout:
+            return None
+        time.sleep(1)
 
 class Flash:
-    def __init__(self, image, dry_run=False, daemon=False, verbose=False, queue=None, data_event=None, skip_erase=False):
+    def __init__(self, image, dry_run=False, daemon=False, verbose=False, queue=None, data_event=None, skip_erase=False, native=False, timeouts=None, delta=False, fastboot_sn=None, plan=None, resume=False, verify=None, board_port=None):
         # Initialize the Flash object with necessary parameters.
         self.img = image
         self.daemon = daemon
         self.verbose = verbose
         self.queue = queue
-        self.fastboot_sn = None
+        self.fastboot_sn = fastboot_sn
+        # serial of the board when known beforehand, else the first new
+        # fastboot device is claimed in daemon mode
+        self.device_sn = fastboot_sn
+        # USB port of a board the daemon dispatched in download mode
+        self.board_port = board_port
         self.data_event = data_event
         self.skip_erase = skip_erase
-        self.fastboot = aiot.Fastboot(dry_run=dry_run, daemon=daemon)
+        # only send the blocks that differ from the device contents
+        self.delta = delta
+        self.fastboot = aiot.Fastboot(dry_run=dry_run, daemon=daemon, native=native, timeouts=timeouts)
         self.logger = logging.getLogger('aiot')
-
-    def handle_output(self, json_output):
-        # Handle the output from the flash operation.
+        # FlashPlan of the targets, compiled once and possibly shared
+        self.plan = plan
+        # continue from the actions the journal of the board has done
+        self.resume = resume
+        self.journal = None
+        self.failed_steps = 0
+        self.last_event = None
+        # VerifyPolicy of the readback after flashing, None for none
+        self.verify = verify
+
+    def handle_output(self, event):
+        # Handle the output event from the flash operation.
+        self.last_event = event
         if self.queue:
-            self.queue.put(json_output)
+            self.queue.put(event)
             if self.data_event:
                 self.data_event.set()  # Notify the flash daemon
 
-    def flash_partition(self, partition, filename):
-        # Flash a specific partition with the given filename.
+    def load_image(self, partition, path, erased=False):
+        # Describe the image as sparse chunks, so that space outside GPT
+        # partitions, unallocated ext4 blocks, zero and other fill pattern
+        # blocks are not sent over USB.
+        dont_care = ()
+        if erased and partition.startswith('nor'):
+            # NOR flash reads as 0xFF once erased, no need to write it again
+            dont_care = (NOR_ERASED_FILL,)
+
+        if is_compressed(path):
+            cached = artifact_cache.lookup('decompressed', SparseStream.cache_key(path))
+            if cached is None:
+                # decompressed while being uploaded, and cached for the next
+                # runs when asked
+                self.logger.debug(f"{partition}: streaming from compressed image {path}")
+                return SparseStream(path, dont_care=dont_care, cache=artifact_cache.streams)
+            self.logger.debug(f"{partition}: using the decompressed image of {path} from the artifact cache")
+            path = cached
+
+        image = image_cache.get(path, dont_care)
+        self.logger.debug(f"{partition}: {image.sparse_size()} bytes to send for "
+                          f"{image.expanded_size()} bytes image")
+        return image
+
+    def load_delta(self, partition, image):
+        # Restrict image to the blocks the device does not already hold.
+        try:
+            return delta_image(image, partition, self.fastboot.delta_device(self.fastboot_sn))
+        except FastbootError as e:
+            self.logger.warning(f"{partition}: cannot compare with the device contents ({e}), "
+                                "flashing the whole image")
+            return image
+
+    def prepare_partition(self, partition, filename, erased=False, stream_size=None):
+        # Host side work of flashing a partition: generate, resolve and
+        # convert its file. May run in the prefetch thread, so the device
+        # is not used here. A compressed image starts being decompressed
+        # in segments of stream_size bytes when given.
         if hasattr(self.img, 'generate_file'):
             self.img.generate_file(partition, filename)
 
-        path = pathlib.Path(self.img.path) / filename
+        path = resolve(pathlib.Path(self.img.path) / filename)
+        if not self.fastboot.native or self.fastboot.dry_run:
+            return str(path)
+
+        image = self.load_image(partition, path, erased)
+        if stream_size and isinstance(image, SparseStream):
+            image.prefetch(stream_size)
+        return image
+
+    def flash_partition(self, partition, filename, erased=False, image=None):
+        # Flash a specific partition with the given filename.
+        # erased tells whether the partition has just been erased, image
+        # is what prepare_partition() returned when already called.
+        if image is None:
+            image = self.prepare_partition(partition, filename, erased)
+        if self.delta and not erased and isinstance(image, SparseImage):
+            image = self.load_delta(partition, image)
 
         if self.daemon:
-            process = self.fastboot.flash(partition, str(path), self.handle_output, fastboot_sn=self.fastboot_sn)
-            if process:
-                process.wait()
-        else:
-            print(f"flashing {partition}={filename}")
-            self.fastboot.flash(partition, str(path))
+            return self.fastboot.flash(partition, image, self.handle_output, fastboot_sn=self.fastboot_sn)
+        print(f"flashing {partition}={filename}")
+        return self.fastboot.flash(partition, image)
+
+    def prefetch_size(self, step):
+        # Size of the segments a compressed image of step may decompress
+        # ahead within the prefetch memory, 0 when it may not. Queried
+        # here as the device cannot be used from the prefetch thread.
+        if not self.fastboot.native or self.fastboot.dry_run or not is_compressed(step.path):
+            return 0
+        max_size = self.fastboot.max_download_size(self.fastboot_sn)
+        return max_size if SparseStream.prefetch_size(max_size) <= PREFETCH_MEMORY else 0
+
+    def succeeded(self, result):
+        # Whether the erase or flash that returned result worked: the
+        # return code outside daemon mode, else the last event reported.
+        if self.fastboot.dry_run:
+            return True
+        if self.daemon:
+            event = self.last_event
+            return isinstance(event, FastbootEvent) and event.status == "OKAY"
+        return result == 0
 
-    def erase_partition(self, partition):
-        # Erase a specific partition.
+    def step_done(self, step):
+        # Whether the journal has step done by an interrupted flash.
+        if self.journal is None or not self.journal.is_done(step_id(step)):
+            return False
+        self.logger.info(f"Resuming: {step.action} {step.partition} already done")
+        return True
+
+    def record_step(self, step, result):
+        # Record step in the journal once it succeeded, count it failed
+        # otherwise.
+        if not self.succeeded(result):
+            self.failed_steps += 1
+        elif self.journal is not None:
+            self.journal.record(step_id(step))
+
+    def board_identity(self):
+        # Key of the journal of the board: the serial of its fastboot
+        # device, claimed or reported, else the USB path it is on. None
+        # when neither is known.
+        serial = (self.fastboot_sn or self.device_sn or
+                  self.fastboot.capabilities(self.fastboot_sn).serialno)
+        if serial:
+            return serial
+        port = self.board_port
+        if port is None:
+            ports = [path for _, path in self.fastboot.device_ports()]
+            port = ports[0] if len(ports) == 1 else None
+        return f"usb-{port}" if port else None
+
+    def open_journal(self, plan):
+        # Start the journal of the board with resume, keyed by its identity
+        # and the content of the plan. Without resume nothing is recorded,
+        # and what a previous flash recorded no longer applies.
+        self.journal = None
+        if self.fastboot.dry_run or not (self.resume or FlashJournal.any_left()):
+            return
+        board = self.board_identity()
+        if not board:
+            if self.resume:
+                self.logger.warning("Cannot identify the board, flashing without a journal to resume from")
+            return
+        journal = FlashJournal(board, plan_fingerprint(plan))
+        if not self.resume:
+            journal.reset()
+            return
+        self.journal = journal
+        self.failed_steps = 0
+        if self.journal.load():
+            self.logger.info(f"Resuming flash of {board}, {len(self.journal.done)} actions already done")
+
+    def flash_steps(self, steps, erased=()):
+        # Flash the steps of a plan in order. The next partition is
+        # prepared in a background thread while the current one is sent,
+        # unless both use the same file, which may be regenerated.
+        steps = [step for step in steps if not self.step_done(step)]
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch') as executor:
+            pending = None
+            try:
+                for index, step in enumerate(steps):
+                    if pending is None:
+                        image = self.prepare_partition(step.partition, step.filename, step.partition in erased)
+                    else:
+                        image = pending.result()
+                        pending = None
+
+                    following = steps[index + 1] if index + 1 < len(steps) else None
+                    if following is not None and following.path != step.path:
+                        pending = executor.submit(self.prepare_partition, following.partition, following.filename,
+                                                  following.partition in erased, self.prefetch_size(following))
+
+                    self.last_event = None
+                    result = self.flash_partition(step.partition, step.filename, step.partition in erased, image)
+                    self.record_step(step, result)
+            finally:
+                if pending is not None:
+                    # flashing stopped early, release what was prepared ahead
+                    if not pending.cancel() and pending.exception() is None:
+                        if isinstance(pending.result(), SparseStream):
+                            pending.result().close()
+
+    def validate_device(self, partitions):
+        # Check the images of partitions, a dict of partition to filename,
+        # against what the device reports, before erasing or uploading
+        # anything. Return False when they cannot be flashed.
+        capabilities = self.fastboot.capabilities(self.fastboot_sn)
         if self.daemon:
-            json_output = self.fastboot.erase(partition, fastboot_sn=self.fastboot_sn)
-            if self.queue:
-                self.queue.put(json_output)
-                if self.data_event:
-                    self.data_event.set()  # Notify the flash daemon
+            self.handle_output(DeviceEvent(fastboot_sn=self.fastboot_sn, storage=capabilities.storage,
+                                           da_version=capabilities.da_version,
+                                           max_download_size=capabilities.max_download_size))
+
+        sizes = {}
+        for partition, filename in partitions.items():
+            path = resolve(pathlib.Path(self.img.path) / filename)
+            if path.exists():
+                sizes[partition] = image_size(path)
+
+        errors = capabilities.validate(sizes, getattr(self.img, 'storage', None))
+        for error in errors:
+            self.logger.error(f"Cannot flash: {error}")
+        if errors and self.daemon:
+            self.handle_output(FastbootEvent(action="Error", error="; ".join(errors)))
+        return not errors
+
+    def covers_partition(self, partition, filename):
+        # Whether flashing filename writes every byte of the partition, as
+        # reported by the device, leaving nothing of its previous content.
+        size = self.fastboot.capabilities(self.fastboot_sn).partition_size(partition)
+        path = resolve(pathlib.Path(self.img.path) / filename)
+        if not size or not path.exists() or is_compressed(path):
+            return False
+
+        if self.fastboot.native:
+            # the image as load_image() sends it
+            covered = image_cache.get(path).covered_size()
+        elif SparseImage.is_sparse(path):
+            covered = SparseImage.from_sparse_file(path).covered_size()
         else:
-            print(f"erasing {partition}")
-            self.fastboot.erase(partition)
+            covered = os.path.getsize(path)
+        return covered >= size
+
+    def redundant_erases(self, target, erase):
+        # Partitions of erase that the group flashes over entirely, unless
+        # the group forces the erase of all or some of its partitions.
+        if target.force_erase is True:
+            return []
+
+        redundant = []
+        flashes = {step.partition: step for step in target.flash}
+        for partition in erase:
+            if partition in (target.force_erase or []) or partition not in flashes:
+                continue
+            filename = flashes[partition].filename
+            if self.covers_partition(partition, filename):
+                self.logger.info(f"Skipping erase of {partition}, fully overwritten by {filename}")
+                redundant.append(partition)
+        return redundant
 
-    def flash_group(self, group):
-        # Flash a group of partitions defined in the image.
-        actions = self.img.groups.get(group, {})
+    def erase_partition(self, partition):
+        # Erase a specific partition.
         if self.daemon:
-            timeout = 10
-            start_time = time.time()
-
-            while not self.fastboot.devices():
-                if time.time() - start_time > timeout:
-                    data = {'action': 'Error: Jump DA failed', 'error': 'Jump DA: Exceeded 10 seconds.'}
-                    json_output = json.dumps(data, indent=4)
-                    if self.queue:
-                        self.queue.put(json_output)
-                        if self.data_event:
-                            self.data_event.set()  # Notify the flash daemon
-                    break
-                time.sleep(1)
-
-            # Assign fastboot serial number
-            self.fastboot_sn = self.daemon.assign_sn_flasher(self.fastboot.devices())
-            if not self.fastboot_sn: # Abort flash if jump DA failed (Cannot find new fastboot device)
-                return
-
-            data = {"fastboot_sn": self.fastboot_sn}
-            json_output = json.dumps(data, indent=4)
-            if self.queue:
-                self.queue.put(json_output)
-                if self.data_event:
-                    self.data_event.set()  # Notify the flash daemon
-
-        if 'erase' in actions and not self.skip_erase:
-            for partition in actions['erase']:
-                self.erase_partition(partition)
+            result = self.fastboot.erase(partition, fastboot_sn=self.fastboot_sn)
+            self.handle_output(result)
+            return result
+        print(f"erasing {partition}")
+        return self.fastboot.erase(partition)
+
+    def erase_step(self, step):
+        # Erase the partition of a plan step, unless already done.
+        if not self.step_done(step):
+            self.last_event = None
+            self.record_step(step, self.erase_partition(step.partition))
+
+    def wait_fastboot_device(self, timeout=10):
+        # Wait for the fastboot device of the board that just jumped to DA,
+        # the first one not already assigned to another worker.
+        claim = getattr(self.daemon, 'claim_fastboot_device', None)
+        if claim is not None:
+            # in a worker process, claimed by the daemon process
+            return claim(self.board_port, timeout)
+        return claim_fastboot_device(self.daemon, self.fastboot, self.board_port, timeout)
+
+    def assign_device(self):
+        # Assign the fastboot serial of the board in daemon mode.
+        self.fastboot_sn = self.device_sn or self.wait_fastboot_device()
+        if not self.fastboot_sn: # Abort flash if jump DA failed (Cannot find new fastboot device)
+            self.handle_output(FastbootEvent(action='Error: Jump DA failed',
+                                             error='Jump DA: Exceeded 10 seconds.'))
+            return False
 
-        if 'flash' in actions:
-            for partition in actions['flash']:
-                if partition not in self.img.partitions:
-                    self.logger.error(f"Invalid partition {partition}")
-                    return
-                self.flash_partition(partition, self.img.partitions[partition])
+        self.handle_output(FastbootEvent(fastboot_sn=self.fastboot_sn))
+        return True
 
-        if 'erase_after_flash' in actions and not self.skip_erase:
-            for partition in actions['erase_after_flash']:
-                self.erase_partition(partition)
+    def live_device(self, targets):
+        # A fastboot device still running the DA, such as one left by an
+        # interrupted flash, preferring the ones whose journal has actions
+        # of this plan done. Claimed in daemon mode.
+        serials = self.fastboot.devices()
+        if self.daemon:
+            serials = [serial for serial in serials if serial not in self.daemon.assigned_sn]
+        fingerprint = plan_fingerprint(self.compile(targets))
+        journaled = [serial for serial in serials if FlashJournal(serial, fingerprint).load()]
+        for serial in journaled + serials:
+            if not self.daemon or self.daemon.assign_sn_flasher([serial]):
+                return serial
+        return None
+
+    def flash_group(self, target):
+        # Flash a group of partitions defined in the image, from its PlanTarget.
+        flashed = [step.partition for step in target.flash]
+        erased = [step.partition for step in target.erase]
+        if self.delta:
+            # the partitions flashed are compared with their current contents
+            erased = [partition for partition in erased if partition not in flashed]
+        redundant = self.redundant_erases(target, erased)
+        erased = [partition for partition in erased if partition not in redundant]
+
+        for step in target.erase:
+            if step.partition in erased:
+                self.erase_step(step)
+
+        self.flash_steps(target.flash, erased)
+
+        for step in target.erase_after_flash:
+            self.erase_step(step)
+
+    def verify_partition(self, step):
+        # Read back the partition of a flash step and compare it with its
+        # image, return the VerifyEvent of the result.
+        event = VerifyEvent(action="verifying", partition=step.partition)
+        start = time.time()
+        path = resolve(pathlib.Path(self.img.path) / step.filename)
+        try:
+            image = self.load_image(step.partition, path)
+            if isinstance(image, SparseStream):
+                event.status = "SKIPPED"
+                event.error = f"{path}: decompressed image not in the artifact cache"
+                return event
+            blocks, mismatches = verify_image(self.fastboot.readback_device(self.fastboot_sn),
+                                              step.partition, image, self.verify)
+            event.blocks = blocks
+            event.mismatches = len(mismatches)
+            event.status = "FAIL" if mismatches else "OKAY"
+            if mismatches:
+                event.error = f"{len(mismatches)} of {blocks} blocks differ, first at block {mismatches[0]}"
+        except (FastbootError, OSError, ValueError) as e:
+            event.status = "FAIL"
+            event.error = str(e)
+        finally:
+            event.duration = f"{time.time() - start:.3f}s"
+        return event
+
+    def verify_flashed(self, plan):
+        # Verify the partitions flashed by plan as the verify policy asks,
+        # before the reboot leaves the DA. Return the partitions that differ.
+        if self.verify is None or not self.verify.enabled or self.fastboot.dry_run:
+            return []
+        if not self.verify.board_selected():
+            self.logger.info("Board not sampled for verification")
+            self.handle_output(VerifyEvent(action="verifying", verify="SKIPPED"))
+            return []
+
+        # the last flash of a partition is what it holds
+        steps = {step.partition: step for step in plan.steps() if step.action == 'flash'}
+        failed = []
+        for step in steps.values():
+            event = self.verify_partition(step)
+            if self.daemon:
+                self.handle_output(event)
+            else:
+                message = f"Verifying '{step.partition}'"
+                print(f"{message:<50} {event.status} [{event.duration:>8}]", flush=True)
+                if event.error:
+                    self.logger.warning(f"{step.partition}: {event.error}")
+            if event.status == "FAIL":
+                failed.append(step.partition)
+
+        verify = f"FAIL: {', '.join(failed)}" if failed else "OKAY"
+        self.handle_output(VerifyEvent(action="verifying", verify=verify))
+        if failed:
+            self.logger.error(f"Verification failed for {', '.join(failed)}")
+        return failed
+
+    def compile(self, targets):
+        # Return the plan of targets, compiled on first use unless given.
+        if self.plan is None or self.plan.requested != list(targets):
+            self.plan = compile_plan(self.img, targets, native=self.fastboot.native, skip_erase=self.skip_erase)
+        return self.plan
 
     def check(self, targets):
         # Check if the specified targets are valid for flashing.
-        if not targets and 'all' not in self.img.groups:
-            self.logger.error("No target specified, and no 'all' default target available")
+        if self.delta and not self.fastboot.native:
+            self.logger.error("Delta flashing requires --fastboot-usb")
+            return False
+        if self.verify is not None and self.verify.enabled and not self.fastboot.native:
+            self.logger.error("Verification requires --fastboot-usb")
             return False
 
-        for target in targets:
-            partition, binary = (target.split(':') + [None])[:2]
-
-            if target not in self.img.groups and partition not in self.img.partitions:
-                self.logger.error(f"Invalid target '{target}'")
-                return False
-
-            if partition in self.img.partitions:
-                if binary is None:
-                    binary = os.path.join(self.img.path, self.img.partitions[partition])
-
-                if os.path.basename(binary) == 'u-boot-env.bin':
-                    continue
-
-                if not os.path.exists(binary):
-                    self.logger.error(f"The binary file '{binary}' for partition '{partition}' doesn't exist")
-                    return False
-
-        return True
+        plan = self.compile(targets)
+        for error in plan.errors:
+            self.logger.error(error)
+        return not plan.errors
 
     def flash(self, targets):
-        # Flash the specified targets.
-        if not targets:
-            targets = ["all"] if 'all' in self.img.groups else []
-            if not targets:
-                self.logger.error("No target specified, and no 'all' default target available")
-                return
+        # Flash the specified targets, following their plan. Return
+        # whether every step worked and the board rebooted.
+        plan = self.compile(targets)
+        if plan.errors:
+            for error in plan.errors:
+                self.logger.error(error)
+            return False
+
+        if self.daemon and not self.assign_device():
+            return False
+        self.open_journal(plan)
 
-        for target in targets:
-            partition, binary = (target.split(':') + [None])[:2]
+        # every image is checked with a single getvar all, before erasing
+        # or uploading anything
+        if not self.validate_device({step.partition: step.filename
+                                     for target in plan.targets for step in target.flash}):
+            self.fastboot.close()
+            return False
 
-            if target in self.img.groups:
+        for target in plan.targets:
+            if target.group:
                 self.flash_group(target)
-                if self.daemon:
-                    if not self.fastboot_sn: # Abort flash if jump DA failed
-                        return
                 continue
 
-            if partition in self.img.partitions:
-                if binary is None:
-                    binary = self.img.partitions[target]
-                self.flash_partition(partition, binary)
-                continue
+            step = target.flash[0]
+            if not self.step_done(step):
+                self.last_event = None
+                self.record_step(step, self.flash_partition(step.partition, step.filename))
 
-            self.logger.error(f"target '{target}' does not exist")
+        failed = self.verify_flashed(plan)
+        if failed:
+            self.failed_steps += 1
+        if failed and self.journal is not None:
+            # flashed again on resume
+            for step in plan.steps():
+                if step.action == 'flash' and step.partition in failed:
+                    self.journal.forget(step_id(step))
 
         # handling reboot event
         if self.daemon:
-            json_output = self.fastboot.reboot(fastboot_sn=self.fastboot_sn)
+            event = self.fastboot.reboot(fastboot_sn=self.fastboot_sn)
             self.action = "rebooting"
-            if self.queue:
-                self.queue.put(json_output)
-                if self.data_event:
-                    self.data_event.set()  # notify flash_daemon
+            self.handle_output(event)
         else:
-            self.fastboot.reboot()
+            event = self.fastboot.reboot()
+        flashed = not self.failed_steps and self.succeeded(event)
+        if self.journal is not None and flashed:
+            # flashed completely, nothing left to resume
+            self.journal.reset()
+
+        # Release the USB session held by the native fastboot client
+        self.fastboot.close()
+        if artifact_cache.stats:
+            self.logger.debug(f"Artifact cache: {artifact_cache.summary()}")
+        return flashed
 
     def flash_worker(self, image, args, queue=None, data_event=None):
-        # Worker thread that performs the flashing.
+        # Worker thread that performs the flashing, return whether the
+        # board was flashed.
         if not self.check(args.targets):
-            return
+            return False
 
         if args.dry_run:
-            self.flash(args.targets)
-            return
-
-        result = {"action": "", "error": ""}
-
-        try:
-            # Initialize board control based on the operating system
-            board = self.initialize_board(args)
-            board.download_mode_boot()
-        except RuntimeError as r:
-            self.handle_board_error(r, args, result, "Unable to find and reset the board.")
-        except Exception as e:
-            self.handle_board_error(e, args, result, "Board control failed.")
-
-        if not args.skip_bootstrap:
-            self.handle_bootstrap(args, queue, data_event)
+            print(self.compile(args.targets))
+            return True
+
+        if self.resume and self.board_port is None:
+            serial = self.live_device(args.targets)
+            if serial:
+                self.logger.info(f"Resuming on fastboot device {serial}, its DA is still running, skipping bootstrap")
+                self.device_sn = serial
+                return self.flash(args.targets)
+
+        result = BootromEvent(action="", error="")
+
+        # A board dispatched by the daemon is already in download mode
+        if self.board_port is None:
+            try:
+                # Initialize board control based on the operating system
+                board = self.initialize_board(args)
+                board.download_mode_boot()
+            except RuntimeError as r:
+                self.handle_board_error(r, args, result, "Unable to find and reset the board.")
+            except Exception as e:
+                self.handle_board_error(e, args, result, "Board control failed.")
+
+        if not args.skip_bootstrap and not self.handle_bootstrap(args, queue, data_event):
+            return False
 
-        self.flash(args.targets)
+        return self.flash(args.targets)
 
     def initialize_board(self, args):
         # Initialize the board control based on the OS.
@@ -217,26 +563,59 @@ class Flash:
 
         if args.daemon:
             if self.queue:
-                result["action"] = "Starting"
-                result["error"] = f"Board Ctrl: {message} You can check detail with normal single download."
-                boardctl_json = json.dumps(result, indent=4)
-                self.queue.put(boardctl_json)
-                if self.data_event:
-                    self.data_event.set()  # notify flash_daemon
+                result.action = "Starting"
+                result.error = f"Board Ctrl: {message} You can check detail with normal single download."
+                self.handle_output(result)
         else:
             self.logger.warning(str(error))
             self.logger.warning(warning_str)
             self.logger.info("Continue flashing...")
 
     def handle_bootstrap(self, args, queue, data_event):
-        # Handle the bootstrap process.
-        bootrom_output = run_bootrom(args)
-        bootrom_json = bootrom_log_parser(bootrom_output)
+        # Handle the bootstrap process. Return False when the bootstrapped
+        # board is not the one to flash.
+        timeout_events = []
+
+        def progress(event):
+            if queue:
+                queue.put(event)
+            if data_event:
+                data_event.set()
+
+        bootrom_output = run_bootrom(args, timeout_events.append, progress, self.board_port)
+        bootrom_event = parse_bootrom_log(bootrom_output)
+        followed = self.follow_board(bootrom_event)
 
         if queue:
-            queue.put(bootrom_json)
+            queue.put(bootrom_event)
+            # reported last, so the worker ends up in the error state
+            for event in timeout_events:
+                queue.put(event)
         if data_event:
             data_event.set()  # notify flash_daemon
+        return followed
+
+    def follow_board(self, event):
+        # Tie the board to the USB port of the serial port the bootrom tool
+        # opened, where its DA then enumerates as a fastboot device. The
+        # tool opens the first boot ROM it finds, which may not be the
+        # board dispatched on board_port: that one is given back to the
+        # daemon, and the other, which another worker may have been given,
+        # is not flashed. Return False then.
+        port = tty_port(event.com_port) if event is not None else None
+        if port is None:
+            return True
+        if self.board_port is not None and port != self.board_port:
+            event.action = "Error"
+            event.error = f"Bootstrapped the board on USB port {port} instead of {self.board_port}"
+            self.logger.error(event.error)
+            redispatch = getattr(self.daemon, 'redispatch', None)
+            if redispatch is not None:
+                redispatch(self.board_port)
+            return False
+        self.board_port = port
+        event.usb_port = port
+        return True
 
     def process(self, targets):
         # Main process method to handle flashing tasks.
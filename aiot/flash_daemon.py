@@ -11,7 +11,21 @@ import threading
 import socket
 from queue import SimpleQueue
 
+from .devices import device_registry
+from .events import WorkerStatus
 from .flash_worker import GenioFlashWorker
+from .plan import compile_plan
+from .worker_process import WorkerProcess
+
+# Actions of a worker bootstrapping its board, or waiting for one: without
+# udev, the next worker only starts when no worker is in one of them
+BOOTSTRAP_ACTIONS = ["Waiting", "Starting", "Opening", "Jumping DA"]
+# Seconds between two worker starts without udev, a worker failing at
+# once would otherwise be restarted in a loop
+WORKER_START_INTERVAL = 5
+# Longest time a client waits for a status change before the status is
+# sent again anyway
+STATUS_KEEPALIVE_SECONDS = 10
 
 class GenioFlashDaemon:
     def __init__(self, args=None, image=None):
@@ -20,18 +34,31 @@ class GenioFlashDaemon:
         self.max_processes = args.workers
         self.args = args
         self.image = image
-        self.status_lock = threading.Lock()
-        self.statuses = [{"id": i, "action": "Stopped", "error": ""} for i in range(self.max_processes)]
-        self.last_start_time = time.time() - 5
+        # notified on every status change, guards the statuses
+        self.status_changed = threading.Condition()
+        self.statuses = [WorkerStatus(id=i, action="Stopped", error="") for i in range(self.max_processes)]
+        self.status_version = 0
+        # statuses serialized for the clients, rebuilt only after a change
+        self.status_json = None
+        self.stopped = threading.Event()
+        # USB ports of the boards in download mode waiting for a worker
+        self.pending_ports = []
+        # compiled once, the files are checked and converted for all the workers
+        self.plan = compile_plan(image, args.targets, native=args.fastboot_usb, skip_erase=args.skip_erase)
         self.workers = [GenioFlashWorker(i, image=image, args=args, daemon=self) for i in range(self.max_processes)]
+        # serializes the bootrom open phase of the worker processes
+        self.open_lock = WorkerProcess.open_lock() if args.worker_mode == 'process' else None
         self.queue = SimpleQueue()
         self.action_update_thread = threading.Thread(target=self.update_status_all)
         self.action_update_thread.start()
+        # serials of the boards of the workers, only changed under the lock
+        # of the device registry, which claims them
         self.assigned_sn = set()
+        self.assigned_lock = device_registry.condition
 
-    def status_json_to_info(self, status_info_json_str):
-        # Convert a JSON string containing status information into a human-readable format.
-        status_info_json = json.loads(status_info_json_str)
+    def status_json_to_info(self, status):
+        # Convert a WorkerStatus into a human-readable format.
+        status_info_json = status.to_dict()
 
         status_info = status_info_json["action"]
 
@@ -41,64 +68,142 @@ class GenioFlashDaemon:
         if status_info_json["action"] not in ['Starting']:
             if "com_port" in status_info_json:
                 status_info += f" (COM port: {status_info_json['com_port']})"
+            if "usb_port" in status_info_json:
+                status_info += f" (USB port: {status_info_json['usb_port']})"
             if "fastboot_sn" in status_info_json:
                 status_info += f" (SN: {status_info_json['fastboot_sn']})"
             if "progress" in status_info_json:
                 status_info += f" (Progress: {status_info_json['progress']})"
             if "duration" in status_info_json:
                 status_info += f" (Duration: {status_info_json['duration']})"
+            if "boards" in status_info_json:
+                status_info += f" (Boards: {status_info_json['boards']}, failures: {status_info_json['failures']})"
 
         return status_info
 
     def assign_sn_flasher(self, fastboot_sn):
-        # Assign a serial number (SN) to the flasher based on the provided list of fastboot SNs.
+        # Assign the first serial number (SN) of the provided list of fastboot SNs not assigned yet to the flasher.
         if isinstance(fastboot_sn, list):
-            new_fastboot_sn = [sn for sn in fastboot_sn if sn not in self.assigned_sn]
-            if len(new_fastboot_sn) > 1:
-                print("Error: Please do not connect more than one new fastboot device at the same time.")
-                print(f"Error: New fastboot devices: {new_fastboot_sn}")
-            self.assigned_sn.update(new_fastboot_sn)
-            return "".join(new_fastboot_sn) if new_fastboot_sn else None
+            with self.assigned_lock:
+                new_fastboot_sn = [sn for sn in fastboot_sn if sn not in self.assigned_sn]
+                if len(new_fastboot_sn) > 1:
+                    print(f"Warning: New fastboot devices: {new_fastboot_sn}, assigning {new_fastboot_sn[0]}")
+                if new_fastboot_sn:
+                    self.assigned_sn.add(new_fastboot_sn[0])
+                    return new_fastboot_sn[0]
         return None
 
+    def release(self, fastboot_sn):
+        # Forget the serial of a board done with, for the next one to use.
+        with self.assigned_lock:
+            self.assigned_sn.discard(fastboot_sn)
+
     def update_status_all(self):
-        # Continuously update the status of all workers and store the information in a JSON format.
+        # Apply the statuses the workers report as they come, waking
+        # whoever waits for a change.
         while True:
-            # Assign the updated status information to the corresponding worker.
-            while not self.queue.empty():
-                status_info_json_str = self.queue.get(block=True, timeout=None)
-                status_info_json = json.loads(status_info_json_str)
-                self.statuses[status_info_json['id']] = status_info_json
+            status = self.queue.get()
+            with self.status_changed:
+                self.statuses[status.id] = status
+                self.status_json = None
+                self.status_version += 1
+                self.status_changed.notify_all()
 
-            time.sleep(1)
+    def free_worker(self, unstarted=False):
+        # A worker done with its last board, or that never had one when
+        # unstarted, None when all are busy.
+        return next((worker for worker in self.workers
+                     if not worker.busy and not (unstarted and worker.is_alive())), None)
+
+    def can_start_worker(self, unstarted=False):
+        # Whether no worker is bootstrapping and one is free to start.
+        return (not any(worker.action in BOOTSTRAP_ACTIONS for worker in self.workers) and
+                self.free_worker(unstarted) is not None)
 
     def start_workers(self):
-        # Monitor and start workers when there are no previous workers in beginning states.
-        while True:
-            time.sleep(1)
-            if not any(worker.action in ["Starting", "Opening", "Jumping DA"] for worker in self.workers):
-                self.start_next_worker()
-
-    def start_next_worker(self):
-        # Start the next available worker if the time since the last start exceeds a threshold.
-        current_time = time.time()
-        if current_time - self.last_start_time >= 5:
-            for worker in self.workers:
-                if worker.action == "Stopped" and not worker.is_alive():
-                    worker.start()
-                    self.last_start_time = current_time
-                    return True
-        return False
+        # Start a worker for each board entering download mode as soon as
+        # it appears. Without udev, nothing tells that a new board is there:
+        # a free worker waits for the next one as soon as no other worker
+        # bootstraps its board. A dry run flashes nothing, each worker only
+        # runs once.
+        if not self.args.skip_bootstrap and device_registry.watch_bootrom(self.board_arrived, self.board_left):
+            self.dispatch_boards()
+            return
+        unstarted = self.args.dry_run
+        while not self.stopped.is_set():
+            if unstarted and self.free_worker(unstarted=True) is None:
+                return
+            with self.status_changed:
+                self.status_changed.wait_for(lambda: self.can_start_worker(unstarted) or self.stopped.is_set())
+            if not self.stopped.is_set():
+                self.start_next_worker(unstarted=unstarted)
+            self.stopped.wait(WORKER_START_INTERVAL)
+
+    def board_arrived(self, port):
+        # Queue a board in download mode on port, unless a worker has it.
+        with self.status_changed:
+            if port in self.pending_ports or any(worker.busy and worker.board_port == port for worker in self.workers):
+                return
+            self.pending_ports.append(port)
+            if self.free_worker() is None:
+                print(f"Board on USB port {port} waiting for a free worker")
+            self.status_changed.notify_all()
+
+    def board_left(self, port):
+        # Forget a queued board that left download mode before a worker
+        # took it, unplugged or reset.
+        with self.status_changed:
+            if port in self.pending_ports:
+                self.pending_ports.remove(port)
+                self.status_changed.notify_all()
+
+    def redispatch(self, port):
+        # Queue again, first in line, a board on port the worker it was
+        # given bootstrapped another board instead of.
+        with self.status_changed:
+            if port not in self.pending_ports:
+                self.pending_ports.insert(0, port)
+                self.status_changed.notify_all()
+
+    def dispatch_boards(self):
+        # Give each board in download mode to a free worker, in the order
+        # they arrived.
+        while not self.stopped.is_set():
+            with self.status_changed:
+                self.status_changed.wait_for(lambda: (self.pending_ports and self.free_worker() is not None) or
+                                             self.stopped.is_set())
+                if self.stopped.is_set():
+                    return
+                port = self.pending_ports.pop(0)
+                if device_registry.in_bootrom(port):
+                    self.start_next_worker(port)
+
+    def start_next_worker(self, port=None, unstarted=False):
+        # Start the next available worker, waiting for a board or flashing
+        # the one on USB port.
+        worker = self.free_worker(unstarted)
+        if worker is None:
+            return False
+        worker.assign(port)
+        self.queue.put(worker.get_status())
+        return True
 
     def handle_client_connection(self, client_socket):
-        # Handle incoming client connections and send the current status as a JSON response.
+        # Answer each status request of a client with the statuses, as
+        # soon as they differ from the last ones it got.
+        sent_version = None
         try:
-            while True:
-                with self.status_lock:
-                    status_json = json.dumps(self.statuses, indent=4)
-                response = f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: {len(status_json)}\r\n\r\n{status_json}"
-                client_socket.sendall(response.encode('utf-8'))
-                time.sleep(1)
+            while client_socket.recv(4096):
+                with self.status_changed:
+                    self.status_changed.wait_for(lambda: self.status_version != sent_version,
+                                                 timeout=STATUS_KEEPALIVE_SECONDS)
+                    if self.status_json is None:
+                        self.status_json = json.dumps([status.to_dict() for status in self.statuses],
+                                                      indent=4).encode('utf-8')
+                    status_json = self.status_json
+                    sent_version = self.status_version
+                header = f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: {len(status_json)}\r\n\r\n"
+                client_socket.sendall(header.encode('utf-8') + status_json)
         except (ConnectionAbortedError, ConnectionResetError):
             print("Client connection closed.")
         finally:
@@ -140,7 +245,6 @@ class GenioFlashDaemon:
     def run(self):
         # Run the main loop of the daemon, handling socket connections and worker management.
         # Do not call cleanup_aiot_tools() here. Leave this work to flash.py for avoiding incorrect kill.
-        self.assigned_sn = set()
 
         if self.args.verbose:
             print(f"Daemon PID {self.pid}")
@@ -149,14 +253,18 @@ class GenioFlashDaemon:
             self.start_socket_server(self.args.host, self.args.port)
 
         try:
-            while True:
-                time.sleep(1)
+            self.stopped.wait()
         except KeyboardInterrupt:
             print("Daemon shutting down...")
-            for event in self.events:
-                event.set()
-            for worker in self.workers:
-                worker.join()
+            self.stop()
+
+    def stop(self):
+        # Stop starting workers, and the idle ones.
+        self.stopped.set()
+        for worker in self.workers:
+            worker.stop()
+        with self.status_changed:
+            self.status_changed.notify_all()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,122 +2,250 @@
 # Copyright 2024 (c) MediaTek Inc.
 # Author: Macpaul Lin <macpaul.lin@mediatek.com>
 
-import json
 import logging
 import threading
 import time
 from queue import SimpleQueue
 
 import aiot
-from aiot.bootrom_log_parser import parse_log_line, bootrom_log_parser
+from aiot.events import WorkerStatus
+from aiot.timeout import Timeouts
+from aiot.verify import VerifyPolicy
+from aiot.worker_process import WorkerProcess
+
+# Put in the queue of a worker when its flasher is done with the board
+BOARD_DONE = object()
+# Put in the board queue of a worker to end it
+STOP_WORKER = object()
 
 class GenioFlashWorker(threading.Thread):
+    """
+    A daemon worker: flashes the boards the daemon assigns to it one after
+    the other, for as long as the daemon runs. Each board is flashed by a
+    new Flash in a thread of its own, whose events the worker turns into
+    status updates for the daemon.
+    """
+
     def __init__(self, id, image=None, args=None, daemon=None):
         super().__init__()
         self.args = args
         self.id = id
         self.action = "Stopped"
+        self.error = ""
         self.com_port = None
+        # USB port of the board dispatched to the worker, if any
+        self.board_port = None
+        # USB topology path of the board being flashed, once known
+        self.usb_port = None
         self.progress = None
+        self.partition = None
+        self.storage = None
+        self.da_version = None
+        self.verify = None
         self.image = image
         self.queue = SimpleQueue()
-        self.data_event = threading.Event()  # use threading.Event
+        # USB ports of the boards to flash, None when not known
+        self.boards = SimpleQueue()
+        self.busy = False
         self.logger = logging.getLogger('aiot')
         self.flasher = None
+        # WorkerProcess flashing the boards in process mode
+        self.process = None
+        self.fastboot_sn = None
         self.daemon = daemon
         self.first_erasing = True
         self.total_duration = None
         self.start_time = None
+        # boards flashed, failed, and total duration of the flashed ones
+        self.boards_done = 0
+        self.failures = 0
+        self.flash_time = 0.0
+
+    def assign(self, port=None):
+        # Give the worker its next board, on USB port when known.
+        self.reset_board_state()
+        self.board_port = port
+        self.usb_port = port
+        self.busy = True
+        self.action = "Waiting"
+        self.boards.put(port)
+        if not self.is_alive():
+            self.start()
+
+    def stop(self):
+        self.boards.put(STOP_WORKER)
 
     def run(self):
+        # Flash the assigned boards until stopped.
+        while True:
+            port = self.boards.get()
+            if port is STOP_WORKER:
+                self.stop_process()
+                return
+            try:
+                self.flash_board()
+            except Exception as e:
+                self.handle_general_error(e)
+            self.release_board()
+
+    def reset_board_state(self):
+        # Forget what the previous board left.
+        self.flasher = None
+        self.fastboot_sn = None
+        self.usb_port = None
+        self.error = ""
+        self.com_port = None
+        self.progress = None
+        self.partition = None
+        self.storage = None
+        self.da_version = None
+        self.verify = None
+        self.first_erasing = True
+        self.total_duration = None
+        self.start_time = None
+
+    def flash_board(self):
+        # Flash the assigned board, in the worker process in process mode.
+        if self.args.worker_mode == 'process':
+            flashed = self.flash_in_process()
+        else:
+            flashed = self.flash_in_thread()
+        self.count_board(flashed)
+
+    def flash_in_thread(self):
         from aiot.flash import Flash
+        self.flasher = Flash(image=self.image, dry_run=self.args.dry_run, daemon=self.daemon, verbose=self.args.verbose, queue=self.queue, skip_erase=self.args.skip_erase, native=self.args.fastboot_usb, timeouts=Timeouts.from_args(self.args), delta=self.args.delta, resume=self.args.resume, verify=VerifyPolicy.from_args(self.args), plan=self.daemon.plan, board_port=self.board_port)
+        outcome = []
+
+        def flash():
+            try:
+                outcome.append(self.flasher.flash_worker(self.image, self.args, self.queue))
+            except Exception as e:
+                self.logger.error(f"Worker {self.id}: {e}")
+            finally:
+                self.queue.put(BOARD_DONE)
+
         # Start the flasher thread
-        self.flasher = Flash(image=self.image, dry_run=self.args.dry_run, daemon=self.daemon, verbose=self.args.verbose, queue=self.queue, data_event=self.data_event)
-        flasher_thread = threading.Thread(target=self.flasher.flash_worker, args=(self.image, self.args, self.queue, self.data_event))
+        flasher_thread = threading.Thread(target=flash)
         flasher_thread.start()
 
-        # Monitor thread logic
+        # Monitor thread logic, woken by each event of the flasher
+        while True:
+            event = self.queue.get()
+            if event is BOARD_DONE:
+                break
+            self.handle_event(event)
+
+        flasher_thread.join()
+        return bool(outcome and outcome[0])
+
+    def flash_in_process(self):
+        # The worker process is started with the first board and kept for
+        # the next ones, unless it dies.
+        if self.process is None:
+            self.process = WorkerProcess(f"genio-flash-worker-{self.id}", self.image, self.args,
+                                         self.daemon.plan, self.daemon.open_lock)
         try:
-            while True:
-                self.data_event.wait()
-
-                while not self.queue.empty():
-                    json_input = self.queue.get(timeout=2)
-                    data = json.loads(json_input)
-
-                    # Update worker's attributes
-                    for key in ["action", "com_port", "progress", "partition", "error"]:
-                        if key in data:
-                            setattr(self, key, data[key])
-
-                    # Log based on action and error
-                    log_message = self.format_log_message(data)
-                    self.log_based_on_action(log_message, data)
-
-                    # Notify flash daemon to update status
-                    status_info_json_str = self.get_status_json()
-                    self.daemon.queue.put(status_info_json_str)
-
-                self.data_event.clear()
-
-        except json.JSONDecodeError:
-            self.handle_json_decode_error()
-        except Exception as e:
-            self.handle_general_error(e)
-
-    def get_status_json(self):
-        # Generate a JSON representation of the current status of the worker.
-        status_info = {
-            "id": self.id,
-            "action": self.action,
-            "error": "",
-            "com_port": self.com_port if self.action not in ["Starting"] else None,
-            "fastboot_sn": self.flasher.fastboot_sn if self.action not in ["Starting"] else None,
-            "progress": self.progress if self.action not in ["Starting"] else None,
-            "duration": None
-        }
+            return self.process.flash(self.board_port, self.handle_event, self.daemon)
+        except (EOFError, OSError) as e:
+            self.logger.error(f"Worker {self.id}: worker process lost ({e or 'exited'})")
+            self.stop_process()
+            return False
+
+    def stop_process(self):
+        if self.process is not None:
+            self.process.stop()
+            self.process = None
+
+    def handle_event(self, event):
+        # Update worker's attributes
+        for key in ["action", "com_port", "usb_port", "fastboot_sn", "progress", "partition", "error", "storage", "da_version", "verify"]:
+            value = getattr(event, key, None)
+            if value is not None:
+                setattr(self, key, value)
+
+        # Log based on action and error
+        log_message = self.format_log_message(event)
+        self.log_based_on_action(log_message, event)
+
+        # Notify flash daemon to update status
+        self.daemon.queue.put(self.get_status())
+
+    def count_board(self, flashed):
+        # Update the counters with the outcome of the board.
+        if flashed:
+            self.boards_done += 1
+            self.flash_time += self.total_duration or 0.0
+            self.action = "done"
+        else:
+            self.failures += 1
+            if not self.action.startswith("Error"):
+                self.action = "failed"
+        self.logger.info(f"Worker {self.id}: board {self.action}, {self.boards_done} flashed, "
+                         f"{self.failures} failed")
+
+    def release_board(self):
+        # Free the serial of the board and become available for the next.
+        self.daemon.release(self.fastboot_sn)
+        self.board_port = None
+        self.busy = False
+        self.daemon.queue.put(self.get_status())
+
+    def get_status(self):
+        # Generate a WorkerStatus describing the current status of the worker.
+        fastboot_sn = self.fastboot_sn
+        status_info = WorkerStatus(
+            id=self.id,
+            action=self.action,
+            error="",
+            com_port=self.com_port if self.action not in ["Starting"] else None,
+            usb_port=self.usb_port,
+            fastboot_sn=fastboot_sn if self.action not in ["Starting"] else None,
+            progress=self.progress if self.action not in ["Starting"] else None,
+            storage=self.storage if self.action not in ["Starting"] else None,
+            da_version=self.da_version if self.action not in ["Starting"] else None,
+            verify=self.verify if self.action not in ["Starting"] else None,
+        )
+        if self.boards_done or self.failures:
+            status_info.boards = self.boards_done
+            status_info.failures = self.failures
+        if self.boards_done:
+            status_info.average_duration = f"{round(self.flash_time / self.boards_done, 2)}s"
 
         if self.action == "Jumping DA":
             self.start_time = time.time()
 
         if self.action == "Starting" and self.error:
-            status_info["error"] = self.error
+            status_info.error = self.error
             self.error = ""
 
-        if self.action not in ["Starting", "rebooting", "done"] and self.start_time is not None:
+        if self.action not in ["Starting", "rebooting", "done", "failed"] and self.start_time is not None:
             self.total_duration = round(time.time() - self.start_time, 2)
-            status_info["duration"] = f"{self.total_duration}s"
-        elif self.action == "rebooting":
-            status_info["duration"] = f"{self.total_duration}s"
-            if self.flasher.fastboot_sn in self.daemon.assigned_sn:
-                self.daemon.assigned_sn.discard(self.flasher.fastboot_sn)
-
-        # Remove keys with None values
-        return json.dumps({k: v for k, v in status_info.items() if v is not None}, indent=4)
-
-    def format_log_message(self, data):
-        # Format the log message for the worker based on its attributes and data.
-        data_str = ', '.join(f'{key}: "{value}"' if key == 'error' else f'{key}: {value}' for key, value in data.items())
+            status_info.duration = f"{self.total_duration}s"
+        elif self.action in ["rebooting", "done", "failed"]:
+            if self.total_duration is not None:
+                status_info.duration = f"{self.total_duration}s"
+
+        return status_info
+
+    def format_log_message(self, event):
+        # Format the log message for the worker based on its attributes and the event.
+        data_str = ', '.join(f'{key}: "{value}"' if key == 'error' else f'{key}: {value}' for key, value in event.to_dict().items())
         log_prefix = f"Worker {self.id}, " if self.args.verbose else f"Worker {self.id}, "
-        return f"{log_prefix}{self.com_port}, {self.flasher.fastboot_sn}, {{{data_str}}}"
+        return f"{log_prefix}{self.com_port}, {self.fastboot_sn}, {{{data_str}}}"
 
-    def log_based_on_action(self, log_message, data):
+    def log_based_on_action(self, log_message, event):
         # Log messages based on the current action of the worker.
         if self.action in ["Starting", "Jumping DA", "rebooting", "done"]:
             self.logger.info(log_message)
         elif not self.args.verbose and self.action == "erasing" and self.first_erasing:
             self.logger.info(f"{log_message} flashing...")
             self.first_erasing = False
-        elif 'error' in data:
+        elif getattr(event, 'error', None) is not None:
             self.logger.warning(log_message)
         else:
             self.logger.debug(log_message)
 
-    def handle_json_decode_error(self):
-        # Handle JSON decoding errors by setting the worker's action to 'Error'.
-        self.action = "Error"
-        self.logger.error("Failed to decode JSON output")
-
     def handle_general_error(self, error):
         # Handle general errors by logging the error message.
         self.action = "Error"
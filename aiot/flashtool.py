@@ -12,8 +12,12 @@ import aiot.image
 
 from aiot.bootrom import add_bootstrap_group
 from aiot.bootrom import run_bootrom
+from aiot.cache import DEFAULT_CACHE_SIZE, artifact_cache
 from aiot.flash_daemon import GenioFlashDaemon
-from aiot.flash_worker import bootrom_log_parser
+from aiot.index import build_index, load_index
+from aiot.timeout import Timeouts
+from aiot.verify import DEFAULT_SAMPLE_BLOCKS, VERIFY_MODES, VerifyPolicy
+from aiot.worker_process import WORKER_MODES
 from collections import OrderedDict
 
 
@@ -30,6 +34,16 @@ images = OrderedDict([
     ('Raw', aiot.image.RawImage), 
 ])
 
+def detect_image(args):
+    # Return the image found in args.path, None when no image type matches.
+    for name, img in images.items():
+        logging.getLogger('aiot').debug(f"Detecting image type: {name}")
+        if img.detect(args.path):
+            image = img(args)
+            load_index(args.path)
+            return image
+    return None
+
 app_description = """
     Genio flashing tool
 
@@ -70,12 +84,36 @@ class FlashTool(aiot.App):
 
     def setup_parser(self):
         # Setup command line argument parser.
-        self.parser.add_argument('targets', type=str, nargs='*', help='Name of the partition or group of partition to flash')
+        self.parser.add_argument('targets', type=str, nargs='*', help='Name of the partition or group of partition to flash, or `index` to write the index (genio-index.json) of the image files')
         self.parser.add_argument('--dry-run', action="store_true")
         self.parser.add_argument('--skip-erase', action="store_true",
             help='Skip erasing partitions before flash')
+        self.parser.add_argument('--fastboot-usb', action="store_true",
+            help='Use the built-in USB fastboot client instead of the fastboot binary')
+        self.parser.add_argument('--delta', action="store_true",
+            help='Only send the blocks that differ from the device contents, flashed partitions are not erased. '
+                 'Requires --fastboot-usb')
+        self.parser.add_argument('--resume', action="store_true",
+            help='Continue an interrupted flash of the same image from its first unfinished action, '
+                 'skipping bootstrap when the board is still in fastboot mode')
+        self.parser.add_argument('--verify', choices=VERIFY_MODES,
+            help='Read the flashed partitions back before rebooting and compare them with the image, '
+                 'all their blocks (full) or a random sample of them (sample). Requires --fastboot-usb')
+        self.parser.add_argument('--verify-blocks', type=int, default=DEFAULT_SAMPLE_BLOCKS, metavar="N",
+            help='Blocks of 1 MiB read back per partition with --verify sample')
+        self.parser.add_argument('--verify-boards', type=float, default=1.0, metavar="RATIO",
+            help='Fraction of the boards verified, picked at random, e.g. 0.1 for one board in ten')
+        self.parser.add_argument('--cache-size', type=int, metavar="MIB",
+            help=f'Disk space in MiB of the cache of converted and generated images, {DEFAULT_CACHE_SIZE // (1024 * 1024)} '
+                 'by default, 0 disables it. Giving it also caches the images decompressed while flashing')
+        self.parser.add_argument('--timeout', action="append", metavar="STAGE=DEADLINE[:INACTIVITY]",
+            help='Override the time limits in seconds of a stage (bootstrap, erase, partition, reboot, command), '
+                 'INACTIVITY being the longest time without output, unlimited by default for bootstrap and '
+                 'partition, 0 disables a limit. e.g. `--timeout partition=900:30`')
         self.parser.add_argument('--daemon', action="store_true", help="Run as a daemon")
         self.parser.add_argument('--workers', type=int, default=2, help='Number of workers in daemon mode')
+        self.parser.add_argument('--worker-mode', choices=WORKER_MODES, default='thread',
+                                 help='Flash with daemon worker threads, or worker processes (default: thread)')
         self.parser.add_argument('--host', type=str, default='localhost', help='Daemon host address')
         self.parser.add_argument('--port', type=int, help='Socket port for daemon mode')
 
@@ -101,6 +139,15 @@ class FlashTool(aiot.App):
     def execute(self):
         # Execute the flashing process based on parsed arguments.
         args = super().execute()
+        try:
+            Timeouts.from_args(args)
+            VerifyPolicy.from_args(args)
+        except ValueError as e:
+            self.logger.error(str(e))
+            return
+        if args.cache_size is not None:
+            artifact_cache.configure(max_size=args.cache_size * 1024 * 1024, streams=True)
+
         image = self.detect_image(args)
 
         if image is None:
@@ -109,20 +156,28 @@ class FlashTool(aiot.App):
 
         print(image)
 
+        if self.is_index_command(image, args):
+            image_type = next(name for name, img in images.items() if isinstance(image, img))
+            index = build_index(image, image_type)
+            print(f"Indexed {len(index.files)} files in {index.directory}")
+            return
+
         if args.daemon:
             self.run_daemon(image, args)
         else:
             self.run_worker(image, args)
 
+    def is_index_command(self, image, args):
+        # `genio-flash index`, unless the image has a target named index.
+        return (args.targets == ['index'] and 'index' not in image.partitions and
+                'index' not in image.groups)
+
     def detect_image(self, args):
         # Detect the appropriate image based on the provided path.
-        for name, img in images.items():
-            self.logger.debug(f"Detecting image type: {name}")
-            if img.detect(args.path):
-                image = img(args)
-                image.setup_local_parser()
-                return image
-        return None
+        image = detect_image(args)
+        if image is not None:
+            image.setup_local_parser()
+        return image
 
     def run_daemon(self, image, args):
         # Starts the daemon process and worker threads.
@@ -141,7 +196,7 @@ class FlashTool(aiot.App):
         # Run the flashing process in worker mode.
         # Note: We need to initialize the Flash class before calling `worker_thread` to avoid creating two instances in a single process.
         from aiot.flash import Flash
-        flasher = Flash(image=image, dry_run=args.dry_run, daemon=False, verbose=args.verbose, skip_erase=args.skip_erase)
+        flasher = Flash(image=image, dry_run=args.dry_run, daemon=False, verbose=args.verbose, skip_erase=args.skip_erase, native=args.fastboot_usb, timeouts=Timeouts.from_args(args), delta=args.delta, resume=args.resume, verify=VerifyPolicy.from_args(args))
         flasher.flash_worker(image=image, args=args)
 
 def main():
@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import logging
+import struct
+import zlib
+
+GPT_SIGNATURE = b'EFI PART'
+GPT_HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+GPT_ENTRY = struct.Struct("<16s16sQQQ72s")
+
+# eMMC images use 512 bytes sectors, UFS LUs 4096 bytes sectors
+SECTOR_SIZES = (512, 4096)
+
+class GptPartition:
+    __slots__ = ('name', 'first_lba', 'last_lba')
+
+    def __init__(self, name, first_lba, last_lba):
+        self.name = name
+        self.first_lba = first_lba
+        self.last_lba = last_lba
+
+class GptImage:
+    """
+    Primary GUID partition table of a full-disk image.
+    """
+
+    def __init__(self, fp, sector_size, header):
+        self.logger = logging.getLogger('aiot')
+        (_, _, _, _, _, _, self.backup_lba, self.first_usable_lba,
+         self.last_usable_lba, _, entries_lba, num_entries, entry_size, _) = header
+        self.sector_size = sector_size
+        self.partitions = []
+
+        fp.seek(entries_lba * sector_size)
+        entries = fp.read(num_entries * entry_size)
+        for i in range(len(entries) // entry_size):
+            (type_guid, _, first_lba, last_lba, _, name) = GPT_ENTRY.unpack_from(entries, i * entry_size)
+            if type_guid == bytes(16) or last_lba < first_lba:
+                continue
+            name = name.decode('utf-16-le', errors='replace').rstrip('\0')
+            self.partitions.append(GptPartition(name, first_lba, last_lba))
+        self.partitions.sort(key=lambda p: p.first_lba)
+
+    @classmethod
+    def open(cls, fp):
+        # Return the partition table of the image, or None if it has no valid GPT.
+        for sector_size in SECTOR_SIZES:
+            fp.seek(sector_size)
+            data = fp.read(GPT_HEADER.size)
+            if len(data) < GPT_HEADER.size or not data.startswith(GPT_SIGNATURE):
+                continue
+
+            header = GPT_HEADER.unpack(data)
+            header_size, header_crc = header[2], header[3]
+            fp.seek(sector_size)
+            raw = bytearray(fp.read(header_size))
+            raw[16:20] = bytes(4)
+            if zlib.crc32(raw) != header_crc:
+                logging.getLogger('aiot').debug(f"gpt: bad header CRC with {sector_size} bytes sectors")
+                continue
+
+            return cls(fp, sector_size, header)
+        return None
+
+    def metadata_ranges(self, size):
+        # (offset, length) of the protective MBR, the primary and the backup
+        # GPT, limited to the first `size` bytes of the disk.
+        ranges = [(0, self.first_usable_lba * self.sector_size)]
+        backup_start = (self.last_usable_lba + 1) * self.sector_size
+        backup_end = (self.backup_lba + 1) * self.sector_size
+        if backup_start < size and backup_end > backup_start:
+            ranges.append((backup_start, min(backup_end, size) - backup_start))
+        return ranges
+
+    def partition_ranges(self, size):
+        # Yield (partition, offset, length) of every partition, limited to
+        # the first `size` bytes of the disk.
+        for partition in self.partitions:
+            offset = partition.first_lba * self.sector_size
+            end = min((partition.last_lba + 1) * self.sector_size, size)
+            if offset < end:
+                yield partition, offset, end - offset
@@ -9,6 +9,7 @@ import argparse
 import logging
 
 import aiot
+from aiot.compression import resolve
 
 class AndroidImage:
     def __init__(self, args):
@@ -40,10 +41,10 @@ class AndroidImage:
                 partition = partitions[name]
                 if 'file' in partition:
                     ignore_file_not_found = partition.get('ignoreFileNotFound', False)
-                    file_path = Path(self.path) / partition['file']
+                    file_path = resolve(Path(self.path) / partition['file'])
                     if file_path.exists():
                         self.groups["all"]["flash"].append(name)
-                        self.partitions[name] = partition['file']
+                        self.partitions[name] = str(Path(partition['file']).with_name(file_path.name))
                     elif ignore_file_not_found:
                         logging.warning(f"{file_path} not found for {name} but is ignorable. Skipping ...")
                     else:
@@ -16,6 +16,7 @@ import traceback
 import argparse
 
 import aiot
+from aiot.compression import resolve_partitions
 
 class BootFirmwareImage:
     def __init__(self, args):
@@ -63,6 +64,7 @@ class BootFirmwareImage:
                 if not self.partitions[partition]:
                     if partition == "mmc0":
                         self.partitions[partition] = f"{self.name}-{self.machine}.wic.img"
+            resolve_partitions(self.path, self.partitions)
 
             if 'groups' in data:
                 self.groups = data['groups']
@@ -17,6 +17,7 @@ import argparse
 from pathlib import Path
 
 import aiot
+from aiot.compression import resolve, resolve_partitions
 
 class RawImage:
     def __init__(self, args):
@@ -28,6 +29,8 @@ class RawImage:
         self.tools_cfg = []
         self.groups = []
         self.partitions = []
+        # storage the image is made for, when the layout tells
+        self.storage = None
         self.uboot_env_size = args.uboot_env_size if args.uboot_env_size else 4096
         self.uboot_env_redund_offset = 0x100000 if args.uboot_env_redund_offset == -1 else args.uboot_env_redund_offset
         self.logger = logging.getLogger('aiot')
@@ -35,13 +38,17 @@ class RawImage:
         self.load_config()
 
     def load_config(self):
+        loaded = False
         if type(self).detect_json(self.path):
-            return self.load_config_from_json()
+            loaded = self.load_config_from_json()
         elif type(self).detect_emmc(self.path):
-            return self.default_config_emmc()
+            loaded = self.default_config_emmc()
         elif type(self).detect_ufs(self.path):
-            return self.default_config_ufs()
-        return False
+            loaded = self.default_config_ufs()
+
+        if loaded:
+            resolve_partitions(self.path, self.partitions)
+        return loaded
 
     @classmethod
     def detect_json(cls, path):
@@ -82,12 +89,13 @@ class RawImage:
             path / "mmc0boot1.bin",
         ]
 
-        # every default file must exist to be valid
-        return all([f.exists() for f in emmc_default_files])
+        # every default file must exist to be valid, possibly compressed
+        return all([resolve(f).exists() for f in emmc_default_files])
 
     def default_config_emmc(self):
         self.name = "Sparse Image"
         self.description = "eMMC Disk Image"
+        self.storage = "emmc"
         self.machine = "Unspecified"
         self.partitions = {
             "mmc0": "mmc0.bin",
@@ -118,12 +126,13 @@ class RawImage:
             path / "ufs_lu0_lu1.bin",
         ]
 
-        # every default file must exist to be valid
-        return all([f.exists() for f in ufs_default_files])
+        # every default file must exist to be valid, possibly compressed
+        return all([resolve(f).exists() for f in ufs_default_files])
 
     def default_config_ufs(self):
         self.name = "Sparse Image"
         self.description = "UFS Disk Image"
+        self.storage = "ufs"
         self.machine = "Unspecified"
 
         # Caveat: the download agent (lk.bin) reports UFS paritions
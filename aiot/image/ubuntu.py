@@ -15,6 +15,7 @@ import sys
 import argparse
 
 import aiot
+from aiot.compression import resolve_partitions
 
 class UbuntuImage:
     def __init__(self, args):
@@ -109,6 +110,7 @@ class UbuntuImage:
                 # The filename is hard-coded.
                 if partition == "mmc0boot1":
                     self.partitions[partition] = "u-boot-env.bin"
+            resolve_partitions(self.path, self.partitions)
 
             if 'groups' in data:
                 self.groups = data['groups']
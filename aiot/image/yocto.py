@@ -17,6 +17,7 @@ import traceback
 import argparse
 
 import aiot
+from aiot.compression import resolve_partitions
 
 class YoctoImage:
     def __init__(self, args):
@@ -212,6 +213,8 @@ class YoctoImage:
                 elif partition == "modules":
                     self.partitions[partition] = f"modules-{machine}{image_suffix}.modimg.ext4"
 
+        resolve_partitions(path, self.partitions)
+
     def detect_uboot_env_size(self):
         '''
         IoT Yocto v22.x - v24.0 is default to 4KiB (0x1000) env size.
@@ -0,0 +1,170 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from aiot.compression import is_compressed, resolve
+
+INDEX_NAME = 'genio-index.json'
+INDEX_VERSION = 1
+# Size of the blocks hashed separately, the delta flashing block size
+INDEX_CHUNK_SIZE = 1024 * 1024
+
+def chunk_digest(data):
+    # hashlib releases the GIL on large buffers, chunks hash in parallel
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(path, executor, chunk_size=INDEX_CHUNK_SIZE, workers=1):
+    """
+    Return the hex SHA-256 of the file at path and of each of its
+    chunk_size chunks. Chunks are hashed by executor while the full hash
+    is computed here, a bounded number of chunks ahead.
+    """
+    full = hashlib.sha256()
+    digests = []
+    pending = collections.deque()
+    with open(path, 'rb') as fp:
+        for data in iter(lambda: fp.read(chunk_size), b''):
+            pending.append(executor.submit(chunk_digest, data))
+            full.update(data)
+            while len(pending) > 2 * workers:
+                digests.append(pending.popleft().result())
+    digests += [future.result() for future in pending]
+    return full.hexdigest(), digests
+
+class ImageIndex:
+    """
+    Sidecar of an image directory written by `genio-flash index`: size,
+    modification time and SHA-256 of each image file and, for raw images,
+    the SHA-256 of each INDEX_CHUNK_SIZE chunk and the sparse layout the
+    scan finds. An entry only applies while the size and modification
+    time of its file are unchanged.
+    """
+
+    def __init__(self, directory, data):
+        self.directory = os.path.realpath(directory)
+        self.data = data
+        self.files = data.get('files', {})
+
+    @classmethod
+    def load(cls, directory):
+        path = os.path.join(directory, INDEX_NAME)
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.getLogger('aiot').warning(f"Ignoring unreadable image index {path}: {e}")
+            return None
+        if data.get('version') != INDEX_VERSION or data.get('chunk_size') != INDEX_CHUNK_SIZE:
+            logging.getLogger('aiot').warning(f"Ignoring image index {path} of unsupported version")
+            return None
+        return cls(directory, data)
+
+    def name(self, path):
+        # Name of path in the index, None when outside of its directory.
+        name = os.path.relpath(os.path.realpath(path), self.directory)
+        if name.startswith(os.pardir + os.sep) or name == os.pardir:
+            return None
+        return pathlib.PurePath(name).as_posix()
+
+    def entry(self, path):
+        # Entry of path, None when not indexed or changed since.
+        name = self.name(path)
+        entry = self.files.get(name) if name else None
+        if entry is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != entry['size'] or st.st_mtime_ns != entry['mtime_ns']:
+            logging.getLogger('aiot').debug(f"{path} changed since indexed, index entry ignored")
+            return None
+        return entry
+
+def index_files(image):
+    # Image files to index: the existing files of the partitions, except
+    # the ones generated at flash time.
+    from aiot.plan import GENERATED_FILES
+
+    files = set()
+    for filename in image.partitions.values():
+        if not filename or os.path.basename(filename) in GENERATED_FILES:
+            continue
+        path = resolve(pathlib.Path(image.path) / filename)
+        if path.is_file():
+            files.add(str(path))
+    return sorted(files)
+
+def file_entry(path, executor, workers):
+    from aiot.sparse import SparseImage
+
+    st = os.stat(path)
+    sha256, chunks = hash_file(path, executor, workers=workers)
+    entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha256}
+    if not is_compressed(path) and not SparseImage.is_sparse(path):
+        entry['chunks'] = chunks
+        entry['layout'] = SparseImage.from_file(path, scan=True).layout()
+    return entry
+
+def build_index(image, image_type, jobs=None):
+    """
+    Write the index of the files of image to its directory, replacing
+    any previous one atomically. Return the ImageIndex.
+    """
+    logger = logging.getLogger('aiot')
+    workers = jobs or os.cpu_count() or 1
+    index = ImageIndex(image.path, {'version': INDEX_VERSION, 'type': image_type,
+                                    'chunk_size': INDEX_CHUNK_SIZE, 'files': {}})
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='index') as executor:
+        for path in index_files(image):
+            logger.info(f"Indexing {path}")
+            index.files[index.name(path)] = file_entry(path, executor, workers)
+
+    fd, temp = tempfile.mkstemp(dir=image.path, prefix='.genio-index-')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(index.data, fp)
+        os.chmod(temp, 0o644)
+        os.replace(temp, os.path.join(image.path, INDEX_NAME))
+    except OSError:
+        os.remove(temp)
+        raise
+    register_index(index)
+    return index
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def register_index(index):
+    with _indexes_lock:
+        _indexes[index.directory] = index
+
+def load_index(directory):
+    # Load the index of an image directory, if any, for index_entry_of().
+    index = ImageIndex.load(directory)
+    if index is not None:
+        logging.getLogger('aiot').debug(f"Using image index of {directory}, {len(index.files)} files")
+        register_index(index)
+    return index
+
+def index_entry_of(path):
+    # Index entry of a file of a loaded image, None when there is none
+    # or it is stale.
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        entry = index.entry(path)
+        if entry is not None:
+            return entry
+    return None
@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+
+from aiot.cache import cache_directory
+from aiot.index import index_entry_of
+from aiot.plan import GENERATED_FILES
+
+def plan_fingerprint(plan):
+    """
+    Identify the content a plan flashes: its steps and the SHA-256 of
+    each file when the image is indexed, else its size and modification
+    time. Files generated while flashing are only identified by name,
+    they are written again on every run.
+    """
+    steps = []
+    for step in plan.steps():
+        entry = [step.action, step.partition, step.filename]
+        if step.path is not None and os.path.basename(step.filename) not in GENERATED_FILES:
+            indexed = index_entry_of(step.path)
+            if indexed is not None:
+                entry.append(indexed['sha256'])
+            else:
+                try:
+                    stat = os.stat(step.path)
+                    entry += [os.path.realpath(step.path), stat.st_size, stat.st_mtime_ns]
+                except OSError:
+                    entry.append(None)
+        steps.append(entry)
+    return hashlib.sha256(json.dumps(steps).encode()).hexdigest()
+
+def step_id(step):
+    # Name of a plan step in the journal, unique within the plan.
+    return f"{step.index}:{step.action}:{step.partition}"
+
+class FlashJournal:
+    """
+    The actions finished on a board for a flash plan, kept on disk so that
+    an interrupted flash can resume where it stopped. A journal only
+    applies to the plan with the same fingerprint, and is removed once
+    the board has been flashed and rebooted.
+    """
+
+    def __init__(self, board, fingerprint, directory=None):
+        self.logger = logging.getLogger('aiot')
+        self.board = board
+        self.fingerprint = fingerprint
+        self.directory = directory or cache_directory('journal')
+        self.done = []
+
+    @staticmethod
+    def any_left(directory=None):
+        # Whether a journal of any board is left on disk.
+        try:
+            return any(name.endswith('.json') for name in os.listdir(directory or cache_directory('journal')))
+        except OSError:
+            return False
+
+    @property
+    def path(self):
+        name = re.sub(r'[^A-Za-z0-9._-]', '_', self.board)
+        return os.path.join(self.directory, f"{name}.json")
+
+    def load(self):
+        # Read the actions already done for this plan, return how many.
+        self.done = []
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Ignoring unreadable flash journal {self.path}: {e}")
+            return 0
+
+        if data.get('board') == self.board and data.get('image') == self.fingerprint:
+            self.done = list(data.get('done', []))
+        return len(self.done)
+
+    def is_done(self, action):
+        return action in self.done
+
+    def record(self, action):
+        # Add a finished action, replacing the file atomically so that an
+        # interruption leaves either the previous or the new journal.
+        if action in self.done:
+            return
+        self.done.append(action)
+        self.save()
+
+    def forget(self, action):
+        # Mark a recorded action as to be done again.
+        if action in self.done:
+            self.done.remove(action)
+            self.save()
+
+    def save(self):
+        data = {'board': self.board, 'image': self.fingerprint, 'done': self.done}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=self.directory, prefix='.journal-')
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(data, fp)
+            os.replace(temp, self.path)
+        except OSError as e:
+            self.logger.warning(f"Cannot write flash journal {self.path}: {e}")
+
+    def reset(self):
+        # Forget every action, the board is flashed from the start.
+        self.done = []
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.warning(f"Cannot remove flash journal {self.path}: {e}")
@@ -48,12 +48,14 @@ def status_json_to_info(status_info_json_str):
         status_info += f": {status_info_json['error']}"
 
     if status_info_json["action"] != 'Starting':
-        for key in ["com_port", "fastboot_sn", "progress", "duration"]:
+        for key in ["com_port", "usb_port", "fastboot_sn", "progress", "duration", "boards", "failures", "average_duration"]:
             if key in status_info_json:
                 if key == "fastboot_sn":
                     status_info += f" (SN: {status_info_json[key]})"
                 elif key == "com_port":
                     status_info += f" (COM Port: {status_info_json[key]})"
+                elif key == "usb_port":
+                    status_info += f" (USB Port: {status_info_json[key]})"
                 else:
                     status_info += f" ({key.replace('_', ' ').title()}: {status_info_json[key]})"
 
@@ -126,7 +128,6 @@ def tui_main(stdscr, args):
             update_status_display_tui(stdscr, json_data)
 
             stdscr.refresh()
-            time.sleep(1)
     except KeyboardInterrupt:
         exit_program = True  # Ctrl-C to quit
     finally:
@@ -194,9 +195,8 @@ def main():
                 except json.JSONDecodeError:
                     continue  # Skip this iteration if JSON is invalid
 
+                # the daemon answers the next request on a status change
                 update_status_display(json_data)
-
-                time.sleep(1)
         except KeyboardInterrupt:
             exit_program = True  # Ctrl-C to quit
         finally:
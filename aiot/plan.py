@@ -0,0 +1,200 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import os
+import pathlib
+
+from aiot.compression import is_compressed, resolve
+from aiot.sparse import image_cache, image_size
+
+# Rough rates and durations the estimates are based on
+USB_BYTES_PER_SECOND = 35 * 1024 * 1024
+WRITE_BYTES_PER_SECOND = 60 * 1024 * 1024
+ERASE_SECONDS = 5.0
+BOOTSTRAP_SECONDS = 5.0
+REBOOT_SECONDS = 1.0
+
+# Files generated by the image when flashed, not there beforehand
+GENERATED_FILES = ('u-boot-env.bin',)
+
+def format_size(size):
+    if size is None:
+        return "unknown size"
+    if size < 1024:
+        return f"{size} B"
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024
+        if size < 1024 or unit == 'GiB':
+            return f"{size:.1f} {unit}"
+
+class PlanStep:
+    """
+    An erase or flash of a partition. For flashes, size is what the
+    partition receives and send_size what goes over USB, None when
+    unknown. Steps flashing the same file share the upload of the first
+    one. index is the position of the step in its plan.
+    """
+    __slots__ = ('action', 'partition', 'filename', 'path', 'size', 'send_size', 'upload', 'index')
+
+    def __init__(self, action, partition, filename=None, path=None):
+        self.action = action
+        self.partition = partition
+        self.filename = filename
+        self.path = path
+        self.size = None
+        self.send_size = None
+        self.upload = None
+        self.index = None
+
+    def duration(self):
+        # Estimated seconds the step takes.
+        if self.action == 'erase':
+            return ERASE_SECONDS
+        duration = (self.send_size or 0) / USB_BYTES_PER_SECOND
+        return duration + (self.size or 0) / WRITE_BYTES_PER_SECOND
+
+    def __str__(self):
+        if self.action == 'erase':
+            return f"erase {self.partition}"
+        text = f"flash {self.partition} <- {self.filename} ({format_size(self.size)}"
+        if self.send_size is not None and self.send_size != self.size:
+            text += f", sends {format_size(self.send_size)}"
+        if self.upload is not None:
+            text += f", same file as {self.upload.partition}"
+        return text + f") ~{self.duration():.1f}s"
+
+class PlanTarget:
+    # A target of the command line: a group, or a single partition.
+
+    def __init__(self, name, group=False):
+        self.name = name
+        self.group = group
+        self.erase = []
+        self.flash = []
+        self.erase_after_flash = []
+        # partitions whose erase is kept even when redundant, True for all
+        self.force_erase = False
+
+    def steps(self):
+        return self.erase + self.flash + self.erase_after_flash
+
+class FlashPlan:
+    """
+    The actions flashing targets takes, with every file checked once and
+    sized. Decisions depending on the device, such as skipping redundant
+    erases, are left to the time it is flashed, so that a plan can be
+    shared by all the workers of the daemon.
+    """
+
+    def __init__(self, targets):
+        # targets as requested, before "all" is implied
+        self.requested = list(targets)
+        self.targets = []
+        self.errors = []
+
+    def steps(self):
+        for target in self.targets:
+            yield from target.steps()
+
+    def stage_durations(self):
+        # Estimated seconds of each stage.
+        durations = {'bootstrap': BOOTSTRAP_SECONDS, 'erase': 0.0, 'flash': 0.0}
+        for step in self.steps():
+            durations[step.action] += step.duration()
+        durations['reboot'] = REBOOT_SECONDS
+        return durations
+
+    def __str__(self):
+        lines = ["Flash plan:"]
+        for target in self.targets:
+            lines.append(f"  {target.name}:")
+            lines += [f"    {step}" for step in target.steps()]
+        lines.append("  reboot")
+        durations = self.stage_durations()
+        lines.append("Estimated time: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in durations.items()) +
+                     f", total {sum(durations.values()):.1f}s")
+        return "\n".join(lines)
+
+class PlanCompiler:
+    # Turn targets into a FlashPlan for an image.
+
+    def __init__(self, image, native=False, skip_erase=False):
+        self.img = image
+        self.native = native
+        self.skip_erase = skip_erase
+        # flash steps by resolved file, to size each file once
+        self.uploads = {}
+
+    def flash_step(self, plan, partition, filename):
+        path = resolve(pathlib.Path(self.img.path) / filename)
+        step = PlanStep('flash', partition, filename, path)
+        if os.path.basename(filename) in GENERATED_FILES:
+            return step
+
+        if not path.exists():
+            plan.errors.append(f"The binary file '{path}' for partition '{partition}' doesn't exist")
+            return step
+        if is_compressed(path) and not self.native:
+            plan.errors.append(f"The binary file '{path}' for partition '{partition}' is compressed, "
+                               "flashing it requires --fastboot-usb")
+            return step
+
+        key = os.path.realpath(path)
+        upload = self.uploads.get(key)
+        if upload is not None:
+            step.upload = upload
+            step.size = upload.size
+            step.send_size = upload.send_size
+            return step
+
+        step.size = image_size(path)
+        if is_compressed(path):
+            # decompressed while being sent, only its compressed size is known
+            step.send_size = os.path.getsize(path)
+        elif self.native:
+            # converted now, the flash reuses the conversion
+            step.send_size = image_cache.get(path).sparse_size()
+        else:
+            step.send_size = os.path.getsize(path)
+        self.uploads[key] = step
+        return step
+
+    def compile(self, targets):
+        plan = FlashPlan(targets)
+        if not targets:
+            if 'all' not in self.img.groups:
+                plan.errors.append("No target specified, and no 'all' default target available")
+                return plan
+            targets = ['all']
+
+        for name in targets:
+            partition, binary = (name.split(':') + [None])[:2]
+
+            if name in self.img.groups:
+                actions = self.img.groups[name]
+                target = PlanTarget(name, group=True)
+                target.force_erase = actions.get('force_erase', False)
+                if not self.skip_erase:
+                    target.erase = [PlanStep('erase', partition) for partition in actions.get('erase', [])]
+                for partition in actions.get('flash', []):
+                    if partition not in self.img.partitions:
+                        plan.errors.append(f"Invalid partition {partition} in group '{name}'")
+                        continue
+                    target.flash.append(self.flash_step(plan, partition, self.img.partitions[partition]))
+                if not self.skip_erase:
+                    target.erase_after_flash = [PlanStep('erase', partition)
+                                                for partition in actions.get('erase_after_flash', [])]
+            elif partition in self.img.partitions:
+                target = PlanTarget(name)
+                target.flash.append(self.flash_step(plan, partition, binary or self.img.partitions[partition]))
+            else:
+                plan.errors.append(f"Invalid target '{name}'")
+                continue
+            plan.targets.append(target)
+
+        for index, step in enumerate(plan.steps()):
+            step.index = index
+        return plan
+
+def compile_plan(image, targets, native=False, skip_erase=False):
+    return PlanCompiler(image, native, skip_erase).compile(targets)
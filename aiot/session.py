@@ -0,0 +1,217 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import argparse
+import logging
+import os
+import threading
+
+from aiot.cache import artifact_cache
+from aiot.devices import device_registry
+from aiot.events import BootromEvent, DeviceEvent, Event, FastbootEvent, TimeoutEvent, VerifyEvent
+from aiot.timeout import Timeouts
+from aiot.verify import VerifyPolicy
+
+# Session stage of the fastboot actions and timeout stages
+FASTBOOT_STAGES = {'erasing': 'erase', 'sending': 'flash', 'writing': 'flash', 'rebooting': 'reboot'}
+TIMEOUT_STAGES = {'partition': 'flash', 'command': 'device'}
+
+_defaults = None
+_defaults_lock = threading.Lock()
+# whether the first session of the process configured the artifact cache
+_cache_configured = False
+
+def default_options():
+    # Options of genio-flash when none is given on its command line.
+    global _defaults
+    with _defaults_lock:
+        if _defaults is None:
+            from aiot.flashtool import FlashTool
+            _defaults = vars(FlashTool().parser.parse_args([]))
+        return dict(_defaults)
+
+def configure_cache(cache_size):
+    # Size the artifact cache shared by the sessions of this process to
+    # cache_size MiB, once: sessions running in threads cannot each resize
+    # it. As with --cache-size, giving a size also caches decompressed
+    # images, None keeps the default. Warn when a later session asks for
+    # another size.
+    global _cache_configured
+    with _defaults_lock:
+        if not _cache_configured:
+            _cache_configured = True
+            if cache_size is not None:
+                artifact_cache.configure(max_size=cache_size * 1024 * 1024, streams=True)
+        elif cache_size is not None and cache_size * 1024 * 1024 != artifact_cache.max_size:
+            logging.getLogger('aiot').warning(f"Artifact cache already sized to "
+                                              f"{artifact_cache.max_size // (1024 * 1024)} MiB, ignoring cache_size")
+
+class StageResult(Event):
+    # Outcome of a stage of a session: board, bootstrap, device, erase,
+    # flash, verify or reboot, of a partition for erase, flash and verify.
+    # status is OKAY, FAIL or TIMEOUT, None when the stage did not complete.
+    __slots__ = ('stage', 'partition', 'status', 'error', 'duration')
+
+class FlashResult:
+    """
+    What a FlashSession did: a StageResult per stage in the order they
+    ran, the events they were built from, the fastboot serial of the
+    board and what it reported through getvar.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.events = []
+        self.fastboot_sn = None
+        self.device = None
+
+    def stage(self, stage, partition=None):
+        # Return the result of a stage, adding it on first use.
+        for result in self.stages:
+            if result.stage == stage and result.partition == partition:
+                return result
+        result = StageResult(stage=stage, partition=partition)
+        self.stages.append(result)
+        return result
+
+    def update(self, stage, partition=None, **fields):
+        result = self.stage(stage, partition)
+        for name, value in fields.items():
+            if value is not None:
+                setattr(result, name, value)
+
+    @property
+    def ok(self):
+        # Board control failures are not fatal, the board may have been
+        # put in download mode by hand.
+        return bool(self.stages) and all(result.status == 'OKAY' for result in self.stages
+                                         if result.stage != 'board')
+
+    def to_dict(self):
+        return {
+            'ok': self.ok,
+            'fastboot_sn': self.fastboot_sn,
+            'device': self.device.to_dict() if self.device else None,
+            'stages': [result.to_dict() for result in self.stages],
+        }
+
+    def __repr__(self):
+        return f"FlashResult(ok={self.ok}, fastboot_sn={self.fastboot_sn!r}, stages={self.stages!r})"
+
+class FlashSession:
+    """
+    Flash an image from Python, without going through the genio-flash
+    command line.
+
+    options are genio-flash options by their argument name, such as
+    {'fastboot_usb': True, 'skip_erase': True}; anything not given takes
+    the genio-flash default. With device, the fastboot serial of a board
+    already in fastboot mode, board control and bootstrap are skipped.
+    Otherwise the board is reset to download mode, bootstrapped, and the
+    first new fastboot device is claimed.
+
+    Each session has its own image, Flash and Fastboot objects, so that
+    sessions of different boards can run in threads of one process. The
+    bootrom tool opens the first board in download mode it finds: sessions
+    without device start it one at a time, each once the previous one has
+    opened its board, so that concurrent sessions get different boards.
+    """
+
+    # serials claimed by the sessions of this process, only changed under
+    # the lock of the device registry, which claims them
+    assigned_sn = set()
+    assigned_lock = device_registry.condition
+
+    def __init__(self, image_path, targets=None, device=None, options=None):
+        self.logger = logging.getLogger('aiot')
+        self.device = device
+        self.args = argparse.Namespace(**default_options())
+        for name, value in (options or {}).items():
+            if not hasattr(self.args, name):
+                raise ValueError(f"Unknown option '{name}'")
+            setattr(self.args, name, value)
+        self.args.path = str(image_path)
+        self.args.targets = list(targets or [])
+        # report through events, as the daemon workers do
+        self.args.daemon = True
+        Timeouts.from_args(self.args)
+        configure_cache(self.args.cache_size)
+        self.result = None
+
+    def assign_sn_flasher(self, fastboot_sn):
+        # Claim the first fastboot device not assigned to another session.
+        with self.assigned_lock:
+            for serial in fastboot_sn or []:
+                if serial not in self.assigned_sn:
+                    self.assigned_sn.add(serial)
+                    return serial
+        return None
+
+    def put(self, event):
+        # Record an event of Flash and fold it into the stage results.
+        result = self.result
+        result.events.append(event)
+
+        if isinstance(event, BootromEvent):
+            if event.action == "Starting":
+                result.update('board', status='FAIL', error=event.error)
+            else:
+                status = 'OKAY' if event.action == "Jumping DA" and not event.error else 'FAIL'
+                result.update('bootstrap', status=status, error=event.error or None)
+        elif isinstance(event, TimeoutEvent):
+            result.update(TIMEOUT_STAGES.get(event.stage, event.stage), event.partition,
+                          status='TIMEOUT', error=event.error)
+        elif isinstance(event, VerifyEvent):
+            if event.partition is not None:
+                result.update('verify', event.partition, status=event.status, error=event.error,
+                              duration=event.duration)
+        elif isinstance(event, DeviceEvent):
+            result.device = event
+            result.update('device', status='OKAY')
+        elif isinstance(event, FastbootEvent):
+            if event.fastboot_sn:
+                result.fastboot_sn = event.fastboot_sn
+            if event.action in FASTBOOT_STAGES:
+                result.update(FASTBOOT_STAGES[event.action], event.partition if event.action != 'rebooting' else None,
+                              status=event.status, error=event.error, duration=event.duration)
+            elif event.action and event.action.startswith("Error"):
+                result.update('device', status='FAIL', error=event.error)
+
+    def run(self):
+        # Flash the targets, return a FlashResult.
+        from aiot.flash import Flash
+        from aiot.flashtool import detect_image
+
+        self.result = FlashResult()
+        image = detect_image(self.args) if os.path.isdir(self.args.path) else None
+        if image is None:
+            self.result.update('image', status='FAIL', error=f"No image found in {self.args.path}")
+            return self.result
+
+        flasher = Flash(image, dry_run=self.args.dry_run, daemon=self, verbose=self.args.verbose,
+                        queue=self, skip_erase=self.args.skip_erase, native=self.args.fastboot_usb,
+                        timeouts=Timeouts.from_args(self.args), delta=self.args.delta,
+                        resume=self.args.resume, verify=VerifyPolicy.from_args(self.args),
+                        fastboot_sn=self.device)
+        # serial this session added to assigned_sn, to remove once done
+        claimed = None
+        try:
+            if not flasher.check(self.args.targets):
+                self.result.update('image', status='FAIL', error="Invalid targets or missing images")
+            elif self.device:
+                self.result.fastboot_sn = self.device
+                with self.assigned_lock:
+                    if self.device not in self.assigned_sn:
+                        self.assigned_sn.add(self.device)
+                        claimed = self.device
+                flasher.flash(self.args.targets)
+            else:
+                flasher.flash_worker(image, self.args, self)
+        finally:
+            if not self.device:
+                # claimed from the device registry, or assign_sn_flasher()
+                claimed = self.result.fastboot_sn
+            if claimed:
+                with self.assigned_lock:
+                    self.assigned_sn.discard(claimed)
+        return self.result
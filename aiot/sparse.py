@@ -0,0 +1,771 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import collections
+import logging
+import os
+import queue
+import struct
+import threading
+
+from aiot.cache import artifact_cache
+from aiot.compression import DecompressedFile, decompressed_size, is_compressed
+from aiot.ext4 import Ext4Image
+from aiot.index import index_entry_of
+from aiot.gpt import GptImage
+
+# Android sparse image format, see system/core/libsparse/sparse_format.h
+SPARSE_HEADER_MAGIC = 0xed26ff3a
+SPARSE_HEADER = struct.Struct("<IHHHHIIII")
+CHUNK_HEADER = struct.Struct("<HHII")
+
+CHUNK_TYPE_RAW = 0xcac1
+CHUNK_TYPE_FILL = 0xcac2
+CHUNK_TYPE_DONT_CARE = 0xcac3
+CHUNK_TYPE_CRC32 = 0xcac4
+
+DEFAULT_BLOCK_SIZE = 4096
+READ_SIZE = 1024 * 1024
+# Segments of a streamed image prepared ahead of the upload
+STREAM_QUEUE_DEPTH = 1
+
+# Content of erased NOR flash
+NOR_ERASED_FILL = 0xffffffff
+# Version of the scanners, part of the key of the cached layouts
+SCAN_VERSION = 1
+# Converted images kept by a process, enough for the files of an image
+# and a few of its variants
+IMAGE_CACHE_ENTRIES = 64
+
+class SparseChunk:
+    """
+    A data carrying chunk of a sparse image: either RAW blocks read from
+    `offset` in the source file, or blocks FILLed with a 32-bit `fill`
+    pattern. Blocks not covered by any chunk are DONT_CARE. RAW chunks
+    of streamed images carry their `data` in memory instead.
+    """
+    __slots__ = ('type', 'block', 'blocks', 'offset', 'fill', 'data')
+
+    def __init__(self, type, block, blocks, offset=0, fill=0, data=None):
+        self.type = type
+        self.block = block
+        self.blocks = blocks
+        self.offset = offset
+        self.fill = fill
+        self.data = data
+
+    def data_size(self, block_size):
+        if self.type == CHUNK_TYPE_RAW:
+            return self.blocks * block_size
+        return 4
+
+    def split(self, blocks, block_size):
+        # Split the chunk after `blocks` blocks, return the two halves.
+        head = SparseChunk(self.type, self.block, blocks, self.offset, self.fill)
+        tail = SparseChunk(self.type, self.block + blocks, self.blocks - blocks, self.offset, self.fill)
+        if self.type == CHUNK_TYPE_RAW:
+            tail.offset += blocks * block_size
+        if self.data is not None:
+            head.data = self.data[:blocks * block_size]
+            tail.data = self.data[blocks * block_size:]
+        return head, tail
+
+    def extend(self, other, block_size):
+        # Merge other into this chunk if it directly follows it with the same content.
+        if (other.type != self.type or other.block != self.block + self.blocks or
+            other.fill != self.fill or self.data is not None or other.data is not None):
+            return False
+        if self.type == CHUNK_TYPE_RAW and other.offset != self.offset + self.blocks * block_size:
+            return False
+        self.blocks += other.blocks
+        return True
+
+    def __repr__(self):
+        return f"SparseChunk(type=0x{self.type:04x}, block={self.block}, blocks={self.blocks})"
+
+def scan_buffer(data, block, offset, block_size, chunks, dont_care=()):
+    """
+    Describe the blocks in data, the first one being `block` and read at
+    `offset` in the source, by appending to chunks: blocks made of a
+    repeated 32-bit value become FILL chunks, or are left out (DONT_CARE)
+    when the value is in dont_care, the others are RAW. A span of blocks
+    is a single fill value when it equals itself shifted by 4 bytes: one
+    memcmp over the whole span, without copying it. Spans that are not
+    get halved until they are, or down to single RAW blocks, for which
+    the memcmp stops within the first bytes.
+    """
+    view = memoryview(data)
+
+    def fill(value, first, count):
+        if value in dont_care:
+            return
+        chunk = SparseChunk(CHUNK_TYPE_FILL, first, count, fill=value)
+        if not chunks or not chunks[-1].extend(chunk, block_size):
+            chunks.append(chunk)
+
+    def raw(i):
+        last = chunks[-1] if chunks else None
+        if (last and last.type == CHUNK_TYPE_RAW and last.data is None and
+            last.block + last.blocks == block + i):
+            last.blocks += 1
+        else:
+            chunks.append(SparseChunk(CHUNK_TYPE_RAW, block + i, 1, offset=offset + i * block_size))
+
+    # spans to check, as (first block, count), in buffer order
+    spans = [(0, len(data) // block_size)]
+    while spans:
+        i, count = spans.pop()
+        if not count:
+            continue
+        start, end = i * block_size, (i + count) * block_size
+        if data.startswith(view[start:end - 4], start + 4):
+            fill(struct.unpack_from("<I", data, start)[0], block + i, count)
+        elif count == 1:
+            raw(i)
+        else:
+            half = count // 2
+            spans.append((i + half, count - half))
+            spans.append((i, half))
+
+    return chunks
+
+def scan_blocks(fp, offset, block, blocks, block_size, dont_care=()):
+    # Read `blocks` blocks at `offset` in fp and describe them as chunks,
+    # see scan_buffer().
+    chunks = []
+    blocks_per_read = max(1, READ_SIZE // block_size)
+
+    fp.seek(offset)
+    end = block + blocks
+    while block < end:
+        count = min(blocks_per_read, end - block)
+        data = fp.read(count * block_size)
+        if len(data) < count * block_size:
+            data += bytes(count * block_size - len(data))
+
+        scan_buffer(data, block, offset, block_size, chunks, dont_care)
+        block += count
+        offset += count * block_size
+
+    return chunks
+
+def block_runs(ranges, block_size, total_blocks):
+    # Convert (offset, length) byte ranges into sorted, merged (block, count)
+    # runs covering them, limited to total_blocks.
+    if ranges is None:
+        return [(0, total_blocks)]
+
+    runs = []
+    for offset, length in sorted(ranges):
+        start = offset // block_size
+        end = min((offset + length + block_size - 1) // block_size, total_blocks)
+        if end <= start:
+            continue
+        if runs and runs[-1][0] + runs[-1][1] >= start:
+            last_start, last_count = runs[-1]
+            runs[-1] = (last_start, max(last_start + last_count, end) - last_start)
+        else:
+            runs.append((start, end - start))
+    return runs
+
+def ext4_ranges(fp, offset, length):
+    # Byte ranges allocated by the ext4 filesystem at offset, or None if
+    # there is no ext4 filesystem this can handle.
+    if not Ext4Image.probe(fp, offset):
+        return None
+    fs = Ext4Image(fp, offset)
+    if not fs.is_supported():
+        return None
+    return [(offset + start, min(size, length - start))
+            for start, size in fs.allocated_ranges() if start < length]
+
+def image_size(path):
+    # Size an image file takes on the device, read from the header of a
+    # sparse file. None for compressed files, whose size is only known
+    # once decompressed.
+    if is_compressed(path):
+        return None
+    with open(path, 'rb') as fp:
+        header = fp.read(SPARSE_HEADER.size)
+    if len(header) == SPARSE_HEADER.size:
+        magic, _, _, _, _, block_size, total_blocks, _, _ = SPARSE_HEADER.unpack(header)
+        if magic == SPARSE_HEADER_MAGIC:
+            return total_blocks * block_size
+    return os.path.getsize(path)
+
+class SparseImage:
+    """
+    Description of a sparse image whose data lives in the file at `path`.
+
+    Nothing is copied: stream() reads the source file while generating the
+    sparse format on the fly, so images can be split and uploaded without
+    writing any temporary file.
+    """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE, total_blocks=0, chunks=None, sparse=False):
+        self.path = str(path) if path is not None else None
+        self.block_size = block_size
+        self.total_blocks = total_blocks
+        self.chunks = chunks if chunks is not None else []
+        # whether the source file already is in sparse format
+        self.sparse = sparse
+
+    @classmethod
+    def is_sparse(cls, path):
+        with open(path, 'rb') as fp:
+            header = fp.read(4)
+        return len(header) == 4 and struct.unpack("<I", header)[0] == SPARSE_HEADER_MAGIC
+
+    @classmethod
+    def from_sparse_file(cls, path):
+        with open(path, 'rb') as fp:
+            (magic, major, minor, file_hdr_sz, chunk_hdr_sz, block_size,
+             total_blocks, total_chunks, _) = SPARSE_HEADER.unpack(fp.read(SPARSE_HEADER.size))
+            if magic != SPARSE_HEADER_MAGIC or major != 1:
+                raise ValueError(f"{path}: unsupported sparse image")
+            fp.seek(file_hdr_sz)
+
+            chunks = []
+            block = 0
+            for _ in range(total_chunks):
+                chunk_type, _, blocks, total_size = CHUNK_HEADER.unpack(fp.read(CHUNK_HEADER.size))
+                fp.seek(chunk_hdr_sz - CHUNK_HEADER.size, os.SEEK_CUR)
+                data_offset = fp.tell()
+                if chunk_type == CHUNK_TYPE_RAW:
+                    chunks.append(SparseChunk(CHUNK_TYPE_RAW, block, blocks, offset=data_offset))
+                elif chunk_type == CHUNK_TYPE_FILL:
+                    fill = struct.unpack("<I", fp.read(4))[0]
+                    chunks.append(SparseChunk(CHUNK_TYPE_FILL, block, blocks, fill=fill))
+                elif chunk_type not in (CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_CRC32):
+                    raise ValueError(f"{path}: unknown sparse chunk type 0x{chunk_type:04x}")
+                fp.seek(data_offset + total_size - chunk_hdr_sz)
+                block += blocks
+
+        if block != total_blocks:
+            raise ValueError(f"{path}: sparse chunks cover {block} blocks, header says {total_blocks}")
+
+        return cls(path, block_size, total_blocks, chunks, sparse=True)
+
+    @classmethod
+    def from_raw_file(cls, path, block_size=DEFAULT_BLOCK_SIZE, scan=False, dont_care=(), ranges=None):
+        # With scan, zero and other fill pattern blocks are not sent as RAW
+        # data. ranges restricts the image to a list of (offset, length)
+        # byte ranges holding data, anything else is DONT_CARE.
+        size = os.path.getsize(path)
+        total_blocks = (size + block_size - 1) // block_size
+        if not total_blocks:
+            return cls(path, block_size, 0, [])
+        if not scan and ranges is None:
+            return cls(path, block_size, total_blocks, [SparseChunk(CHUNK_TYPE_RAW, 0, total_blocks)])
+
+        chunks = []
+        with open(path, 'rb') as fp:
+            for block, blocks in block_runs(ranges, block_size, total_blocks):
+                if scan:
+                    chunks += scan_blocks(fp, block * block_size, block, blocks, block_size, dont_care)
+                else:
+                    chunks.append(SparseChunk(CHUNK_TYPE_RAW, block, blocks, offset=block * block_size))
+        return cls(path, block_size, total_blocks, chunks)
+
+    @classmethod
+    def from_ext4_file(cls, path, block_size=DEFAULT_BLOCK_SIZE, dont_care=()):
+        # Only the blocks allocated by the filesystem are part of the image,
+        # or None if the file is not an ext4 filesystem this can handle.
+        with open(path, 'rb') as fp:
+            ranges = ext4_ranges(fp, 0, os.path.getsize(path))
+        if ranges is None:
+            return None
+        return cls.from_raw_file(path, block_size, scan=True, dont_care=dont_care, ranges=ranges)
+
+    @classmethod
+    def from_disk_file(cls, path, block_size=DEFAULT_BLOCK_SIZE, dont_care=()):
+        # Full-disk image with a GPT: only the partition tables and the
+        # partitions are part of the image, each partition being limited
+        # to its allocated blocks when it holds an ext4 filesystem.
+        # Return None if the file has no valid GPT.
+        logger = logging.getLogger('aiot')
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            gpt = GptImage.open(fp)
+            if gpt is None:
+                return None
+
+            ranges = gpt.metadata_ranges(size)
+            for partition, offset, length in gpt.partition_ranges(size):
+                fs_ranges = ext4_ranges(fp, offset, length)
+                logger.debug(f"gpt: {partition.name}: offset={offset} length={length} "
+                             f"ext4={fs_ranges is not None}")
+                ranges += fs_ranges if fs_ranges is not None else [(offset, length)]
+
+        return cls.from_raw_file(path, block_size, scan=True, dont_care=dont_care, ranges=ranges)
+
+    @classmethod
+    def from_file(cls, path, block_size=DEFAULT_BLOCK_SIZE, scan=False, dont_care=()):
+        if cls.is_sparse(path):
+            return cls.from_sparse_file(path)
+        if scan:
+            for convert in (cls.from_disk_file, cls.from_ext4_file):
+                image = convert(path, block_size, dont_care)
+                if image is not None:
+                    return image
+        return cls.from_raw_file(path, block_size, scan, dont_care)
+
+    @classmethod
+    def from_layout(cls, path, layout):
+        chunks = [SparseChunk(*chunk) for chunk in layout['chunks']]
+        return cls(path, layout['block_size'], layout['total_blocks'], chunks, layout['sparse'])
+
+    def layout(self):
+        # The chunks of the image, to rebuild it without scanning the
+        # source file again. Chunks must not carry their data.
+        return {
+            'block_size': self.block_size,
+            'total_blocks': self.total_blocks,
+            'sparse': self.sparse,
+            'chunks': [[chunk.type, chunk.block, chunk.blocks, chunk.offset, chunk.fill] for chunk in self.chunks],
+        }
+
+    def is_plain(self):
+        # Whether the image is the source file as is, without any gap or fill.
+        return not self.sparse and (not self.chunks or (
+            len(self.chunks) == 1 and self.chunks[0].type == CHUNK_TYPE_RAW and
+            self.chunks[0].blocks == self.total_blocks and self.chunks[0].offset == 0))
+
+    def expanded_size(self):
+        # Size of the image once written to the device.
+        return self.total_blocks * self.block_size
+
+    def covered_size(self):
+        # Bytes written from the start of the device before the first
+        # DONT_CARE block, whose previous content is left in place.
+        block = 0
+        for chunk in self.chunks:
+            if chunk.block != block:
+                break
+            block += chunk.blocks
+        return block * self.block_size
+
+    def _layout(self):
+        # Yield (gap_blocks, chunk) in order, chunk is None for the trailing gap.
+        block = 0
+        for chunk in self.chunks:
+            yield chunk.block - block, chunk
+            block = chunk.block + chunk.blocks
+        yield self.total_blocks - block, None
+
+    def sparse_size(self):
+        # Size of the image in sparse format, as sent over USB.
+        size = SPARSE_HEADER.size
+        for gap, chunk in self._layout():
+            if gap:
+                size += CHUNK_HEADER.size
+            if chunk:
+                size += CHUNK_HEADER.size + chunk.data_size(self.block_size)
+        return size
+
+    def chunk_count(self):
+        return sum((1 if gap else 0) + (1 if chunk else 0) for gap, chunk in self._layout())
+
+    def split(self, max_size):
+        # Split the image into segments whose sparse size fit in max_size.
+        # Each segment covers the whole image, with DONT_CARE blocks around
+        # its own chunks, so the device can write them one after the other.
+        overhead = SPARSE_HEADER.size + 2 * CHUNK_HEADER.size
+        budget = max_size - overhead
+        if budget < 2 * CHUNK_HEADER.size + self.block_size:
+            raise ValueError(f"max download size {max_size} too small for block size {self.block_size}")
+
+        segments = []
+        current = []
+        used = 0
+        pending = list(reversed(self.chunks))
+        while pending:
+            chunk = pending.pop()
+            # a gap between two chunks of the same segment costs a header
+            gap = CHUNK_HEADER.size if current and current[-1].block + current[-1].blocks != chunk.block else 0
+            cost = gap + CHUNK_HEADER.size + chunk.data_size(self.block_size)
+            if used + cost <= budget:
+                current.append(chunk)
+                used += cost
+                continue
+
+            if chunk.type == CHUNK_TYPE_RAW:
+                blocks = (budget - used - gap - CHUNK_HEADER.size) // self.block_size
+                if blocks > 0:
+                    head, tail = chunk.split(blocks, self.block_size)
+                    current.append(head)
+                    pending.append(tail)
+                    used = budget
+                    continue
+
+            if not current:
+                raise ValueError(f"sparse chunk {chunk} does not fit in {max_size} bytes")
+            segments.append(current)
+            current = []
+            used = 0
+            pending.append(chunk)
+
+        if current or not segments:
+            segments.append(current)
+
+        return [SparseImage(self.path, self.block_size, self.total_blocks, chunks)
+                for chunks in segments]
+
+    def _read_raw(self, fp, chunk):
+        # Yield the data of a RAW chunk, zero padding past the end of file.
+        fp.seek(chunk.offset)
+        remaining = chunk.blocks * self.block_size
+        while remaining:
+            data = fp.read(min(READ_SIZE, remaining))
+            if not data:
+                data = bytes(min(READ_SIZE, remaining))
+            remaining -= len(data)
+            yield data
+
+    def expand(self):
+        # Yield (offset, data) the content written by each chunk at offset
+        # bytes of the device, in pieces of at most READ_SIZE bytes.
+        fp = None
+        try:
+            for chunk in self.chunks:
+                if chunk.type != CHUNK_TYPE_RAW:
+                    pattern = struct.pack("<I", chunk.fill) * (self.block_size // 4)
+                    per_read = max(1, READ_SIZE // self.block_size)
+                    for block in range(chunk.block, chunk.block + chunk.blocks, per_read):
+                        yield block * self.block_size, pattern * min(per_read, chunk.block + chunk.blocks - block)
+                    continue
+
+                if chunk.data is not None:
+                    data = [chunk.data]
+                else:
+                    if fp is None:
+                        fp = open(self.path, 'rb')
+                    data = self._read_raw(fp, chunk)
+                offset = chunk.block * self.block_size
+                for piece in data:
+                    yield offset, piece
+                    offset += len(piece)
+        finally:
+            if fp is not None:
+                fp.close()
+
+    def stream(self):
+        # Generate the image in sparse format.
+        logger = logging.getLogger('aiot')
+        logger.debug(f"sparse: {self.path}: {len(self.chunks)} chunks, "
+                     f"{self.sparse_size()} bytes for {self.expanded_size()} bytes")
+
+        yield SPARSE_HEADER.pack(SPARSE_HEADER_MAGIC, 1, 0, SPARSE_HEADER.size, CHUNK_HEADER.size,
+                                 self.block_size, self.total_blocks, self.chunk_count(), 0)
+
+        fp = None
+        try:
+            for gap, chunk in self._layout():
+                if gap:
+                    yield CHUNK_HEADER.pack(CHUNK_TYPE_DONT_CARE, 0, gap, CHUNK_HEADER.size)
+                if chunk is None:
+                    continue
+
+                size = chunk.data_size(self.block_size)
+                yield CHUNK_HEADER.pack(chunk.type, 0, chunk.blocks, CHUNK_HEADER.size + size)
+                if chunk.type != CHUNK_TYPE_RAW:
+                    yield struct.pack("<I", chunk.fill)
+                elif chunk.data is not None:
+                    yield chunk.data
+                else:
+                    if fp is None:
+                        fp = open(self.path, 'rb')
+                    yield from self._read_raw(fp, chunk)
+        finally:
+            if fp is not None:
+                fp.close()
+
+class SparseStream:
+    """
+    Image read from a compressed file, converted to sparse segments while
+    it is being decompressed. Decompression runs in a background thread,
+    a bounded number of segments ahead of the upload, and the decompressed
+    image is never written to disk.
+
+    Raw images go through the zero/fill scan, images already in sparse
+    format are re-chunked as they are read. The other converters need
+    random access and are not used on streams.
+
+    With cache, the decompressed image is also written to the artifact
+    cache as it goes, and published there once entirely read.
+    """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE, dont_care=(), cache=False):
+        self.path = str(path)
+        self.block_size = block_size
+        self.dont_care = dont_care
+        self.cache = cache
+        self.file = None
+        # (queue, stop event, thread, max_size) of the running producer
+        self.producer = None
+
+    @staticmethod
+    def cache_key(path):
+        # Artifact cache key of the decompressed content of path, by
+        # content when the image is indexed.
+        entry = index_entry_of(path)
+        if entry is not None:
+            return artifact_cache.key('decompressed', entry['sha256'])
+        st = os.stat(path)
+        return artifact_cache.key('decompressed', os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+    def progress(self):
+        # Ratio of the compressed file consumed so far.
+        if self.file is None or not self.file.size:
+            return 0.0
+        return self.file.tell_compressed() / self.file.size
+
+    def _raw_chunks(self, fp):
+        block = 0
+        while True:
+            data = fp.read(READ_SIZE)
+            if not data:
+                return
+            if len(data) % self.block_size:
+                data += bytes(self.block_size - len(data) % self.block_size)
+
+            chunks = scan_buffer(data, block, 0, self.block_size, [], self.dont_care)
+            view = memoryview(data)
+            for chunk in chunks:
+                if chunk.type == CHUNK_TYPE_RAW:
+                    chunk.data = view[chunk.offset:chunk.offset + chunk.blocks * self.block_size]
+                yield chunk
+            block += len(data) // self.block_size
+
+    def _sparse_chunks(self, fp, header):
+        (_, major, _, file_hdr_sz, chunk_hdr_sz, block_size,
+         total_blocks, total_chunks, _) = SPARSE_HEADER.unpack(header)
+        if major != 1:
+            raise ValueError(f"{self.path}: unsupported sparse image")
+        self.block_size = block_size
+        fp.read(file_hdr_sz - SPARSE_HEADER.size)
+
+        blocks_per_read = max(1, READ_SIZE // block_size)
+        block = 0
+        for _ in range(total_chunks):
+            chunk_type, _, blocks, total_size = CHUNK_HEADER.unpack(fp.read(CHUNK_HEADER.size))
+            fp.read(chunk_hdr_sz - CHUNK_HEADER.size)
+            if chunk_type == CHUNK_TYPE_RAW:
+                for start in range(0, blocks, blocks_per_read):
+                    count = min(blocks_per_read, blocks - start)
+                    data = fp.read(count * block_size)
+                    yield SparseChunk(CHUNK_TYPE_RAW, block + start, count, data=data)
+            elif chunk_type == CHUNK_TYPE_FILL:
+                fill = struct.unpack("<I", fp.read(4))[0]
+                if fill not in self.dont_care:
+                    yield SparseChunk(CHUNK_TYPE_FILL, block, blocks, fill=fill)
+            elif chunk_type in (CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_CRC32):
+                fp.read(total_size - chunk_hdr_sz)
+            else:
+                raise ValueError(f"{self.path}: unknown sparse chunk type 0x{chunk_type:04x}")
+            block += blocks
+
+    def _segments(self, fp, max_size):
+        # Group the chunks into segments fitting max_size.
+        header = fp.read(SPARSE_HEADER.size)
+        if len(header) == SPARSE_HEADER.size and struct.unpack_from("<I", header)[0] == SPARSE_HEADER_MAGIC:
+            chunks = self._sparse_chunks(fp, header)
+        else:
+            chunks = self._raw_chunks(PrefixedFile(header, fp))
+
+        budget = max_size - SPARSE_HEADER.size - CHUNK_HEADER.size
+        current = []
+        used = 0
+        for chunk in chunks:
+            if current and current[-1].extend(chunk, self.block_size):
+                continue
+            pending = [chunk]
+            while pending:
+                chunk = pending.pop()
+                gap = CHUNK_HEADER.size if current and current[-1].block + current[-1].blocks != chunk.block else 0
+                cost = gap + CHUNK_HEADER.size + chunk.data_size(self.block_size)
+                if used + cost <= budget:
+                    current.append(chunk)
+                    used += cost
+                    continue
+
+                if chunk.type == CHUNK_TYPE_RAW:
+                    blocks = (budget - used - gap - CHUNK_HEADER.size) // self.block_size
+                    if blocks > 0:
+                        head, tail = chunk.split(blocks, self.block_size)
+                        current.append(head)
+                        pending.append(tail)
+                        used = budget
+                        continue
+
+                if not current:
+                    raise ValueError(f"sparse chunk {chunk} does not fit in {max_size} bytes")
+                yield self._segment(current)
+                current = []
+                used = 0
+                pending.append(chunk)
+
+        yield self._segment(current)
+
+    def _segment(self, chunks):
+        # The full size of the image is not known yet, segments end with
+        # their last chunk.
+        end = chunks[-1].block + chunks[-1].blocks if chunks else 0
+        return SparseImage(None, self.block_size, end, chunks)
+
+    def prefetch(self, max_size):
+        # Start preparing the segments of max_size bytes before they are
+        # asked for, holding up to prefetch_size(max_size) bytes.
+        if self.producer is None:
+            self.producer = self._produce(max_size)
+
+    @staticmethod
+    def prefetch_size(max_size):
+        # Memory held by the segments prepared ahead of the upload.
+        return (STREAM_QUEUE_DEPTH + 1) * max_size
+
+    def close(self):
+        # Stop the producer, if any.
+        if self.producer is not None:
+            _, stop, thread, _ = self.producer
+            stop.set()
+            thread.join()
+            self.producer = None
+
+    def _produce(self, max_size):
+        segments = queue.Queue(maxsize=STREAM_QUEUE_DEPTH)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    segments.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            writer = None
+            if self.cache and artifact_cache.fits(decompressed_size(self.path)):
+                writer = artifact_cache.writer('decompressed', self.cache_key(self.path))
+            try:
+                with DecompressedFile(self.path) as fp:
+                    self.file = fp
+                    source = TeeFile(fp, writer) if writer else fp
+                    for segment in self._segments(source, max_size):
+                        if not put(segment):
+                            return
+                if writer:
+                    writer.commit()
+                    writer = None
+                put(None)
+            except Exception as e:
+                put(e)
+            finally:
+                if writer:
+                    writer.discard()
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        return segments, stop, thread, max_size
+
+    def segments(self, max_size):
+        # Yield SparseImage segments of at most max_size bytes each, while
+        # the next ones are prepared in the background.
+        if self.producer is not None and self.producer[3] != max_size:
+            self.close()
+        self.prefetch(max_size)
+        segments = self.producer[0]
+        try:
+            while True:
+                item = segments.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+class PrefixedFile:
+    # File-like object returning `prefix` before the content of fp.
+
+    def __init__(self, prefix, fp):
+        self.prefix = prefix
+        self.fp = fp
+
+    def read(self, size):
+        if not self.prefix:
+            return self.fp.read(size)
+        data = self.prefix + self.fp.read(max(0, size - len(self.prefix)))
+        self.prefix = b''
+        return data
+
+class TeeFile:
+    # File-like object copying what is read from fp to writer.
+
+    def __init__(self, fp, writer):
+        self.fp = fp
+        self.writer = writer
+
+    def read(self, size):
+        data = self.fp.read(size)
+        self.writer.write(data)
+        return data
+
+class SparseImageCache:
+    """
+    Conversion results shared by all the users of this process, keyed by
+    file identity and conversion parameters. Concurrent requests for the
+    same image wait for a single conversion instead of redoing it. Scan
+    results are kept in the artifact cache for the next runs.
+
+    A long-running daemon sees images change: the entries of a file that
+    changed are dropped, and only the max_entries most recently used are
+    kept.
+    """
+
+    def __init__(self, max_entries=IMAGE_CACHE_ENTRIES):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    def get(self, path, dont_care=()):
+        st = os.stat(path)
+        key = (os.path.realpath(path), st.st_size, st.st_mtime_ns, st.st_ino, tuple(dont_care))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                for stale in [other for other in self.entries if other[0] == key[0] and other[1:4] != key[1:4]]:
+                    del self.entries[stale]
+                entry = self.entries[key] = [threading.Lock(), None]
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(key)
+
+        with entry[0]:
+            if entry[1] is None:
+                entry[1] = self.convert(path, key, dont_care)
+            return entry[1]
+
+    def convert(self, path, key, dont_care):
+        # Images in sparse format are only parsed, not worth caching.
+        if SparseImage.is_sparse(path):
+            return SparseImage.from_sparse_file(path)
+
+        entry = index_entry_of(path)
+        if entry is not None and 'layout' in entry and not dont_care:
+            return SparseImage.from_layout(path, entry['layout'])
+
+        identity = [entry['sha256']] if entry is not None else list(key[:3])
+        cache_key = artifact_cache.key('layout', SCAN_VERSION, *identity, list(dont_care))
+        layout = artifact_cache.load_json('layout', cache_key)
+        if layout is not None:
+            return SparseImage.from_layout(path, layout)
+        image = SparseImage.from_file(path, scan=True, dont_care=dont_care)
+        artifact_cache.store_json('layout', cache_key, image.layout())
+        return image
+
+image_cache = SparseImageCache()
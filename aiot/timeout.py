@@ -0,0 +1,182 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import logging
+import subprocess
+import threading
+import time
+
+from aiot.events import TimeoutEvent
+
+# Default (deadline, inactivity) of each stage in seconds, None disables
+# the limit. inactivity is the longest time a child may stay silent. The
+# bootstrap has none, bootrom-tool may wait for the operator, nor the
+# partition uploads, the fastboot binary prints nothing while it sends a
+# plain image, for minutes on a slow link; the native client times out
+# each USB transfer instead.
+STAGE_TIMEOUTS = {
+    'bootstrap': (60, None),
+    'erase': (600, 120),
+    'partition': (1800, None),
+    'reboot': (60, 30),
+    'command': (120, 30),
+}
+
+# Time given to a child to exit after SIGTERM, before it is killed
+TERMINATE_GRACE = 5
+
+def print_line(line):
+    # on_line handler echoing the output of a child as it comes.
+    if line.strip():
+        print(line.rstrip(), flush=True)
+
+def timeout_event(stage, kind, limit, partition=None):
+    # Event reported to the worker when a stage exceeds one of its limits.
+    return TimeoutEvent(action="Error", error=f"{stage} {kind} timeout after {limit}s",
+                        timeout=kind, stage=stage, partition=partition)
+
+class Timeouts:
+    """
+    Deadline and inactivity limits of the flashing stages, the defaults
+    being overridden by "STAGE=DEADLINE[:INACTIVITY]" specs, where 0
+    disables a limit.
+    """
+
+    def __init__(self, specs=None):
+        self.stages = dict(STAGE_TIMEOUTS)
+        for spec in specs or []:
+            stage, _, limits = spec.partition('=')
+            if stage not in self.stages or not limits:
+                raise ValueError(f"Invalid timeout '{spec}', expected STAGE=DEADLINE[:INACTIVITY] "
+                                 f"with STAGE one of {', '.join(self.stages)}")
+            deadline, _, inactivity = limits.partition(':')
+            deadline = float(deadline) or None
+            inactivity = (float(inactivity) or None) if inactivity else self.stages[stage][1]
+            self.stages[stage] = (deadline, inactivity)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(getattr(args, 'timeout', None))
+
+    def deadline(self, stage):
+        return self.stages[stage][0]
+
+    def inactivity(self, stage):
+        return self.stages[stage][1]
+
+class SupervisedProcess:
+    """
+    Child process run under a deadline and an output inactivity limit.
+
+    Output lines are read by a helper thread and passed to on_line. The
+    calling thread sleeps on a condition until a line arrives, the child
+    exits or a limit expires, so no CPU is used while waiting. A child
+    exceeding a limit is terminated, killed if it does not exit, and
+    always reaped; timed_out then tells which limit expired.
+
+    With deferred, the deadline only runs once start_deadline() is called,
+    for a child first waiting on something that may legitimately take
+    long, such as an operator.
+    """
+
+    def __init__(self, command, deadline=None, inactivity=None, on_line=None, deferred=False):
+        self.logger = logging.getLogger('aiot')
+        self.command = [str(arg) for arg in command]
+        self.deadline = deadline
+        self.inactivity = inactivity
+        self.on_line = on_line
+        self.condition = threading.Condition()
+        self.output = []
+        self.timed_out = None
+        self.process = None
+        self.eof = False
+        self.last_output = None
+        self.deferred = deferred
+        self.deadline_start = None
+
+    def _read(self):
+        try:
+            for line in iter(self.process.stdout.readline, ''):
+                with self.condition:
+                    self.output.append(line)
+                    self.last_output = time.monotonic()
+                    self.condition.notify()
+                if self.on_line:
+                    self.on_line(line)
+        finally:
+            self.process.stdout.close()
+            with self.condition:
+                self.eof = True
+                self.condition.notify()
+
+    def start_deadline(self):
+        # Start the deferred deadline, from now. Called from on_line.
+        with self.condition:
+            if self.deadline_start is None:
+                self.deadline_start = time.monotonic()
+                self.condition.notify()
+
+    def _expired(self):
+        # Return (limit kind, seconds left before the next expiry).
+        now = time.monotonic()
+        limits = []
+        if self.deadline and self.deadline_start is not None:
+            limits.append(('deadline', self.deadline_start + self.deadline - now))
+        if self.inactivity:
+            limits.append(('inactivity', self.last_output + self.inactivity - now))
+        return min(limits, key=lambda limit: limit[1], default=(None, None))
+
+    def _stop(self):
+        if self.timed_out:
+            self.logger.warning(f"{self.command[0]}: {self.timed_out} timeout, terminating")
+        self.process.terminate()
+        try:
+            self.process.wait(TERMINATE_GRACE)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def run(self):
+        # Run the child to completion or timeout, return its exit code.
+        start = time.monotonic()
+        self.last_output = start
+        if not self.deferred:
+            self.deadline_start = start
+        self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        text=True, errors='replace')
+        reader = threading.Thread(target=self._read, daemon=True)
+        reader.start()
+
+        try:
+            with self.condition:
+                while not self.eof:
+                    kind, remaining = self._expired()
+                    if kind and remaining <= 0:
+                        self.timed_out = kind
+                        break
+                    self.condition.wait(remaining)
+
+            if not self.timed_out:
+                # output closed, the child should be exiting
+                remaining = None
+                if self.deadline and self.deadline_start is not None:
+                    remaining = max(self.deadline_start + self.deadline - time.monotonic(), 0)
+                try:
+                    self.process.wait(remaining)
+                except subprocess.TimeoutExpired:
+                    self.timed_out = 'deadline'
+        finally:
+            if self.process.poll() is None:
+                self._stop()
+            # a grandchild may still hold the output open, the rest of
+            # the output is of no use after a timeout
+            reader.join(0 if self.timed_out else TERMINATE_GRACE)
+
+        return self.process.returncode
+
+    def limit(self):
+        # Value of the limit that expired.
+        return self.deadline if self.timed_out == 'deadline' else self.inactivity
+
+    def stdout(self):
+        return ''.join(self.output)
@@ -7,6 +7,8 @@ import random
 import zlib
 import struct
 
+from aiot.cache import artifact_cache
+
 class UBootEnv:
     def __init__(self, env_size, env_file, args, use_android_dtbo=False):
         self.logger = logging.getLogger('aiot')
@@ -14,6 +16,8 @@ class UBootEnv:
         self.env_size = env_size
         self.args = args
         self.use_android_dtbo = use_android_dtbo
+        # random variables, such as MAC addresses, differ on each run
+        self.randomized = False
         with open(env_file, "r") as env:
             self.env = env.readlines()
         if self.args.dtbo_index:
@@ -91,6 +95,21 @@ class UBootEnv:
         for line in self.env:
             self.logger.debug(f"(env) {line.strip()}")
 
+        # The binary only depends on the variables, the env size and the
+        # redund offset: reuse the one of a previous run if any. An env
+        # with random variables never matches one, nor must be reused.
+        if self.randomized:
+            self._write_binary(filename, redund_offset)
+            return
+
+        key = artifact_cache.key('u-boot-env', self.env, self.env_size, redund_offset)
+        if artifact_cache.fetch('u-boot-env', key, filename):
+            return
+
+        if self._write_binary(filename, redund_offset):
+            artifact_cache.store('u-boot-env', key, filename)
+
+    def _write_binary(self, filename, redund_offset):
         with open(filename, "w+b") as out:
             redund_id = -1
 
@@ -100,14 +119,15 @@ class UBootEnv:
             self.write_env(out, redund_id)
 
             if redund_offset == -1:
-                return
+                return True
 
             if redund_offset < self.env_size:
                 self.logger.error(f"redund_offset(0x{redund_offset:08x}) < env_size(0x{self.env_size:08x}): the redund env will override the main env, aborting...")
-                return
+                return False
 
             out.seek(redund_offset)
             self.write_env(out, 1)
+            return True
 
     def gen_mac_addr(self, oui, num_iface):
         for i in range(num_iface):
@@ -120,3 +140,4 @@ class UBootEnv:
             if i == 0:
                 varname = "ethaddr"
             self.add(varname, macaddr)
+            self.randomized = True
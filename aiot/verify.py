@@ -0,0 +1,84 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import random
+
+from aiot.delta import DELTA_HASH_SIZE, READBACK_SIZE, BlockHasher, image_digests, indexed_digests
+
+VERIFY_MODES = ('full', 'sample')
+# Blocks read back per partition when sampling
+DEFAULT_SAMPLE_BLOCKS = 16
+
+class VerifyPolicy:
+    """
+    What to read back after flashing: every block of each flashed
+    partition in full mode, sample_blocks blocks picked at random in
+    sample mode. Only a board_ratio fraction of the boards, picked at
+    random, is verified.
+    """
+
+    def __init__(self, mode=None, sample_blocks=DEFAULT_SAMPLE_BLOCKS, board_ratio=1.0, rng=None):
+        if mode is not None and mode not in VERIFY_MODES:
+            raise ValueError(f"Unknown verify mode '{mode}'")
+        if not 0.0 <= board_ratio <= 1.0:
+            raise ValueError(f"Verify board ratio {board_ratio} not between 0 and 1")
+        self.mode = mode
+        self.sample_blocks = sample_blocks
+        self.board_ratio = board_ratio
+        self.rng = rng or random.Random()
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(getattr(args, 'verify', None), getattr(args, 'verify_blocks', DEFAULT_SAMPLE_BLOCKS),
+                   getattr(args, 'verify_boards', 1.0))
+
+    @property
+    def enabled(self):
+        return self.mode is not None
+
+    def board_selected(self):
+        return self.board_ratio >= 1.0 or self.rng.random() < self.board_ratio
+
+    def select(self, blocks):
+        # The blocks to read back among the list of verifiable blocks.
+        if self.mode == 'full' or len(blocks) <= self.sample_blocks:
+            return list(blocks)
+        return sorted(self.rng.sample(blocks, self.sample_blocks))
+
+def block_ranges(blocks, hash_size, size, max_size=READBACK_SIZE):
+    # Group sorted block indexes into (offset, length, blocks) reads of
+    # consecutive blocks, of at most max_size bytes.
+    ranges = []
+    for index in blocks:
+        offset = index * hash_size
+        length = min(hash_size, size - offset)
+        if ranges:
+            start, total, indexes = ranges[-1]
+            if start + total == offset and total + length <= max_size:
+                ranges[-1] = (start, total + length, indexes + [index])
+                continue
+        ranges.append((offset, length, [index]))
+    return ranges
+
+def verify_image(device, partition, image, policy, hash_size=DELTA_HASH_SIZE):
+    """
+    Read back the blocks of partition that policy selects, hashing them
+    as they arrive, and compare them with image. device has a
+    fetch(partition, sink, offset, size) method. Blocks the image does not
+    entirely write cannot be compared and are never read. Return the
+    number of blocks read and the list of the ones that differ.
+    """
+    expected = indexed_digests(image, hash_size)
+    if expected is None:
+        expected = image_digests(image, hash_size)
+    selected = policy.select([index for index, digest in enumerate(expected) if digest is not None])
+
+    mismatches = []
+    for offset, length, indexes in block_ranges(selected, hash_size, image.expanded_size()):
+        hasher = BlockHasher(hash_size)
+        device.fetch(partition, hasher.update, offset, length)
+        digests = hasher.finish()
+        mismatches += [index for index, digest in zip(indexes, digests) if digest != expected[index]]
+        # a short read leaves blocks without digest
+        mismatches += indexes[len(digests):]
+    return len(selected), mismatches
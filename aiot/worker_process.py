@@ -0,0 +1,152 @@
+# SPDX-License-Identifier: MIT
+# Copyright 2026 (c) MediaTek Inc.
+
+import logging
+import multiprocessing
+import sys
+import threading
+
+import aiot
+from aiot import bootrom, events
+from aiot.timeout import Timeouts
+from aiot.verify import VerifyPolicy
+
+WORKER_MODES = ('thread', 'process')
+# Seconds a worker process is given to exit once asked to
+STOP_TIMEOUT = 5
+
+# Worker processes are spawned rather than forked: the daemon runs many
+# threads, whose locks a forked child could inherit held
+_context = multiprocessing.get_context('spawn')
+
+class WorkerChannel:
+    """
+    The daemon as seen by a Flash in a worker process. Events are sent as
+    the name and fields of their class, and what needs the state of the
+    daemon, such as the fastboot serials assigned to the other workers,
+    is a call answered by the daemon process.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        # events are sent from the fastboot and bootrom helper threads too
+        self.lock = threading.Lock()
+
+    def send(self, *message):
+        with self.lock:
+            self.conn.send(message)
+
+    def put(self, event):
+        # Queue interface of Flash and its bootstrap.
+        self.send('event', type(event).__name__, event.to_dict())
+
+    def call(self, method, *args):
+        self.send('call', method, args)
+        return self.conn.recv()
+
+    @property
+    def assigned_sn(self):
+        return set(self.call('assigned_sn'))
+
+    def assign_sn_flasher(self, fastboot_sn):
+        return self.call('assign_sn_flasher', fastboot_sn)
+
+    def claim_fastboot_device(self, port=None, timeout=10):
+        return self.call('claim_fastboot_device', port, timeout)
+
+    def redispatch(self, port):
+        return self.call('redispatch', port)
+
+def worker_main(conn, image, args, plan, open_lock):
+    # Main of a worker process: flash each board the daemon sends, on its
+    # USB port when known, until sent None.
+    from aiot.app import FlushingStreamHandler
+    from aiot.flash import Flash
+
+    sys.stdout.reconfigure(line_buffering=True)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        handlers=[FlushingStreamHandler()], force=True)
+    # boards bootstrapped by the other worker processes too
+    bootrom.bootrom_open_lock = open_lock
+
+    channel = WorkerChannel(conn)
+    while True:
+        message = conn.recv()
+        if message is None:
+            return
+        _, port = message
+        flasher = Flash(image=image, dry_run=args.dry_run, daemon=channel, verbose=args.verbose, queue=channel, skip_erase=args.skip_erase, native=args.fastboot_usb, timeouts=Timeouts.from_args(args), delta=args.delta, resume=args.resume, verify=VerifyPolicy.from_args(args), plan=plan, board_port=port)
+        try:
+            flashed = flasher.flash_worker(image, args, channel)
+        except Exception as e:
+            logging.getLogger('aiot').error(str(e))
+            flashed = False
+        channel.send('done', bool(flashed))
+
+class WorkerProcess:
+    """
+    Child process flashing the boards of a daemon worker in process mode,
+    kept from one board to the next. The events of each board come back
+    through a pipe, so that flashing supervision does not compete with
+    the other workers for the GIL of the daemon.
+    """
+
+    def __init__(self, name, image, args, plan, open_lock):
+        self.logger = logging.getLogger('aiot')
+        self.args = args
+        self.conn, child_conn = _context.Pipe()
+        self.process = _context.Process(target=worker_main, name=name, daemon=True,
+                                        args=(child_conn, image, args, plan, open_lock))
+        self.process.start()
+        child_conn.close()
+
+    @staticmethod
+    def open_lock():
+        # Lock serializing the bootrom open phase across worker processes.
+        return _context.Lock()
+
+    def flash(self, port, on_event, daemon):
+        """
+        Flash the board on USB port, None when not known, passing its
+        events to on_event and answering the calls of the child with
+        daemon. Return whether the board was flashed. Raise EOFError or
+        OSError when the child died.
+        """
+        self.conn.send(('board', port))
+        while True:
+            message = self.conn.recv()
+            if message[0] == 'event':
+                _, name, fields = message
+                on_event(getattr(events, name).from_dict(fields))
+            elif message[0] == 'call':
+                _, method, args = message
+                self.conn.send(self.answer(daemon, method, args))
+            elif message[0] == 'done':
+                return message[1]
+
+    def answer(self, daemon, method, args):
+        from aiot.flash import claim_fastboot_device
+
+        if method == 'assigned_sn':
+            with daemon.assigned_lock:
+                return list(daemon.assigned_sn)
+        if method == 'assign_sn_flasher':
+            return daemon.assign_sn_flasher(*args)
+        if method == 'redispatch':
+            return daemon.redispatch(*args)
+        if method == 'claim_fastboot_device':
+            fastboot = aiot.Fastboot(dry_run=self.args.dry_run, daemon=True, native=self.args.fastboot_usb)
+            return claim_fastboot_device(daemon, fastboot, *args)
+        raise ValueError(f"Unknown worker process call {method}")
+
+    def stop(self):
+        # Ask the child to exit, terminate it if it does not.
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
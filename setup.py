@@ -48,6 +48,7 @@ setuptools.setup(
         'pyudev;platform_system=="Linux"',
         'ftd2xx;platform_system=="Windows"',
         'fastboot-log-parser',
+        'zstandard',
     ],
     classifiers=[
         "Programming Language :: Python :: 3",